@@ -0,0 +1,217 @@
+# allergens.py
+
+import re
+from Agent.catalog import prebuilt, recipes, all_recipe_ids
+from Agent.text import katakana_to_hiragana, normalize_kana, normalize_text
+
+# Allergen and diet classes with the Japanese and English terms that mark an ingredient
+# as belonging to them. `exclude` terms are removed before matching so e.g. 牛乳 (milk)
+# is not read as 牛 (beef).
+ALLERGEN_CLASSES = {
+    "egg": {
+        "terms": ["卵", "たまご", "タマゴ", "玉子", "マヨネーズ", "egg", "mayonnaise"],
+        "exclude": ["eggplant"],
+    },
+    "dairy": {
+        "terms": ["牛乳", "ミルク", "バター", "チーズ", "クリーム", "ヨーグルト", "練乳", "モッツァレラ",
+                  "milk", "butter", "cheese", "cream", "yogurt"],
+        "exclude": ["ココナッツミルク", "豆乳", "ピーナッツバター", "coconut milk"],
+    },
+    "wheat": {
+        "terms": ["小麦", "薄力粉", "強力粉", "パン粉", "パン", "うどん", "中華麺", "ラーメン", "焼そば", "焼きそば",
+                  "パスタ", "スパゲティ", "マカロニ", "ペンネ", "餃子の皮", "ホットケーキミックス", "天ぷら粉", "麩",
+                  "wheat", "flour", "bread", "pasta", "noodle"],
+        "exclude": ["パンプキン", "フライパン", "rice flour", "corn flour"],
+    },
+    "buckwheat": {
+        "terms": ["そば", "蕎麦", "buckwheat", "soba"],
+        "exclude": ["焼そば", "焼きそば"],
+    },
+    "peanut": {
+        "terms": ["落花生", "ピーナッツ", "peanut"],
+        "exclude": [],
+    },
+    "tree_nut": {
+        "terms": ["くるみ", "クルミ", "アーモンド", "カシューナッツ", "ナッツ", "ピスタチオ", "マカダミア",
+                  "walnut", "almond", "cashew", "pistachio", "nut"],
+        "exclude": ["ピーナッツ", "ココナッツ", "peanut", "coconut"],
+    },
+    "sesame": {
+        "terms": ["ごま", "胡麻", "ゴマ", "sesame"],
+        "exclude": [],
+    },
+    "soy": {
+        "terms": ["大豆", "豆腐", "とうふ", "納豆", "味噌", "みそ", "豆乳", "油揚げ", "厚揚げ", "しょうゆ", "醤油",
+                  "soy", "tofu", "miso"],
+        "exclude": [],
+    },
+    "shellfish": {
+        "terms": ["えび", "エビ", "海老", "かに", "カニ", "蟹", "shrimp", "prawn", "crab", "lobster"],
+        "exclude": ["かにかま", "カニカマ"],
+    },
+    "mollusc": {
+        "terms": ["いか", "イカ", "たこ", "タコ", "あさり", "しじみ", "ほたて", "ホタテ", "帆立", "かき", "牡蠣", "貝",
+                  "squid", "octopus", "clam", "scallop", "oyster", "mussel"],
+        "exclude": ["いかが", "たこ焼き粉", "かき混", "かき揚げ", "貝割れ", "かいわれ"],
+    },
+    "fish": {
+        "terms": ["鮭", "さけ", "サーモン", "まぐろ", "マグロ", "鮪", "ツナ", "たら", "タラ", "さば", "サバ", "いわし",
+                  "あじ", "アジ", "ぶり", "しらす", "かつお", "鰹", "いくら", "たらこ", "明太子", "ちくわ", "かまぼこ",
+                  "かにかま", "カニカマ", "白だし", "本つゆ", "めんつゆ", "アンチョビ",
+                  "salmon", "tuna", "cod", "mackerel", "sardine", "anchovy", "fish", "bonito"],
+        "exclude": ["あじわい", "味わい", "さける"],
+    },
+    "pork": {
+        "terms": ["豚", "ポーク", "ベーコン", "ハム", "ウインナー", "ソーセージ", "pork", "bacon", "ham", "sausage"],
+        "exclude": [],
+    },
+    "beef": {
+        "terms": ["牛", "ビーフ", "beef"],
+        "exclude": ["牛乳"],
+    },
+    "chicken": {
+        "terms": ["鶏", "鳥", "チキン", "ささみ", "手羽", "chicken"],
+        "exclude": [],
+    },
+    "other_meat": {
+        "terms": ["ひき肉", "挽き肉", "合いびき", "ラム", "羊", "肉", "meat", "lamb"],
+        "exclude": ["肉球"],
+    },
+    "honey": {
+        "terms": ["はちみつ", "蜂蜜", "ハチミツ", "honey"],
+        "exclude": [],
+    },
+    "gelatin": {
+        "terms": ["ゼラチン", "gelatin"],
+        "exclude": [],
+    },
+}
+
+# Groups of classes a single user term or diet can stand for
+ALLERGEN_GROUPS = {
+    "meat": ["pork", "beef", "chicken", "other_meat"],
+    "seafood": ["fish", "shellfish", "mollusc"],
+    "nuts": ["peanut", "tree_nut"],
+    "gluten": ["wheat"],
+}
+
+DIET_EXCLUSIONS = {
+    "Vegetarian": ["pork", "beef", "chicken", "other_meat", "fish", "shellfish", "mollusc", "gelatin"],
+    "Vegan": ["pork", "beef", "chicken", "other_meat", "fish", "shellfish", "mollusc", "gelatin",
+              "egg", "dairy", "honey"],
+}
+
+# What users type in the sidebar mapped to classes or groups
+ALLERGY_ALIASES = {
+    "eggs": "egg", "卵": "egg", "たまご": "egg",
+    "milk": "dairy", "lactose": "dairy", "乳": "dairy", "乳製品": "dairy", "牛乳": "dairy",
+    "小麦": "wheat", "gluten free": "gluten",
+    "そば": "buckwheat",
+    "peanuts": "peanut", "落花生": "peanut", "ピーナッツ": "peanut",
+    "nut": "nuts", "tree nuts": "tree_nut", "ナッツ": "nuts",
+    "ごま": "sesame",
+    "soya": "soy", "soybean": "soy", "大豆": "soy",
+    "shrimp": "shellfish", "prawn": "shellfish", "crab": "shellfish", "えび": "shellfish", "かに": "shellfish",
+    "甲殻類": "shellfish",
+    "squid": "mollusc", "octopus": "mollusc", "shell": "mollusc",
+    "魚": "fish", "魚介": "seafood", "fish": "fish",
+    "肉": "meat",
+}
+
+MEASURE_PATTERN = re.compile(r"[0-9０-９]|少々|適量|適宜|大さじ|小さじ|ひとつまみ|お好み|各")
+BRAND_PATTERN = re.compile(r"^(くらしにベルク|ベルク|明治|キユーピー|カゴメ|日清|キッコーマン|クラフト|フィラデルフィア|サラダクラブ)\s*")
+
+
+def canonical_ingredient(name):
+    """Reduce a raw ingredient line like '【A】たまねぎ1/2個' to 'たまねぎ'"""
+    name = normalize_text(name)
+    name = re.sub(r"【.*?】|\[.*?\]|\(.*?\)|（.*?）", "", name)
+    name = BRAND_PATTERN.sub("", name)
+    name = MEASURE_PATTERN.split(name, 1)[0]
+    name = re.sub(r"[中小大]$", "", name.strip())
+    return name.strip(" ・:：、,")
+
+
+def ingredient_key(name):
+    """canonical_ingredient with katakana folded to hiragana, so 'タマネギ' and 'たまねぎ' share a key"""
+    return katakana_to_hiragana(canonical_ingredient(name))
+
+
+def ingredient_classes(name):
+    """Return the allergen classes a single ingredient belongs to"""
+    text = normalize_text(name)
+    classes = set()
+    for class_name, spec in ALLERGEN_CLASSES.items():
+        masked = text
+        for term in spec["exclude"]:
+            masked = masked.replace(term.lower(), " ")
+        if any(term.lower() in masked for term in spec["terms"]):
+            classes.add(class_name)
+    return classes
+
+
+def build_indexes(recipe_list):
+    """Build canonical ingredient -> recipe ids and allergen class -> recipe ids postings"""
+    ingredient_index = {}
+    allergen_index = {class_name: set() for class_name in ALLERGEN_CLASSES}
+    for recipe_id, recipe in enumerate(recipe_list):
+        for ingredient in recipe.get("ingredients", []):
+            raw_name = ingredient.get("name", "") if isinstance(ingredient, dict) else str(ingredient)
+            key = ingredient_key(raw_name)
+            if key:
+                ingredient_index.setdefault(key, set()).add(recipe_id)
+            for class_name in ingredient_classes(raw_name):
+                allergen_index[class_name].add(recipe_id)
+    return ingredient_index, allergen_index
+
+
+# Prebuilt by python -m Agent.index_build when they match the loaded corpus
+if "allergen_index" in prebuilt:
+    ingredient_index, allergen_index = prebuilt["ingredient_index"], prebuilt["allergen_index"]
+else:
+    ingredient_index, allergen_index = build_indexes(recipes)
+
+
+def resolve_allergy_classes(term):
+    """Map a user allergy term to allergen classes, empty if it is a plain ingredient"""
+    key = normalize_text(term)
+    key = ALLERGY_ALIASES.get(key, key)
+    if key.endswith("s") and key[:-1] in ALLERGEN_CLASSES:
+        key = key[:-1]
+    if key in ALLERGEN_GROUPS:
+        return set(ALLERGEN_GROUPS[key])
+    if key in ALLERGEN_CLASSES:
+        return {key}
+    return set()
+
+
+def recipes_with_ingredient(term):
+    """Recipe ids whose canonical ingredients contain the given term"""
+    key = ingredient_key(term) or normalize_kana(term)
+    matches = set()
+    for indexed_key, recipe_ids in ingredient_index.items():
+        if key in indexed_key:
+            matches |= recipe_ids
+    return matches
+
+
+def excluded_recipe_ids(allergies=None, diet=None):
+    excluded = set()
+    for term in allergies or []:
+        if not term or not term.strip():
+            continue
+        classes = resolve_allergy_classes(term)
+        if classes:
+            for class_name in classes:
+                excluded |= allergen_index[class_name]
+        else:
+            excluded |= recipes_with_ingredient(term)
+    for class_name in DIET_EXCLUSIONS.get(diet, []):
+        excluded |= allergen_index[class_name]
+    return excluded
+
+
+def allowed_recipe_ids(allergies=None, diet=None):
+    """Recipe ids that are safe for the given allergies and diet"""
+    return all_recipe_ids() - excluded_recipe_ids(allergies, diet)
+
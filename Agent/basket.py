@@ -0,0 +1,125 @@
+# basket.py
+#
+# Cheapest sufficient basket for one or more catalog recipes. The needed amount of every
+# ingredient comes from the shopping list merge; each matching product is priced as the
+# number of packages that cover that amount times its price with tax, and the cheapest
+# candidate is picked per ingredient. All candidates are scored at once as ingredient x
+# product arrays.
+
+import numpy as np
+from Agent.allergens import normalize_text
+from Agent.cart import add_item_to_cart, parse_price
+from Agent.product import format_matches, match_scores, product_display_names
+from Agent.shopping import COUNT_UNITS, UNIT_FACTORS, format_amounts, merge_ingredients
+from tracing import traced
+from Database.database import search_products
+
+MATCH_THRESHOLD = 85
+# A bare number in a recipe ('卵 2') counts pieces
+DEFAULT_COUNT_UNIT = "個"
+
+
+def product_package(row):
+    """(amount per package, unit it is summed in) of a product row, amount NaN if unknown"""
+    unit = normalize_text(str(row[6] or ""))
+    try:
+        weight = float(row[5])
+    except (TypeError, ValueError):
+        return np.nan, unit
+    if unit in UNIT_FACTORS:
+        unit, factor = UNIT_FACTORS[unit]
+        return weight * factor, unit
+    return weight, unit
+
+
+def product_arrays(products_db, units):
+    """Package size, unit index (-1 when no recipe uses it), price with tax and stock per product"""
+    sizes = np.empty(len(products_db))
+    unit_codes = np.full(len(products_db), -1, dtype=np.int64)
+    prices = np.empty(len(products_db))
+    stock = np.empty(len(products_db))
+    for index, row in enumerate(products_db):
+        sizes[index], unit = product_package(row)
+        unit_codes[index] = units.get(unit, -1)
+        prices[index] = parse_price(str(row[1])) or parse_price(str(row[2]))
+        stock[index] = row[3] if row[3] is not None else np.inf
+    return sizes, unit_codes, prices, stock
+
+
+def need_matrix(merged, units):
+    """ingredients x units needed amounts, NaN where the recipes give none in that unit"""
+    need = np.full((len(merged), len(units) + 1), np.nan)
+    for row, item in enumerate(merged.values()):
+        for unit, total in item["amounts"].items():
+            code = units[unit or DEFAULT_COUNT_UNIT]
+            need[row, code] = total if np.isnan(need[row, code]) else need[row, code] + total
+    return need
+
+
+@traced("basket.optimize")
+def cheapest_basket(recipe_ids, language, is_vegan=None, servings=None, products_db=None,
+                    threshold=MATCH_THRESHOLD):
+    """Cheapest product and package count per ingredient that covers the recipes' amounts
+
+    Products sold in the unit of the amount are preferred; when none matches ('適量', or
+    pieces against a product sold by weight) one package is assumed to cover it. Returns {"items": [...],
+    "total": price with tax, "missing": ingredients without a product in stock}.
+    """
+    merged = merge_ingredients(recipe_ids, servings)
+    if products_db is None:
+        products_db = search_products(is_vegan=is_vegan)
+    products_db = [list(p) for p in products_db]
+    names = list(merged)
+    if not names or not products_db:
+        return {"items": [], "total": 0, "missing": names}
+
+    known_units = {unit or DEFAULT_COUNT_UNIT for item in merged.values() for unit in item["amounts"]}
+    known_units.update(unit for unit, _ in UNIT_FACTORS.values())
+    known_units.update(COUNT_UNITS)
+    units = {unit: code for code, unit in enumerate(sorted(known_units))}
+    sizes, unit_codes, prices, stock = product_arrays(products_db, units)
+
+    # The last column of need is all NaN, products in a unit no recipe uses land there
+    need = need_matrix(merged, units)[:, unit_codes]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        packages = np.where(np.isnan(need) | np.isnan(sizes) | (sizes <= 0), 1, np.ceil(need / sizes))
+    packages = np.maximum(packages, 1)
+
+    scores = match_scores(names, products_db)
+    eligible = (scores >= threshold) & (packages <= stock) & (prices > 0)
+    # A product whose package size can be compared with the amount beats one that cannot
+    comparable = ~np.isnan(need) & ~np.isnan(sizes)
+    eligible &= comparable | ~(eligible & comparable).any(axis=1)[:, None]
+    costs = np.where(eligible, packages * prices, np.inf)
+    # Equal cost goes to the closer name match
+    cheapest = costs.min(axis=1)
+    best = np.where(costs == cheapest[:, None], scores, -1).argmax(axis=1)
+    found = np.isfinite(cheapest)
+
+    chosen = [products_db[index] for index in best[found]]
+    products = iter(format_matches(chosen, product_display_names(chosen, language)))
+    items, missing = [], []
+    for row, name in enumerate(names):
+        if not found[row]:
+            missing.append(name)
+            continue
+        index = best[row]
+        items.append({
+            "ingredient": name,
+            "amount": format_amounts(merged[name]),
+            "product": next(products),
+            "packages": int(packages[row, index]),
+            "cost": round(float(costs[row, index]), 2),
+            # False when the amount could not be compared with the package size
+            "covers_amount": bool(comparable[row, index]),
+        })
+    return {"items": items, "total": round(sum(item["cost"] for item in items), 2), "missing": missing}
+
+
+def fill_cart(basket, cart_items=None, cart_id=None):
+    """Add every item of a basket to the cart with its package count, returns the ingredients not in stock"""
+    unavailable = []
+    for item in basket["items"]:
+        if not add_item_to_cart(item["product"], item["packages"], cart_items, cart_id):
+            unavailable.append(item["ingredient"])
+    return unavailable
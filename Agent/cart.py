@@ -1,5 +1,6 @@
 import streamlit as st
 import re
+from Agent.reservations import reserve
 
 
 def parse_price(price_str):
@@ -11,8 +12,17 @@ def parse_price(price_str):
     return 0.0
 
 
-def add_item_to_cart(product, quantity):
-    existing = next((item for item in st.session_state.cart_items 
+def add_item_to_cart(product, quantity, cart_items=None, cart_id=None):
+    """Add to the cart, with a cart_id the stock is held first; False if it is not available
+
+    A ReservationError from the hold is passed on, the stock could not be checked.
+    """
+    # Without an explicit cart the Streamlit session's cart is used
+    if cart_items is None:
+        cart_items = st.session_state.cart_items
+    if cart_id is not None and not reserve(cart_id, product.get("Catalog_name", product["Product_name"]), quantity):
+        return False
+    existing = next((item for item in cart_items
                      if item['Product_name'] == product["Product_name"]), None)
 
     price = parse_price(product["Price"])
@@ -29,8 +39,9 @@ def add_item_to_cart(product, quantity):
         existing["Total_Price_with_Tax"] = existing["Quantity"] * price_with_tax
     else:
 
-        st.session_state.cart_items.append({
+        cart_items.append({
             "Product_name": product["Product_name"],
+            "Catalog_name": product.get("Catalog_name", product["Product_name"]),
             "Price": price,
             "Price_with_Tax": price_with_tax,
             "Weight": product["Weight"],
@@ -38,14 +49,17 @@ def add_item_to_cart(product, quantity):
             "Total_price": price * quantity,
             "Total_Price_with_Tax": price_with_tax * quantity
         })
+    return True
 
         
-def display_cart_summary():
+def display_cart_summary(cart_items=None):
+    if cart_items is None:
+        cart_items = st.session_state.cart_items
     total_base = 0
     total_with_tax = 0
     lines = []
 
-    for item in st.session_state.cart_items:
+    for item in cart_items:
 
         item_total_base = item['Total_price']
         item_total_with_tax = item['Total_Price_with_Tax']
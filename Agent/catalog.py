@@ -0,0 +1,167 @@
+# catalog.py
+
+import os
+import pickle
+import re
+import numpy as np
+from rapidfuzz import fuzz, process
+from Agent.ingest import RECIPE_STORE, iter_json_records
+from Agent.text import normalize_kana
+
+# Derived indexes written by python -m Agent.index_build
+INDEX_FILE = os.getenv("RECIPE_INDEX_FILE", "recipe_data/indexes.pkl")
+# The index build loads the corpus itself, shard by shard
+CATALOG_AUTOLOAD = os.getenv("RECIPE_CATALOG_AUTOLOAD", "1") == "1"
+# Titles sharing the most bigrams with a query that are scored by the fuzzy matcher
+TITLE_CANDIDATES = 200
+# Bumped whenever title or ingredient normalization changes, older index files are rebuilt
+INDEX_VERSION = 2
+
+
+def default_corpus_path():
+    """The ingested store (python -m Agent.ingest) when present, the raw scrape otherwise"""
+    return RECIPE_STORE if os.path.exists(RECIPE_STORE) else "recipe_data/all_recipes.json"
+
+
+# Load the recipe corpus once so every module shares the same records and ids
+def load_recipe_data(json_path=None):
+    if json_path is None:
+        json_path = default_corpus_path()
+    try:
+        return list(iter_json_records(json_path))
+    except Exception as e:
+        print(f"Error loading recipe data: {e}")
+        return []
+
+
+def is_valid_recipe(recipe):
+    """Scrape failures carry `error`/`status` instead of recipe content"""
+    return bool(recipe.get('title')) and 'error' not in recipe
+
+
+def normalize_title(title):
+    """Width, case and kana folded title without spaces, 'タマネギ スープ' and 'たまねぎスープ' match"""
+    return re.sub(r"\s+", "", normalize_kana(title))
+
+
+def title_bigrams(normalized):
+    if len(normalized) < 2:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + 2] for i in range(len(normalized) - 1)}
+
+
+def corpus_fingerprint(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_prebuilt(fingerprint, count):
+    """The prebuilt indexes if they were built from this exact corpus file, otherwise empty"""
+    if not os.path.exists(INDEX_FILE):
+        return {}
+    try:
+        with open(INDEX_FILE, "rb") as f:
+            data = pickle.load(f)
+    except Exception as e:
+        print(f"Error loading prebuilt indexes: {e}")
+        return {}
+    if (data.get("version") != INDEX_VERSION or data.get("fingerprint") != fingerprint
+            or data.get("count") != count):
+        print("Prebuilt indexes are stale, rebuilding them in process")
+        return {}
+    return data
+
+
+# Recipe ids are positions in this list, so derived indexes can be plain arrays
+recipes = []
+recipe_ids_by_title = {}
+recipe_ids_by_normalized_title = {}
+normalized_titles = []
+# Indexes from python -m Agent.index_build, empty when they have to be built at import
+prebuilt = {}
+
+
+def load_catalog(recipe_list, source=None):
+    """Replace the catalog contents in place, so modules holding references see the new data
+
+    `source` is the corpus file the records came from, prebuilt indexes are only used
+    when they were built from that same file.
+    """
+    recipes[:] = [recipe for recipe in recipe_list if is_valid_recipe(recipe)]
+    prebuilt.clear()
+    if source is not None:
+        prebuilt.update(load_prebuilt(corpus_fingerprint(source), len(recipes)))
+    recipe_ids_by_title.clear()
+    recipe_ids_by_normalized_title.clear()
+    if prebuilt:
+        recipe_ids_by_title.update(prebuilt["recipe_ids_by_title"])
+        recipe_ids_by_normalized_title.update(prebuilt["recipe_ids_by_normalized_title"])
+    else:
+        for recipe_id, recipe in enumerate(recipes):
+            recipe_ids_by_title.setdefault(recipe['title'].strip(), recipe_id)
+            recipe_ids_by_normalized_title.setdefault(normalize_title(recipe['title']), recipe_id)
+    normalized_titles[:] = list(recipe_ids_by_normalized_title)
+
+
+if CATALOG_AUTOLOAD:
+    corpus_path = default_corpus_path()
+    load_catalog(load_recipe_data(corpus_path), source=corpus_path if os.path.exists(corpus_path) else None)
+
+
+def get_recipe(recipe_id):
+    if 0 <= recipe_id < len(recipes):
+        return recipes[recipe_id]
+    return None
+
+
+def find_recipe_id(title):
+    return recipe_ids_by_title.get(title.strip())
+
+
+def all_recipe_ids():
+    return set(range(len(recipes)))
+
+
+def resolve_title(text, threshold=85):
+    """Map a suggested title to a catalog recipe id locally, None if nothing is close enough"""
+    if not text:
+        return None
+    recipe_id = find_recipe_id(text)
+    if recipe_id is not None:
+        return recipe_id
+
+    # Strip list markers and the "(English name)" suffix the supervisor adds
+    cleaned = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", text)
+    candidates = [cleaned, re.sub(r"\s*\([^()]*\)\s*$", "", cleaned), re.sub(r"\s*\(.*?\)", "", cleaned)]
+    for candidate in candidates:
+        recipe_id = recipe_ids_by_normalized_title.get(normalize_title(candidate))
+        if recipe_id is not None:
+            return recipe_id
+
+    query = normalize_title(candidates[1])
+    candidate_ids = title_candidates(query)
+    if candidate_ids is None:
+        best_match = process.extractOne(query, normalized_titles, scorer=fuzz.ratio)
+        if best_match and best_match[1] >= threshold:
+            return recipe_ids_by_normalized_title[best_match[0]]
+        return None
+
+    choices = {recipe_id: normalize_title(recipes[recipe_id]['title']) for recipe_id in candidate_ids}
+    best_match = process.extractOne(query, choices, scorer=fuzz.ratio)
+    if best_match and best_match[1] >= threshold:
+        return best_match[2]
+    return None
+
+
+def title_candidates(query, limit=TITLE_CANDIDATES):
+    """Recipe ids sharing the most title bigrams with the query, None without prebuilt postings"""
+    postings = prebuilt.get("title_postings")
+    if postings is None:
+        return None
+    matches = [postings[gram] for gram in title_bigrams(query) if gram in postings]
+    if not matches:
+        return []
+    recipe_ids, counts = np.unique(np.concatenate(matches), return_counts=True)
+    if len(recipe_ids) > limit:
+        recipe_ids = recipe_ids[np.argpartition(-counts, limit)[:limit]]
+    return recipe_ids.tolist()
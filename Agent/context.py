@@ -0,0 +1,101 @@
+# context.py
+
+import re
+
+# Token budget for the conversation history each agent gets on top of its prompt
+CONTEXT_BUDGETS = {
+    "supervisor": 800,
+    "recipe": 0,
+}
+
+# Share of the budget the summary of dropped turns may use
+SUMMARY_SHARE = 0.25
+SUMMARY_LINE_CHARS = 80
+
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12,
+}
+
+SERVINGS_PATTERNS = [
+    re.compile(r"(\d+|" + "|".join(NUMBER_WORDS) + r")\s*(?:people|persons|person|servings|serving|portions|guests|pax)", re.IGNORECASE),
+    re.compile(r"(?:serves|feed|feeds|for)\s+(\d+|" + "|".join(NUMBER_WORDS) + r")\b"
+               r"(?!\s*(?:min|hour|hr|day|week|yen|円|分|g\b|kg|ml|cal|kcal))", re.IGNORECASE),
+    re.compile(r"([0-9０-９]+)\s*(?:人前|人分|人)(?!気)"),
+]
+
+
+def count_tokens(text):
+    """Estimate the token count of a text without a tokenizer
+
+    CJK characters are close to one token each, other text averages about four
+    characters per token for the OpenAI tokenizers.
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for char in text if ord(char) >= 0x3000)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def summarize_turn(message):
+    """One short line standing in for a turn that no longer fits the budget"""
+    content = message["content"]
+    if message["role"] == "assistant" and "RECIPE SUGGESTIONS:" in content:
+        suggestions = content.split("RECIPE SUGGESTIONS:", 1)[1]
+        titles = [line.strip(" -") for line in suggestions.splitlines() if line.strip(" -")]
+        line = "Suggested: " + ", ".join(titles)
+    else:
+        line = ("User asked: " if message["role"] == "user" else "Assistant said: ") + " ".join(content.split())
+    if len(line) > SUMMARY_LINE_CHARS:
+        line = line[:SUMMARY_LINE_CHARS - 3] + "..."
+    return line
+
+
+def build_context_messages(history, prompt, agent_name="supervisor"):
+    """Messages for an agent run: as many recent turns as fit the agent's budget,
+    a short summary of older turns if there is room, then the prompt"""
+    budget = CONTEXT_BUDGETS.get(agent_name, 0)
+    kept = []
+    used = 0
+    index = len(history)
+    while index > 0:
+        message = history[index - 1]
+        tokens = count_tokens(message["content"])
+        if used + tokens > budget * (1 - SUMMARY_SHARE):
+            break
+        kept.insert(0, {"role": message["role"], "content": message["content"]})
+        used += tokens
+        index -= 1
+
+    # Older turns are summarized newest first until the summary share is used up
+    summary_lines = []
+    summary_budget = budget - used
+    for message in reversed(history[:index]):
+        line = summarize_turn(message)
+        tokens = count_tokens(line)
+        if tokens > summary_budget:
+            break
+        summary_lines.insert(0, line)
+        summary_budget -= tokens
+
+    messages = []
+    if summary_lines:
+        messages.append({"role": "user", "content": "Earlier in this conversation:\n" + "\n".join(summary_lines)})
+    messages.extend(kept)
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def extract_requested_servings(history):
+    """The number of servings the user asked for most recently, None if never mentioned"""
+    for message in reversed(history):
+        if message["role"] != "user":
+            continue
+        for pattern in SERVINGS_PATTERNS:
+            match = pattern.search(message["content"])
+            if match:
+                value = match.group(1).lower()
+                if value in NUMBER_WORDS:
+                    return NUMBER_WORDS[value]
+                return int(value.translate(str.maketrans("０１２３４５６７８９", "0123456789")))
+    return None
@@ -0,0 +1,112 @@
+# facets.py
+
+import numpy as np
+from Agent.catalog import prebuilt, recipes
+
+MINUTES_PER_UNIT = {"分": 1, "時間": 60, "日": 60 * 24}
+
+# Sidebar preference labels mapped to half-open ranges [low, high) on the facet
+COOKING_TIME_BUCKETS = {
+    "Quick (< 30 min)": (0, 30),
+    "Medium (30-60 min)": (30, 61),
+    "Long (> 60 min)": (61, np.inf),
+}
+
+COST_BUCKETS = {
+    "< 300 円": (0, 300),
+    "300-600 円": (300, 600),
+    "> 600 円": (600, np.inf),
+}
+
+RATING_BUCKETS = {
+    "4.5+": (4.5, np.inf),
+    "4.0-4.5": (4.0, 4.5),
+    "< 4.0": (0, 4.0),
+}
+
+SERVINGS_BUCKETS = {
+    "1-2": (0, 3),
+    "3-4": (3, 5),
+    "5+": (5, np.inf),
+}
+
+
+def cooking_minutes(recipe):
+    cooking_time = recipe.get("cooking_time") or {}
+    value = cooking_time.get("value")
+    if value is None:
+        return np.nan
+    return float(value) * MINUTES_PER_UNIT.get(cooking_time.get("unit"), 1)
+
+
+def cost_value(recipe):
+    value = (recipe.get("cost_estimate") or {}).get("value")
+    return np.nan if value is None else float(value)
+
+
+def rating_value(recipe):
+    value = (recipe.get("rating") or {}).get("average")
+    return np.nan if value is None else float(value)
+
+
+def servings_value(recipe):
+    servings = recipe.get("servings") or {}
+    if servings.get("value") is not None:
+        return float(servings["value"])
+    if servings.get("min") is not None and servings.get("max") is not None:
+        return (float(servings["min"]) + float(servings["max"])) / 2
+    return np.nan
+
+
+FACET_FIELDS = {
+    "cooking_time": (cooking_minutes, COOKING_TIME_BUCKETS),
+    "cost": (cost_value, COST_BUCKETS),
+    "rating": (rating_value, RATING_BUCKETS),
+    "servings": (servings_value, SERVINGS_BUCKETS),
+}
+
+
+def build_facets(recipe_list):
+    """One float array per facet indexed by recipe id, NaN where the field is missing"""
+    return {
+        field: np.fromiter((extract(recipe) for recipe in recipe_list), dtype=np.float64, count=len(recipe_list))
+        for field, (extract, _) in FACET_FIELDS.items()
+    }
+
+
+facets = prebuilt["facets"] if "facets" in prebuilt else build_facets(recipes)
+
+
+def range_mask(field, low=None, high=None):
+    """Boolean mask of recipes with low <= value < high, missing values never match"""
+    values = facets[field]
+    mask = ~np.isnan(values)
+    if low is not None:
+        mask &= values >= low
+    if high is not None:
+        mask &= values < high
+    return mask
+
+
+def range_filter(field, low=None, high=None):
+    return set(np.flatnonzero(range_mask(field, low, high)).tolist())
+
+
+def bucket_filter(field, bucket):
+    """Recipe ids in a named bucket, None if the bucket means no preference"""
+    buckets = FACET_FIELDS[field][1]
+    if bucket not in buckets:
+        return None
+    low, high = buckets[bucket]
+    return range_filter(field, low, high)
+
+
+def bucket_counts(field, recipe_ids=None):
+    """Number of recipes per bucket, optionally within a candidate set"""
+    values = facets[field]
+    if recipe_ids is not None:
+        values = values[np.fromiter(recipe_ids, dtype=np.int64, count=len(recipe_ids))]
+    counts = {}
+    for bucket, (low, high) in FACET_FIELDS[field][1].items():
+        counts[bucket] = int(np.count_nonzero((values >= low) & (values < high)))
+    return counts
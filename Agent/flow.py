@@ -0,0 +1,199 @@
+# flow.py
+#
+# Shared flow control for OpenAI calls from every session of a worker. Identical requests
+# in flight at the same time are coalesced into one upstream call, the number of
+# concurrent calls adapts to rate limits (additive increase, multiplicative decrease)
+# and, mildly, to latency, and transient failures are retried with jittered backoff.
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from agno.exceptions import ModelProviderError
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from tracing import register_metrics
+
+FLOW_CONTROL_ENABLED = os.getenv("LLM_FLOW_CONTROL", "1") == "1"
+INITIAL_CONCURRENCY = int(os.getenv("LLM_INITIAL_CONCURRENCY", "8"))
+MIN_CONCURRENCY = int(os.getenv("LLM_MIN_CONCURRENCY", "2"))
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+# A call slower than this many times the usual latency of its kind counts as congestion
+LATENCY_TOLERANCE = float(os.getenv("LLM_LATENCY_TOLERANCE", "3.0"))
+RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "4"))
+RETRY_MAX_WAIT = float(os.getenv("LLM_RETRY_MAX_WAIT", "20"))
+# Weight of the latest call in the moving average of the usual latency
+BASELINE_WEIGHT = 0.1
+
+counters = {"upstream": 0, "coalesced": 0, "rate_limited": 0}
+# Retries by the name of the error that caused them
+retries = {}
+
+
+def upstream_error(error):
+    """The OpenAI exception behind an error, agno wraps them in ModelProviderError"""
+    if isinstance(error, ModelProviderError) and error.__cause__ is not None:
+        return error.__cause__
+    return error
+
+
+def is_rate_limited(error):
+    return isinstance(upstream_error(error), RateLimitError)
+
+
+def is_retryable(error):
+    # A missing cassette entry or a bad request is also a ModelProviderError, only
+    # rate limits, connection errors and server errors are worth another attempt
+    return isinstance(upstream_error(error), (RateLimitError, APIConnectionError, InternalServerError))
+
+
+class AdaptiveLimiter:
+    """Concurrency limit for upstream calls that grows by one per window of calls and halves
+    on a rate limit
+
+    Latency is only a mild signal: a call much slower than the usual latency of its kind
+    (model, response format, streaming) takes back as much as a normal call adds.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY,
+                 tolerance=LATENCY_TOLERANCE):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.in_flight = 0
+        # Moving average latency per kind of call, time to first token for streams
+        self.baselines = {}
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        # Polling keeps the event loop free without parking a thread per waiting call
+        delay = 0.005
+        while not self.try_acquire():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def release(self, kind=None, latency=None, rate_limited=False):
+        with self.condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif latency is not None:
+                baseline = self.baselines.get(kind, latency)
+                if latency > baseline * self.tolerance:
+                    self.limit = max(self.minimum, self.limit - 1 / self.limit)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.baselines[kind] = baseline + (latency - baseline) * BASELINE_WEIGHT
+            self.condition.notify_all()
+
+
+class SingleFlight:
+    """Registry of in-flight calls by request key, later identical calls wait for the first"""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def join(self, key):
+        """(future, True) for the caller that should make the call, (future, False) for the others"""
+        with self.lock:
+            future = self.flights.get(key)
+            if future is not None:
+                count("coalesced")
+                return future, False
+            future = self.flights[key] = Future()
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        with self.lock:
+            self.flights.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+limiter = AdaptiveLimiter()
+single_flight = SingleFlight()
+
+
+def count(name):
+    """Increment one of the counters, calls from every session thread share them"""
+    with limiter.condition:
+        counters[name] += 1
+
+
+def record_attempt(retry_state):
+    error = type(upstream_error(retry_state.outcome.exception())).__name__
+    with limiter.condition:
+        retries[error] = retries.get(error, 0) + 1
+
+
+def retry_policy():
+    return dict(
+        stop=stop_after_attempt(RETRY_ATTEMPTS),
+        wait=wait_random_exponential(multiplier=0.5, max=RETRY_MAX_WAIT),
+        retry=retry_if_exception(is_retryable),
+        before_sleep=record_attempt,
+        reraise=True,
+    )
+
+
+def retrying():
+    return Retrying(**retry_policy())
+
+
+def aretrying():
+    return AsyncRetrying(**retry_policy())
+
+
+def release_after(kind, latency=None, error=None):
+    """Give the limiter slot back with what the call taught about the upstream"""
+    if error is not None:
+        rate_limited = is_rate_limited(error)
+        if rate_limited:
+            count("rate_limited")
+        limiter.release(kind, rate_limited=rate_limited)
+    else:
+        limiter.release(kind, latency=latency)
+
+
+@register_metrics
+def render_flow_metrics():
+    with limiter.condition:
+        current, retried = dict(counters), dict(retries)
+        in_flight, limit = limiter.in_flight, int(limiter.limit)
+    lines = [
+        "# HELP recipe_llm_calls_total OpenAI calls by how they were served.",
+        "# TYPE recipe_llm_calls_total counter",
+        f'recipe_llm_calls_total{{outcome="upstream"}} {current["upstream"]}',
+        f'recipe_llm_calls_total{{outcome="coalesced"}} {current["coalesced"]}',
+        "# HELP recipe_llm_retries_total OpenAI calls retried after a transient error, by error.",
+        "# TYPE recipe_llm_retries_total counter",
+    ]
+    for error, total in sorted(retried.items()):
+        lines.append(f'recipe_llm_retries_total{{error="{error}"}} {total}')
+    lines += [
+        "# HELP recipe_llm_rate_limited_total OpenAI calls answered with a rate limit.",
+        "# TYPE recipe_llm_rate_limited_total counter",
+        f"recipe_llm_rate_limited_total {current['rate_limited']}",
+        "# HELP recipe_llm_concurrency OpenAI calls in flight and the current adaptive limit.",
+        "# TYPE recipe_llm_concurrency gauge",
+        f'recipe_llm_concurrency{{kind="in_flight"}} {in_flight}',
+        f'recipe_llm_concurrency{{kind="limit"}} {limit}',
+    ]
+    return lines
@@ -0,0 +1,140 @@
+# index_build.py
+#
+# Parallel build of the indexes derived from the recipe corpus: title lookups, canonical
+# ingredient and allergen postings, facet and nutrient arrays and title bigram postings.
+# The corpus is streamed in shards to a process pool and the partial results are merged
+# by recipe id.
+# The app loads the result at import instead of deriving everything serially.
+#
+#   python -m Agent.index_build --workers 8
+
+import os
+
+# Neither this process nor the workers need the whole corpus loaded at import
+os.environ["RECIPE_CATALOG_AUTOLOAD"] = "0"
+
+import argparse
+import pickle
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Agent.allergens import ALLERGEN_CLASSES, build_indexes
+from Agent.catalog import (INDEX_FILE, INDEX_VERSION, corpus_fingerprint, default_corpus_path, is_valid_recipe,
+                           normalize_title, title_bigrams)
+from Agent.facets import FACET_FIELDS, build_facets
+from Agent.ingest import iter_json_records
+from Agent.nutrition import NUTRIENTS, build_nutrient_matrix
+
+SHARD_SIZE = 5000
+
+
+def iter_shards(path, shard_size=SHARD_SIZE):
+    """(first recipe id, records) batches of the valid recipes, ids match Agent.catalog"""
+    shard = []
+    offset = 0
+    for record in iter_json_records(path):
+        if not is_valid_recipe(record):
+            continue
+        shard.append(record)
+        if len(shard) == shard_size:
+            yield offset, shard
+            offset += len(shard)
+            shard = []
+    if shard:
+        yield offset, shard
+
+
+def build_shard(offset, shard):
+    """Everything derived from one shard, with recipe ids already shifted to catalog ids"""
+    ingredient_index, allergen_index = build_indexes(shard)
+    titles = [recipe['title'].strip() for recipe in shard]
+    normalized = [normalize_title(recipe['title']) for recipe in shard]
+    title_postings = {}
+    for recipe_id, title in enumerate(normalized, start=offset):
+        for gram in title_bigrams(title):
+            title_postings.setdefault(gram, []).append(recipe_id)
+    return {
+        "offset": offset,
+        "titles": titles,
+        "normalized_titles": normalized,
+        "ingredient_index": {name: [recipe_id + offset for recipe_id in ids] for name, ids in ingredient_index.items()},
+        "allergen_index": {name: [recipe_id + offset for recipe_id in ids] for name, ids in allergen_index.items()},
+        "facets": build_facets(shard),
+        "nutrients": build_nutrient_matrix(shard),
+        "title_postings": title_postings,
+    }
+
+
+def merge_shards(parts):
+    """Combine shard results in recipe id order into the structures the app modules use"""
+    parts = sorted(parts, key=lambda part: part["offset"])
+    recipe_ids_by_title = {}
+    recipe_ids_by_normalized_title = {}
+    ingredient_index = {}
+    allergen_index = {class_name: set() for class_name in ALLERGEN_CLASSES}
+    title_postings = {}
+    for part in parts:
+        for recipe_id, (title, normalized) in enumerate(zip(part["titles"], part["normalized_titles"]),
+                                                        start=part["offset"]):
+            recipe_ids_by_title.setdefault(title, recipe_id)
+            recipe_ids_by_normalized_title.setdefault(normalized, recipe_id)
+        for name, ids in part["ingredient_index"].items():
+            ingredient_index.setdefault(name, set()).update(ids)
+        for name, ids in part["allergen_index"].items():
+            allergen_index[name].update(ids)
+        for gram, ids in part["title_postings"].items():
+            title_postings.setdefault(gram, []).extend(ids)
+    return {
+        "count": sum(len(part["titles"]) for part in parts),
+        "recipe_ids_by_title": recipe_ids_by_title,
+        "recipe_ids_by_normalized_title": recipe_ids_by_normalized_title,
+        "ingredient_index": ingredient_index,
+        "allergen_index": allergen_index,
+        "facets": {field: np.concatenate([part["facets"][field] for part in parts]) if parts else np.empty(0)
+                   for field in FACET_FIELDS},
+        "nutrients": np.concatenate([part["nutrients"] for part in parts]) if parts else np.empty((0, len(NUTRIENTS))),
+        # Shards arrive in id order, so every postings list is already sorted
+        "title_postings": {gram: np.array(ids, dtype=np.int32) for gram, ids in title_postings.items()},
+    }
+
+
+def build_all(path, output=INDEX_FILE, workers=None, shard_size=SHARD_SIZE):
+    fingerprint = corpus_fingerprint(path)
+    workers = workers or os.cpu_count() or 1
+    parts = []
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for offset, shard in iter_shards(path, shard_size):
+            # Only a few shards are in flight, so the corpus is never held in memory at once
+            if len(pending) >= workers * 2:
+                parts.append(pending.popleft().result())
+            pending.append(pool.submit(build_shard, offset, shard))
+        parts.extend(future.result() for future in pending)
+    indexes = merge_shards(parts)
+    indexes["fingerprint"] = fingerprint
+    indexes["version"] = INDEX_VERSION
+
+    temp_path = f"{output}.tmp"
+    with open(temp_path, "wb") as f:
+        pickle.dump(indexes, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, output)
+    return indexes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the derived recipe indexes in parallel")
+    parser.add_argument("--corpus", default=None, help="recipe store or raw scrape, defaults to what the app loads")
+    parser.add_argument("--output", default=INDEX_FILE)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to one per core")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    path = args.corpus or default_corpus_path()
+    indexes = build_all(path, args.output, args.workers, args.shard_size)
+    print(f"Indexed {indexes['count']} recipes from {path} into {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# ingest.py
+#
+# Streaming ingestion of scraped recipes into the runtime store read by Agent.catalog.
+# Records are parsed one at a time from JSON arrays or JSON lines, validated and
+# normalized, scrape failures dropped and duplicates removed by final_url, then written
+# to the store as they go, so memory does not grow with the size of the input.
+#
+#   python -m Agent.ingest recipe_data/all_recipes.json scraped/*.jsonl --output recipe_data/recipes.jsonl
+
+import argparse
+import hashlib
+import json
+import os
+from collections import Counter
+from typing import Any, Dict, List, Optional, Union
+from pydantic import BaseModel, ValidationError, field_validator
+
+RECIPE_STORE = os.getenv("RECIPE_STORE", "recipe_data/recipes.jsonl")
+READ_CHUNK = 1 << 16
+
+
+class Measure(BaseModel):
+    value: Optional[Union[int, float]] = None
+    min: Optional[Union[int, float]] = None
+    max: Optional[Union[int, float]] = None
+    unit: Optional[str] = None
+    # Text the scraper could not parse into numbers, e.g. '12個分'
+    raw_text: Optional[str] = None
+
+    def is_empty(self):
+        return self.value is None and self.min is None and self.raw_text is None
+
+
+class Rating(BaseModel):
+    average: float
+    count: Optional[int] = None
+
+
+class Ingredient(BaseModel):
+    name: str
+    quantity: Optional[str] = None
+
+    @field_validator("name")
+    @classmethod
+    def strip_name(cls, value):
+        return value.strip()
+
+
+class Step(BaseModel):
+    number: Optional[int] = None
+    description: str
+    point: Optional[str] = None
+    video: Optional[Dict[str, Any]] = None
+
+
+class RecipeRecord(BaseModel):
+    url: str
+    final_url: Optional[str] = None
+    source: Optional[str] = None
+    extracted_at: Optional[str] = None
+    title: str
+    english_name: Optional[str] = None
+    description: Optional[str] = None
+    image_url: Optional[str] = None
+    video_data: Optional[Dict[str, Any]] = None
+    cooking_time: Optional[Measure] = None
+    servings: Optional[Measure] = None
+    cost_estimate: Optional[Measure] = None
+    rating: Optional[Rating] = None
+    nutrients: Optional[Dict[str, Measure]] = None
+    ingredients: List[Ingredient]
+    # Older scrapes store plain strings, newer ones numbered objects with videos; both are kept as they are
+    steps: List[Union[Step, str]]
+
+    @field_validator("title")
+    @classmethod
+    def title_not_empty(cls, value):
+        value = value.strip()
+        if not value:
+            raise ValueError("empty title")
+        return value
+
+
+def iter_json_records(path, chunk_size=READ_CHUNK):
+    """Yield the objects of a JSON array or of concatenated JSON values (JSON lines) one at a time"""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        position = 0
+        eof = False
+        while True:
+            # Skip separators between records, and the brackets of an enclosing array
+            while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                position += 1
+            if position >= len(buffer):
+                if eof:
+                    return
+                buffer = f.read(chunk_size)
+                position = 0
+                eof = not buffer
+                continue
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The record continues in the next chunk
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield record
+            position = end
+            if position > chunk_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+def is_placeholder_image(url):
+    return not url or not url.startswith(("http://", "https://")) or "logo" in url
+
+
+def normalize_recipe(raw):
+    """Validate a scraped record into a RecipeRecord, None for scrape failures"""
+    if "error" in raw or not raw.get("title"):
+        return None
+    recipe = RecipeRecord.model_validate(raw)
+    recipe.final_url = recipe.final_url or recipe.url
+    # Many pages only expose the site logo, the video poster is the better picture
+    if is_placeholder_image(recipe.image_url):
+        poster_url = (recipe.video_data or {}).get("poster_url")
+        recipe.image_url = None if is_placeholder_image(poster_url) else poster_url
+    # Missing blocks come through as nulls in the scrape
+    if recipe.servings and recipe.servings.is_empty():
+        recipe.servings = None
+    if recipe.cooking_time and recipe.cooking_time.is_empty():
+        recipe.cooking_time = None
+    recipe.ingredients = [ingredient for ingredient in recipe.ingredients if ingredient.name]
+    return recipe
+
+
+def ingest(paths, output=RECIPE_STORE):
+    """Stream every input into `output` as JSON lines, returns counts of what happened to the records"""
+    stats = Counter()
+    # Digests instead of URLs keep the dedupe set small
+    seen = set()
+    temp_path = f"{output}.tmp"
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(temp_path, "w", encoding="utf-8") as out:
+        for path in paths:
+            for raw in iter_json_records(path):
+                stats["read"] += 1
+                try:
+                    recipe = normalize_recipe(raw)
+                except ValidationError as e:
+                    stats["invalid"] += 1
+                    print(f"Invalid recipe {raw.get('url')}: {e.error_count()} errors")
+                    continue
+                if recipe is None:
+                    stats["failed_scrape"] += 1
+                    continue
+                digest = hashlib.blake2b(recipe.final_url.encode("utf-8"), digest_size=16).digest()
+                if digest in seen:
+                    stats["duplicate"] += 1
+                    continue
+                seen.add(digest)
+                out.write(recipe.model_dump_json(exclude_none=True) + "\n")
+                stats["written"] += 1
+    # Readers never see a half written store
+    os.replace(temp_path, output)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest scraped recipes into the runtime store")
+    parser.add_argument("inputs", nargs="+", help="JSON array or JSON lines files")
+    parser.add_argument("--output", default=RECIPE_STORE)
+    args = parser.parse_args()
+    stats = ingest(args.inputs, args.output)
+    print(f"Ingested into {args.output}: " + ", ".join(f"{key} {value}" for key, value in sorted(stats.items())))
+
+
+if __name__ == "__main__":
+    main()
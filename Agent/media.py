@@ -0,0 +1,170 @@
+# media.py
+#
+# Local cache of recipe images. The best image of a recipe is resolved (the page image,
+# else the video poster, else the first step poster), fetched once, resized to a
+# thumbnail and stored under the hash of its content, so the UI and the API serve
+# images from disk instead of every browser fetching them from the recipe site.
+
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from PIL import Image
+from Agent.ingest import is_placeholder_image
+from tracing import traced
+
+MEDIA_DIR = os.getenv("MEDIA_CACHE_DIR", "media_cache")
+THUMBNAIL_SIZE = (640, 640)
+JPEG_QUALITY = 85
+FETCH_TIMEOUT = 10
+# Bigger downloads are not images we want to resize on the request path
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# Decoded size limit, a small file can still expand into a huge bitmap
+MAX_IMAGE_PIXELS = 40_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+DOWNLOAD_CHUNK = 64 * 1024
+
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("MEDIA_FETCH_WORKERS", "4")),
+                              thread_name_prefix="media-fetch")
+
+
+def best_image_url(recipe):
+    """The most useful absolute image URL of a catalog recipe, None if it has none"""
+    if not recipe:
+        return None
+    if not is_placeholder_image(recipe.get("image_url")):
+        return recipe["image_url"]
+    poster_url = (recipe.get("video_data") or {}).get("poster_url")
+    if not is_placeholder_image(poster_url):
+        return poster_url
+    for step in recipe.get("steps", []):
+        if isinstance(step, dict):
+            poster_url = (step.get("video") or {}).get("poster_url")
+            if not is_placeholder_image(poster_url):
+                return poster_url
+    return None
+
+
+class MediaCache:
+    """Thumbnails on disk named by content hash, with a URL -> hash index in index.jsonl"""
+
+    def __init__(self, directory=MEDIA_DIR):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.jsonl")
+        self.index = {}
+        self.in_flight = set()
+        # URLs that failed in this process are not retried on every render
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def load_index(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            self.index[entry["url"]] = entry["hash"]
+
+    def file_name(self, digest):
+        return f"{digest}.jpg"
+
+    def path(self, url):
+        """Local path of the cached thumbnail for `url`, None if it is not cached yet"""
+        if not url:
+            return None
+        self.load_index()
+        digest = self.index.get(url)
+        if digest is None:
+            return None
+        path = os.path.join(self.directory, self.file_name(digest))
+        return path if os.path.exists(path) else None
+
+    def download(self, url):
+        """The body of `url`, read in chunks and abandoned as soon as it exceeds MAX_IMAGE_BYTES"""
+        with requests.get(url, timeout=FETCH_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > MAX_IMAGE_BYTES:
+                raise ValueError(f"Image too large: {length} bytes")
+            body = bytearray()
+            for chunk in response.iter_content(DOWNLOAD_CHUNK):
+                body += chunk
+                if len(body) > MAX_IMAGE_BYTES:
+                    raise ValueError(f"Image too large: more than {MAX_IMAGE_BYTES} bytes")
+            return bytes(body)
+
+    @traced("media.fetch")
+    def fetch(self, url):
+        """Download, resize and store one image, returns the local path"""
+        content = self.download(url)
+        # Image.open only reads the header, the pixel limit is checked before anything is decoded
+        image = Image.open(io.BytesIO(content))
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image too large: {image.width}x{image.height} pixels")
+        image.thumbnail(THUMBNAIL_SIZE)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        data = buffer.getvalue()
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.directory, self.file_name(digest))
+        os.makedirs(self.directory, exist_ok=True)
+        # Identical images under different URLs are stored once
+        if not os.path.exists(path):
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        with self.lock:
+            self.index[url] = digest
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"url": url, "hash": digest}) + "\n")
+        return path
+
+    def get(self, url):
+        """The cached thumbnail, fetching it now if needed, None if it cannot be fetched"""
+        path = self.path(url)
+        if path is not None or not url or url in self.failed:
+            return path
+        try:
+            return self.fetch(url)
+        except Exception as e:
+            print(f"Image fetch failed for {url}: {e}")
+            self.failed.add(url)
+            return None
+
+    def prefetch(self, urls):
+        """Fetch uncached images in the background, each URL at most once at a time"""
+        self.load_index()
+        for url in urls:
+            if not url or url in self.failed or self.path(url) is not None:
+                continue
+            with self.lock:
+                if url in self.in_flight:
+                    continue
+                self.in_flight.add(url)
+            executor.submit(self.prefetch_one, url)
+
+    def prefetch_one(self, url):
+        try:
+            self.get(url)
+        finally:
+            with self.lock:
+                self.in_flight.discard(url)
+
+
+media_cache = MediaCache()
+
+
+def recipe_image(recipe):
+    """(local thumbnail path or None, remote URL or None) for a catalog recipe"""
+    url = best_image_url(recipe)
+    return media_cache.path(url), url
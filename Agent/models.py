@@ -0,0 +1,414 @@
+# models.py
+#
+# Chat model factory for the agents. With LLM_MODE=record real OpenAI responses are written
+# to a JSONL cassette along with their timing, with LLM_MODE=replay they are served from the
+# cassette offline at the recorded time-to-first-token and inter-token pace.
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from agno.exceptions import ModelProviderError
+from agno.models.message import Message
+from agno.models.openai import OpenAIChat
+from openai.lib._parsing._completions import type_to_response_format_param
+from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from openai.types.chat.parsed_chat_completion import ParsedChatCompletion
+from pydantic import BaseModel
+
+from Agent import flow
+from tracing import record_span, span
+
+DEFAULT_MODEL_ID = "gpt-4o-mini"
+# "live" (default), "record" or "replay"
+LLM_MODE = os.getenv("LLM_MODE", "live")
+LLM_CASSETTE = os.getenv("LLM_CASSETTE", "recordings/openai.jsonl")
+# Replay pace relative to the recording, 2.0 replays twice as fast and 0 without any delay
+LLM_REPLAY_SPEED = float(os.getenv("LLM_REPLAY_SPEED", "1.0"))
+
+# Cassette contents by path, shared by every model instance in the process
+cassettes = {}
+cassette_lock = threading.Lock()
+
+
+def load_cassette(path):
+    with cassette_lock:
+        if path not in cassettes:
+            entries = {}
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            # The latest recording of a request wins
+                            entries[entry["key"]] = entry
+            cassettes[path] = entries
+        return cassettes[path]
+
+
+def append_to_cassette(path, entry):
+    entries = load_cassette(path)
+    with cassette_lock:
+        entries[entry["key"]] = entry
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+@dataclass
+class StructuredStreamChat(OpenAIChat):
+    """OpenAIChat that can also stream structured outputs
+
+    chat.completions.create refuses a pydantic response_format, which is what agno sets
+    for structured outputs, so a stream sends the model's strict JSON schema instead. The
+    JSON then arrives token by token and the caller parses the whole text at the end.
+    """
+
+    @contextmanager
+    def schema_response_format(self):
+        response_format = self.response_format
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            self.response_format = type_to_response_format_param(response_format)
+        try:
+            yield
+        finally:
+            self.response_format = response_format
+
+    def invoke_stream(self, messages: List[Message]) -> Iterator[ChatCompletionChunk]:
+        # The request is sent on the first chunk, only that needs the schema
+        with self.schema_response_format():
+            stream = super().invoke_stream(messages)
+            first = next(stream, None)
+        if first is not None:
+            yield first
+            yield from stream
+
+    async def ainvoke_stream(self, messages: List[Message]) -> AsyncIterator[ChatCompletionChunk]:
+        with self.schema_response_format():
+            stream = super().ainvoke_stream(messages)
+            first = await anext(stream, None)
+        if first is not None:
+            yield first
+            async for chunk in stream:
+                yield chunk
+
+
+@dataclass
+class RecordReplayChat(StructuredStreamChat):
+    """OpenAIChat that records responses to a cassette or replays them from it
+
+    Requests are keyed by the model id, the response format and the formatted messages,
+    so a replayed run must build exactly the same prompt as the recorded one. In replay
+    mode a request that was never recorded raises a ModelProviderError, nothing is sent
+    to OpenAI.
+    """
+
+    mode: str = "record"
+    cassette_path: str = LLM_CASSETTE
+    replay_speed: float = LLM_REPLAY_SPEED
+
+    def request_key(self, messages: List[Message], stream: bool) -> str:
+        response_format = self.response_format
+        if isinstance(response_format, type):
+            response_format = response_format.__name__
+        payload = {
+            "model": self.id,
+            "stream": stream,
+            "response_format": response_format,
+            "structured_outputs": self.structured_outputs,
+            "messages": [self._format_message(m) for m in messages],
+        }
+        data = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def recorded(self, key: str) -> Dict[str, Any]:
+        entry = load_cassette(self.cassette_path).get(key)
+        if entry is None:
+            raise ModelProviderError(
+                message=f"No recorded response for request {key[:12]} in {self.cassette_path}",
+                model_name=self.name,
+                model_id=self.id,
+            )
+        return entry
+
+    def delay(self, seconds: float) -> float:
+        return seconds / self.replay_speed if self.replay_speed > 0 else 0.0
+
+    def to_completion(self, data: Dict[str, Any]):
+        if self.structured_outputs and isinstance(self.response_format, type) \
+                and issubclass(self.response_format, BaseModel):
+            return ParsedChatCompletion[self.response_format].model_validate(data)
+        return ChatCompletion.model_validate(data)
+
+    def invoke(self, messages: List[Message]):
+        key = self.request_key(messages, stream=False)
+        if self.mode == "replay":
+            entry = self.recorded(key)
+            time.sleep(self.delay(entry["latency"]))
+            return self.to_completion(entry["response"])
+
+        start = time.perf_counter()
+        response = super().invoke(messages)
+        append_to_cassette(self.cassette_path, {
+            "key": key,
+            "model": self.id,
+            "latency": time.perf_counter() - start,
+            "response": response.model_dump(mode="json"),
+        })
+        return response
+
+    async def ainvoke(self, messages: List[Message]):
+        key = self.request_key(messages, stream=False)
+        if self.mode == "replay":
+            entry = self.recorded(key)
+            await asyncio.sleep(self.delay(entry["latency"]))
+            return self.to_completion(entry["response"])
+
+        start = time.perf_counter()
+        response = await super().ainvoke(messages)
+        append_to_cassette(self.cassette_path, {
+            "key": key,
+            "model": self.id,
+            "latency": time.perf_counter() - start,
+            "response": response.model_dump(mode="json"),
+        })
+        return response
+
+    def invoke_stream(self, messages: List[Message]) -> Iterator[ChatCompletionChunk]:
+        key = self.request_key(messages, stream=True)
+        if self.mode == "replay":
+            entry = self.recorded(key)
+            start = time.perf_counter()
+            for chunk in entry["chunks"]:
+                # Offsets are from the start of the request, so the first one is the time to first token
+                wait = self.delay(chunk["offset"]) - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+                yield ChatCompletionChunk.model_validate(chunk["chunk"])
+            return
+
+        chunks = []
+        start = time.perf_counter()
+        for chunk in super().invoke_stream(messages):
+            chunks.append({"offset": time.perf_counter() - start, "chunk": chunk.model_dump(mode="json")})
+            yield chunk
+        append_to_cassette(self.cassette_path, {"key": key, "model": self.id, "chunks": chunks})
+
+    async def ainvoke_stream(self, messages: List[Message]) -> AsyncIterator[ChatCompletionChunk]:
+        key = self.request_key(messages, stream=True)
+        if self.mode == "replay":
+            entry = self.recorded(key)
+            start = time.perf_counter()
+            for chunk in entry["chunks"]:
+                wait = self.delay(chunk["offset"]) - (time.perf_counter() - start)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                yield ChatCompletionChunk.model_validate(chunk["chunk"])
+            return
+
+        chunks = []
+        start = time.perf_counter()
+        async for chunk in super().ainvoke_stream(messages):
+            chunks.append({"offset": time.perf_counter() - start, "chunk": chunk.model_dump(mode="json")})
+            yield chunk
+        append_to_cassette(self.cassette_path, {"key": key, "model": self.id, "chunks": chunks})
+
+
+class FlowControlMixin:
+    """Sends requests through the shared flow control of Agent.flow
+
+    Identical non-streaming requests in flight at the same time share one upstream call
+    and its response. Every upstream attempt takes a slot of the adaptive limiter, and
+    rate limits, connection and server errors are retried with backoff; a stream is only
+    retried until its first chunk arrives.
+    """
+
+    def flight_key(self, messages: List[Message]) -> str:
+        payload = {
+            "model": self.id,
+            "request": self.request_kwargs,
+            "response_format": getattr(self.response_format, "__name__", self.response_format),
+            "structured_outputs": self.structured_outputs,
+            "messages": [self._format_message(m) for m in messages],
+        }
+        data = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def flow_kind(self, stream: bool) -> str:
+        # A recipe generation and a short supervisor answer have very different usual latencies
+        response_format = getattr(self.response_format, "__name__", self.response_format)
+        return f"{self.id}:{response_format}:{'stream' if stream else 'completion'}"
+
+    def limited_call(self, call, messages: List[Message]):
+        for attempt in flow.retrying():
+            with attempt:
+                flow.limiter.acquire()
+                flow.count("upstream")
+                start = time.perf_counter()
+                try:
+                    response = call(messages)
+                except Exception as e:
+                    flow.release_after(self.flow_kind(stream=False), error=e)
+                    raise
+                flow.release_after(self.flow_kind(stream=False), latency=time.perf_counter() - start)
+                return response
+
+    async def alimited_call(self, call, messages: List[Message]):
+        async for attempt in flow.aretrying():
+            with attempt:
+                await flow.limiter.aacquire()
+                flow.count("upstream")
+                start = time.perf_counter()
+                try:
+                    response = await call(messages)
+                except Exception as e:
+                    flow.release_after(self.flow_kind(stream=False), error=e)
+                    raise
+                flow.release_after(self.flow_kind(stream=False), latency=time.perf_counter() - start)
+                return response
+
+    def invoke(self, messages: List[Message]):
+        if not flow.FLOW_CONTROL_ENABLED:
+            return super().invoke(messages)
+        key = self.flight_key(messages)
+        future, leader = flow.single_flight.join(key)
+        if not leader:
+            return future.result()
+        try:
+            response = self.limited_call(super().invoke, messages)
+        except Exception as e:
+            flow.single_flight.finish(key, future, error=e)
+            raise
+        flow.single_flight.finish(key, future, response)
+        return response
+
+    async def ainvoke(self, messages: List[Message]):
+        if not flow.FLOW_CONTROL_ENABLED:
+            return await super().ainvoke(messages)
+        key = self.flight_key(messages)
+        future, leader = flow.single_flight.join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            response = await self.alimited_call(super().ainvoke, messages)
+        except Exception as e:
+            flow.single_flight.finish(key, future, error=e)
+            raise
+        flow.single_flight.finish(key, future, response)
+        return response
+
+    def invoke_stream(self, messages: List[Message]) -> Iterator[ChatCompletionChunk]:
+        if not flow.FLOW_CONTROL_ENABLED:
+            yield from super().invoke_stream(messages)
+            return
+        call = super().invoke_stream
+        for attempt in flow.retrying():
+            with attempt:
+                flow.limiter.acquire()
+                flow.count("upstream")
+                start = time.perf_counter()
+                stream = call(messages)
+                try:
+                    first = next(stream, None)
+                except Exception as e:
+                    flow.release_after(self.flow_kind(stream=True), error=e)
+                    raise
+        # The slot is held until the stream ends, its latency is the time to first token
+        latency = time.perf_counter() - start
+        error = None
+        try:
+            if first is not None:
+                yield first
+                yield from stream
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            flow.release_after(self.flow_kind(stream=True), latency=latency, error=error)
+
+    async def ainvoke_stream(self, messages: List[Message]) -> AsyncIterator[ChatCompletionChunk]:
+        if not flow.FLOW_CONTROL_ENABLED:
+            async for chunk in super().ainvoke_stream(messages):
+                yield chunk
+            return
+        call = super().ainvoke_stream
+        async for attempt in flow.aretrying():
+            with attempt:
+                await flow.limiter.aacquire()
+                flow.count("upstream")
+                start = time.perf_counter()
+                stream = call(messages)
+                try:
+                    first = await anext(stream, None)
+                except Exception as e:
+                    flow.release_after(self.flow_kind(stream=True), error=e)
+                    raise
+        latency = time.perf_counter() - start
+        error = None
+        try:
+            if first is not None:
+                yield first
+                async for chunk in stream:
+                    yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            flow.release_after(self.flow_kind(stream=True), latency=latency, error=error)
+
+
+class TracedChatMixin:
+    """Times model requests as the `llm.request` stage, streams also report `llm.ttft`"""
+
+    def invoke(self, messages: List[Message]):
+        with span("llm.request", model=self.id, stream=False):
+            return super().invoke(messages)
+
+    async def ainvoke(self, messages: List[Message]):
+        with span("llm.request", model=self.id, stream=False):
+            return await super().ainvoke(messages)
+
+    def invoke_stream(self, messages: List[Message]) -> Iterator[ChatCompletionChunk]:
+        start = time.perf_counter()
+        first = True
+        with span("llm.request", model=self.id, stream=True):
+            for chunk in super().invoke_stream(messages):
+                if first:
+                    record_span("llm.ttft", time.perf_counter() - start, model=self.id)
+                    first = False
+                yield chunk
+
+    async def ainvoke_stream(self, messages: List[Message]) -> AsyncIterator[ChatCompletionChunk]:
+        start = time.perf_counter()
+        first = True
+        with span("llm.request", model=self.id, stream=True):
+            async for chunk in super().ainvoke_stream(messages):
+                if first:
+                    record_span("llm.ttft", time.perf_counter() - start, model=self.id)
+                    first = False
+                yield chunk
+
+
+class TracedChat(TracedChatMixin, FlowControlMixin, StructuredStreamChat):
+    pass
+
+
+class TracedRecordReplayChat(TracedChatMixin, FlowControlMixin, RecordReplayChat):
+    pass
+
+
+def get_chat_model(id=DEFAULT_MODEL_ID):
+    """The chat model for an agent, live OpenAI unless LLM_MODE selects record or replay"""
+    # Retries are left to the flow control so they are counted against the adaptive limit
+    max_retries = 0 if flow.FLOW_CONTROL_ENABLED else None
+    if LLM_MODE in ("record", "replay"):
+        return TracedRecordReplayChat(id=id, mode=LLM_MODE, max_retries=max_retries)
+    return TracedChat(id=id, max_retries=max_retries)
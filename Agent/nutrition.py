@@ -0,0 +1,136 @@
+# nutrition.py
+
+import math
+from itertools import combinations
+import numpy as np
+from Agent.catalog import prebuilt, recipes
+
+# Columns of the nutrient matrix, values are per serving as published with the recipe
+NUTRIENTS = ["カロリー", "炭水化物", "脂質", "たんぱく質", "糖質", "塩分"]
+NUTRIENT_NAMES = {
+    "calories": "カロリー",
+    "carbohydrates": "炭水化物",
+    "fat": "脂質",
+    "protein": "たんぱく質",
+    "sugar": "糖質",
+    "salt": "塩分",
+}
+CALORIES, CARBOHYDRATES, FAT, PROTEIN, SUGAR, SALT = range(len(NUTRIENTS))
+
+# Upper bound on the recipe combinations scored at once by the meal-plan search
+MAX_COMBINATIONS = 200_000
+# Recipes in one meal plan, a week of dinners at most
+MAX_PLAN_RECIPES = 7
+
+
+def nutrient_row(recipe):
+    nutrients = recipe.get("nutrients") or {}
+    return [float((nutrients.get(name) or {}).get("value", np.nan)) for name in NUTRIENTS]
+
+
+def build_nutrient_matrix(recipe_list):
+    """recipes x NUTRIENTS float array indexed by recipe id, NaN where a value is missing"""
+    matrix = np.full((len(recipe_list), len(NUTRIENTS)), np.nan)
+    for recipe_id, recipe in enumerate(recipe_list):
+        if recipe.get("nutrients"):
+            matrix[recipe_id] = nutrient_row(recipe)
+    return matrix
+
+
+nutrient_matrix = prebuilt["nutrients"] if "nutrients" in prebuilt else build_nutrient_matrix(recipes)
+# Recipes with every nutrient known, the only ones a meal plan can be built from
+complete_mask = ~np.isnan(nutrient_matrix).any(axis=1)
+
+
+def recipe_nutrients(recipe_id, servings=1):
+    """Nutrients of one recipe scaled to `servings`, None if the recipe has no nutrient data"""
+    row = nutrient_matrix[recipe_id]
+    if np.isnan(row).all():
+        return None
+    return {name: None if math.isnan(value) else round(value * servings, 1) for name, value in zip(NUTRIENTS, row)}
+
+
+def candidate_pool(allowed_ids, count, calorie_target):
+    """Recipe ids to search over: complete, allowed, and capped to those closest to the per-meal target"""
+    mask = complete_mask.copy()
+    if allowed_ids is not None:
+        allowed = np.zeros(len(mask), dtype=bool)
+        allowed[np.fromiter(allowed_ids, dtype=np.int64, count=len(allowed_ids))] = True
+        mask &= allowed
+    pool = np.flatnonzero(mask)
+
+    size = max_pool_size(count)
+    if len(pool) > size:
+        if calorie_target is not None:
+            order = np.argsort(np.abs(nutrient_matrix[pool, CALORIES] - calorie_target / count), kind="stable")
+        else:
+            order = np.argsort(-nutrient_matrix[pool, PROTEIN], kind="stable")
+        pool = np.sort(pool[order[:size]])
+    return pool
+
+
+def max_pool_size(count):
+    """The largest pool whose `count`-combinations fit in MAX_COMBINATIONS"""
+    if count < 1:
+        raise ValueError("count must be at least 1")
+    low, high = count, count
+    while math.comb(high, count) <= MAX_COMBINATIONS:
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if math.comb(middle, count) <= MAX_COMBINATIONS:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def combinations_array(n, k):
+    """All k-combinations of range(n) as an (m, k) index array"""
+    flat = np.fromiter((i for combo in combinations(range(n), k) for i in combo), dtype=np.int32,
+                       count=math.comb(n, k) * k)
+    return flat.reshape(-1, k)
+
+
+def build_meal_plan(count=3, calories=None, min_protein=None, max_salt=None, allowed_ids=None, servings=1):
+    """Pick `count` recipes whose per-person totals meet the targets, closest to the calorie midpoint
+
+    `calories` is a (low, high) range for the whole plan, `min_protein` and `max_salt` are
+    grams for the whole plan. Returns None if fewer than `count` recipes have nutrient data.
+    When no combination meets every target the closest one is returned with feasible=False.
+    """
+    if not 1 <= count <= MAX_PLAN_RECIPES:
+        raise ValueError(f"count must be between 1 and {MAX_PLAN_RECIPES}")
+    calorie_target = sum(calories) / 2 if calories else None
+    pool = candidate_pool(allowed_ids, count, calorie_target)
+    if len(pool) < count:
+        return None
+
+    combos = pool[combinations_array(len(pool), count)]
+    totals = nutrient_matrix[combos].sum(axis=1)
+
+    # Shortfall against each target, 0 when it is met
+    penalty = np.zeros(len(combos))
+    if calories:
+        low, high = calories
+        penalty += np.maximum(low - totals[:, CALORIES], 0) / max(low, 1)
+        penalty += np.maximum(totals[:, CALORIES] - high, 0) / max(high, 1)
+    if min_protein is not None:
+        penalty += np.maximum(min_protein - totals[:, PROTEIN], 0) / max(min_protein, 1)
+    if max_salt is not None:
+        penalty += np.maximum(totals[:, SALT] - max_salt, 0) / max(max_salt, 0.1)
+
+    # Among equally good plans prefer the calorie midpoint, then more protein and less salt
+    closeness = np.abs(totals[:, CALORIES] - calorie_target) / calorie_target if calorie_target else 0.0
+    score = penalty * 1000 + closeness - totals[:, PROTEIN] * 1e-4 + totals[:, SALT] * 1e-3
+    best = int(np.argmin(score))
+
+    recipe_ids = combos[best].tolist()
+    return {
+        "recipe_ids": recipe_ids,
+        "titles": [recipes[recipe_id]['title'] for recipe_id in recipe_ids],
+        "feasible": bool(penalty[best] == 0),
+        "per_person": {name: round(float(value), 1) for name, value in zip(NUTRIENTS, totals[best])},
+        "recipes": [recipe_nutrients(recipe_id, servings) for recipe_id in recipe_ids],
+        "servings": servings,
+    }
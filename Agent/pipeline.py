@@ -0,0 +1,395 @@
+# pipeline.py
+#
+# The suggestion and recipe pipelines without any UI, shared by the Streamlit pages
+# and the HTTP API in api.py.
+
+import math
+from pydantic import ValidationError
+from rapidfuzz import fuzz
+from Agent.allergens import DIET_EXCLUSIONS, allowed_recipe_ids
+from Agent.catalog import get_recipe, normalize_title, recipes, resolve_title
+from Agent.context import build_context_messages, extract_requested_servings
+from Agent.facets import bucket_filter, rating_value
+from Agent.nutrition import build_meal_plan
+from Agent.recipe import RecipeOutput, search_for_recipe_exact
+from Agent.router import cache_key, choose_route, record_route, servings_scale, translation_cache
+from Agent.shopping import scale_ingredient
+from Agent.suggestions import streamed_message, validate_suggestions
+from Agent.supervisor import RecipeSuggestion, SupervisorResponse, set_supervisor_candidates
+from tracing import span, traced
+from Agent.usage import record_run, session_over_budget
+
+NO_PREFERENCE_INDICATORS = [
+    "no preferences", "not having specific preferences", "any recipe is fine",
+    "no specific", "don't have preferences", "no particular preferences",
+    "just suggest", "whatever you suggest", "anything is fine"
+]
+
+BUDGET_MESSAGES = {
+    "English": "This conversation has reached its usage limit, so these suggestions come straight from our recipe list.",
+    "Japanese": "この会話の利用上限に達したため、レシピ一覧から直接おすすめを表示しています。",
+}
+
+
+def build_supervisor_prompt(user_input, language, preferences, preferences_collected, weather_data=None,
+                            user_message_count=1):
+    if preferences_collected:
+        text = ""
+        if preferences['taste']:
+            text += f" - Taste must be {preferences['taste']}"
+        if preferences['cooking_time']:
+            text += f" - Cooking Time must be {preferences['cooking_time']}"
+        if preferences['ingredients']:
+            text += f" - Ingredients to include: {', '.join(preferences['ingredients']) if preferences['ingredients'] else 'No specific ingredients'}"
+        if preferences['allergies']:
+            text += f"""MOST IMPORTANT: Suggest Recipe which don't have mentioned Allergies
+                Allergies/Avoid: {', '.join(preferences['allergies']) if preferences['allergies'] else 'None specified'}
+                """
+        if preferences['diet']:
+            text += f" - Diet must be {preferences['diet']}."
+        # Include user preferences in the prompt
+        preferences_text = f"""
+            IMPORTANT USER PREFERENCES:
+            {text}
+
+            Based on these preferences and the user's request: "{user_input}", suggest 5 suitable recipes.
+            Please ensure All the user preferences must be satisfied
+
+            IMPORTANT FORMATTING RULES:
+            1. Put your conversational text in `message`
+            2. Put each suggested recipe in `suggestions` with its recipe_id and exact Japanese title from the list
+            3. NO URLs, NO image links, NO descriptions in the suggestions
+            """
+        prompt = f"{preferences_text} IMPORTANT: Generate response in {language}"
+    else:
+        # Process request without specific preference information
+        has_explicit_no_preference = any(indicator in user_input.lower() for indicator in NO_PREFERENCE_INDICATORS)
+
+        prompt = f"{user_input}"
+
+        if has_explicit_no_preference:
+            prompt += " USER HAS EXPLICITLY STATED NO PREFERENCES, PROVIDE RECIPE SUGGESTIONS IMMEDIATELY."
+        elif user_message_count > 1:
+            prompt += " THIS IS A FOLLOW-UP MESSAGE WITH USER PREFERENCES, PROVIDE RECIPE SUGGESTIONS NOW."
+
+        prompt += f"""
+            IMPORTANT FORMATTING RULES:
+            - Generate response in {language}
+            - alway give msg like this when no preference: give msg like i search for prefrnce but no prefrence so i will suggest some recipes
+            - Put your conversational text in `message`
+            - Put each suggested recipe in `suggestions` with its recipe_id and exact Japanese title from the list
+            - NO URLs, NO image links, NO descriptions in the suggestions
+            """
+    if weather_data:
+        prompt += f"""MUST ADD WEATHER DETAILS AND SUGGEST RECIPE
+                {weather_data['temperature']}:
+                    - If the temperature is over 30°C and the weather is hot or sunny, suggest cold or refreshing dishes, drinks.
+                    - If the temperature is below 15°C and the weather is cold, suggest warm and comforting dishes, drinks.
+                    - If the temperature is between 15°C and 30°C, suggest balanced dishes,drinks that are neither too hot nor too cold.
+                {weather_data['description']}:
+                    - If  weather data includes the word **rain**: suggest meal based on rain"""
+    return prompt
+
+
+def candidate_recipe_ids(preferences, preferences_collected):
+    """Recipe ids allowed by allergies, diet and cooking time, None when nothing is filtered"""
+    allowed_ids = None
+    if preferences_collected:
+        if preferences['allergies'] or preferences['diet'] in DIET_EXCLUSIONS:
+            allowed_ids = allowed_recipe_ids(preferences['allergies'], preferences['diet'])
+        time_ids = bucket_filter("cooking_time", preferences['cooking_time'])
+        if time_ids is not None:
+            allowed_ids = time_ids if allowed_ids is None else allowed_ids & time_ids
+    return allowed_ids
+
+
+@traced("nutrition.meal_plan")
+def plan_meals(preferences, preferences_collected, count=3, calories=None, min_protein=None, max_salt=None,
+               servings=1):
+    """A meal plan answered locally from the nutrient matrix, within the session's allergy, diet and time filters"""
+    allowed_ids = candidate_recipe_ids(preferences, preferences_collected)
+    return build_meal_plan(count, calories, min_protein, max_salt, allowed_ids, servings)
+
+
+@traced("supervisor.prepare")
+def prepare_suggestion_run(supervisor_agent, history, user_input, language, preferences, preferences_collected,
+                           weather_data=None):
+    """Set the supervisor's candidates and build its messages, `history` ends with the user turn"""
+    user_message_count = sum(1 for msg in history if msg["role"] == "user")
+    prompt = build_supervisor_prompt(user_input, language, preferences, preferences_collected, weather_data,
+                                     user_message_count)
+
+    # Filter out recipes that clash with allergies, diet or cooking time locally, before the LLM sees them
+    allowed_ids = candidate_recipe_ids(preferences, preferences_collected)
+    set_supervisor_candidates(supervisor_agent, allowed_ids)
+
+    # Recent turns within the supervisor's token budget, older turns summarized
+    messages = build_context_messages(history[:-1], prompt, "supervisor")
+    return messages, allowed_ids
+
+
+@traced("supervisor.validate")
+def finish_suggestion_run(content, allowed_ids):
+    """Validate the supervisor's response, returns the display text and the suggested titles"""
+    message, recipe_ids = validate_suggestions(content, allowed_ids)
+    dish_suggestions = [get_recipe(recipe_id)['title'] for recipe_id in recipe_ids]
+    full_response = message
+    if dish_suggestions:
+        full_response += "\n\nRECIPE SUGGESTIONS:\n" + "\n".join(f"- {title}" for title in dish_suggestions)
+    return full_response, dish_suggestions
+
+
+def local_supervisor_response(user_input, language, allowed_ids=None, count=5):
+    """Suggestions picked without the LLM: closest titles to the request, then best rated"""
+    candidate_ids = sorted(allowed_ids) if allowed_ids is not None else range(len(recipes))
+    query = normalize_title(user_input)
+
+    def score(recipe_id):
+        recipe = get_recipe(recipe_id)
+        rating = rating_value(recipe)
+        return fuzz.partial_ratio(query, normalize_title(recipe['title'])), 0.0 if math.isnan(rating) else rating
+
+    best_ids = sorted(candidate_ids, key=score, reverse=True)[:count]
+    return SupervisorResponse(
+        message=BUDGET_MESSAGES.get(language, BUDGET_MESSAGES["English"]),
+        suggestions=[RecipeSuggestion(recipe_id=recipe_id, title=get_recipe(recipe_id)['title'])
+                     for recipe_id in best_ids],
+    )
+
+
+def run_supervisor(supervisor_agent, messages, user_input, language, allowed_ids):
+    """The supervisor's response content, or a local one once the session is over budget"""
+    if session_over_budget():
+        return local_supervisor_response(user_input, language, allowed_ids)
+    with span("supervisor.run"):
+        run_response = supervisor_agent.run(messages=messages)
+    record_run(supervisor_agent, run_response)
+    return run_response.content
+
+
+class SupervisorStream:
+    """Iterates the supervisor's `message` text as it is generated, `content` holds the whole response afterwards
+
+    The structured response streams as JSON; the message is decoded from the partial
+    JSON so the user reads it while the suggestions are still being written.
+    """
+
+    def __init__(self, supervisor_agent, messages, user_input, language, allowed_ids):
+        self.supervisor_agent = supervisor_agent
+        self.messages = messages
+        self.user_input = user_input
+        self.language = language
+        self.allowed_ids = allowed_ids
+        self.content = None
+
+    def __iter__(self):
+        if session_over_budget():
+            self.content = local_supervisor_response(self.user_input, self.language, self.allowed_ids)
+            yield self.content.message
+            return
+        text = ""
+        shown = ""
+        with span("supervisor.run"):
+            for chunk in self.supervisor_agent.run(messages=self.messages, stream=True):
+                if not isinstance(chunk.content, str):
+                    continue
+                text += chunk.content
+                message = streamed_message(text)
+                if len(message) > len(shown):
+                    yield message[len(shown):]
+                    shown = message
+        record_run(self.supervisor_agent, self.supervisor_agent.run_response)
+        try:
+            self.content = SupervisorResponse.model_validate_json(text)
+        except ValidationError:
+            # Left to the text fallback of validate_suggestions
+            self.content = text
+
+
+async def arun_supervisor(supervisor_agent, messages, user_input, language, allowed_ids):
+    if session_over_budget():
+        return local_supervisor_response(user_input, language, allowed_ids)
+    with span("supervisor.run"):
+        run_response = await supervisor_agent.arun(messages=messages)
+    record_run(supervisor_agent, run_response)
+    return run_response.content
+
+
+def suggest_recipes(supervisor_agent, history, user_input, language, preferences, preferences_collected,
+                    weather_data=None):
+    messages, allowed_ids = prepare_suggestion_run(supervisor_agent, history, user_input, language, preferences,
+                                                   preferences_collected, weather_data)
+    content = run_supervisor(supervisor_agent, messages, user_input, language, allowed_ids)
+    return finish_suggestion_run(content, allowed_ids)
+
+
+async def asuggest_recipes(supervisor_agent, history, user_input, language, preferences, preferences_collected,
+                           weather_data=None):
+    messages, allowed_ids = prepare_suggestion_run(supervisor_agent, history, user_input, language, preferences,
+                                                   preferences_collected, weather_data)
+    content = await arun_supervisor(supervisor_agent, messages, user_input, language, allowed_ids)
+    return finish_suggestion_run(content, allowed_ids)
+
+
+def build_preferences_context(preferences, preferences_collected):
+    preferences_context = ""
+    if preferences_collected:
+        preferences_list = []
+
+        if preferences['taste'] and preferences['taste'] != "No Preference":
+            preferences_list.append(f"- Taste: {preferences['taste']}")
+
+        if preferences['cooking_time'] and preferences['cooking_time'] != "No Preference":
+            preferences_list.append(f"- Cooking Time: {preferences['cooking_time']}")
+
+        if preferences['ingredients']:
+            preferences_list.append(f"- Ingredients to include: {', '.join(preferences['ingredients'])}")
+
+        if preferences['allergies']:
+            preferences_list.append(f"- Allergies/Avoid: {', '.join(preferences['allergies'])}")
+
+        if preferences['diet'] and preferences['diet'] != "No Preference":
+            preferences_list.append(f"- Diet: {preferences['diet']}")
+
+        # Join all valid preferences together
+        if preferences_list:
+            preferences_context = "User Preferences:\n" + "\n".join(preferences_list)
+    return preferences_context
+
+
+def build_recipe_prompt(recipe_from_json, language, preferences_context, requested_servings=None):
+    if requested_servings:
+        servings_instruction = f"Adjust the ingredients, times and quantities proportionally to match {requested_servings} servings. "
+    else:
+        servings_instruction = "Keep the original servings. "
+    return (
+        f"Please translate the following recipe into {language}:\n\n"
+        f"{preferences_context}\n\n"
+        f"Recipe: {recipe_from_json}\n\n"
+        f"{servings_instruction}"
+        f"Ensure that all quantities are modified proportionally and the INGREDIANTS appear on separate lines. "
+        f"Do not omit any important details in the translation."
+    )
+
+
+@traced("recipe.prepare")
+def prepare_recipe_prompt(title, language, preferences, preferences_collected, history):
+    """The recipe agent prompt for a catalog recipe, None if the title is not in the catalog"""
+    recipe_from_json = search_for_recipe_exact(title)
+    if not recipe_from_json:
+        return None
+    # The only thing the recipe agent needs from the conversation is the requested servings
+    requested_servings = extract_requested_servings(history)
+    preferences_context = build_preferences_context(preferences, preferences_collected)
+    return build_recipe_prompt(recipe_from_json, language, preferences_context, requested_servings)
+
+
+def as_text(value):
+    return None if value is None else str(value)
+
+
+def format_nutrients(recipe):
+    nutrients = recipe.get("nutrients") or {}
+    parts = [f"{name} {value['value']:g}{value.get('unit', '')}" for name, value in nutrients.items()
+             if isinstance(value, dict) and value.get("value") is not None]
+    return "1人分: " + ", ".join(parts) if parts else None
+
+
+def local_recipe_output(title, servings=None):
+    """The catalog recipe without the recipe agent, untranslated, with its quantities scaled
+    to `servings` when the published servings are known"""
+    recipe = search_for_recipe_exact(title)
+    if not recipe:
+        return None
+    recipe_id = resolve_title(title)
+    record = get_recipe(recipe_id)
+    scale = servings_scale(recipe_id, servings)
+    if scale is None:
+        scale = 1
+    return RecipeOutput(
+        recipe_title=recipe["recipe_title"],
+        cuisine_type=as_text(recipe["cuisine_type"]),
+        prep_time=as_text(recipe["prep_time"]),
+        cook_time=as_text(recipe["cook_time"]),
+        total_time=as_text(recipe["total_time"]),
+        ingredients="\n".join(scale_ingredient(ingredient, scale) for ingredient in record.get("ingredients", [])),
+        instructions=[step.get("description", "") if isinstance(step, dict) else str(step)
+                      for step in recipe["instructions"]],
+        nutritional_info=format_nutrients(record),
+        serving_size=f"{servings}人分" if servings and scale != 1 else as_text(recipe["serving_size"]),
+        image_url=recipe["image_url"],
+    )
+
+
+def route_recipe(title, language, history, preferences_context=""):
+    """(route, recipe) for a request; the recipe is None when the route is 'llm'"""
+    recipe_id = resolve_title(title)
+    servings = extract_requested_servings(history)
+    with span("recipe.route") as attributes:
+        route = choose_route(recipe_id, language, servings, preferences_context)
+        attributes["route"] = route
+    if route == "cache":
+        return route, translation_cache.get(cache_key(recipe_id, language, servings, preferences_context))
+    if route == "catalog":
+        return route, local_recipe_output(title, servings)
+    return route, None
+
+
+def remember_translation(title, language, history, preferences_context, recipe):
+    # A response that did not parse into a RecipeOutput is not worth keeping
+    if isinstance(recipe, RecipeOutput):
+        translation_cache.put(cache_key(resolve_title(title), language, extract_requested_servings(history),
+                                        preferences_context), recipe)
+
+
+def get_recipe_details(recipe_agent, title, language, preferences, preferences_collected, history,
+                       prefetcher=None):
+    """Look the recipe up in the catalog and let the recipe agent translate/scale it, None if unknown"""
+    prompt = prepare_recipe_prompt(title, language, preferences, preferences_collected, history)
+    if prompt is None:
+        return None
+    # The catalog or the translation cache answer most requests without the recipe agent
+    preferences_context = build_preferences_context(preferences, preferences_collected)
+    route, recipe = route_recipe(title, language, history, preferences_context)
+    if recipe is not None:
+        if prefetcher is not None:
+            prefetcher.cancel()
+        record_route(route)
+        return recipe
+    record_route("llm")
+    over_budget = session_over_budget()
+    if prefetcher is not None:
+        # The user picked this recipe, other speculative work is no longer needed
+        prefetcher.cancel(keep=[prompt])
+        with span("recipe.prefetch_wait") as attributes:
+            recipe = prefetcher.result(prompt, timeout=0 if over_budget else None)
+            attributes["hit"] = recipe is not None
+        if recipe is not None:
+            remember_translation(title, language, history, preferences_context, recipe)
+            return recipe
+    if over_budget:
+        return local_recipe_output(title, extract_requested_servings(history))
+    with span("recipe.run"):
+        run_response = recipe_agent.run(prompt, stream=True)
+    record_run(recipe_agent, run_response)
+    remember_translation(title, language, history, preferences_context, run_response.content)
+    return run_response.content
+
+
+async def aget_recipe_details(recipe_agent, title, language, preferences, preferences_collected, history):
+    prompt = prepare_recipe_prompt(title, language, preferences, preferences_collected, history)
+    if prompt is None:
+        return None
+    preferences_context = build_preferences_context(preferences, preferences_collected)
+    route, recipe = route_recipe(title, language, history, preferences_context)
+    if recipe is not None:
+        record_route(route)
+        return recipe
+    record_route("llm")
+    if session_over_budget():
+        return local_recipe_output(title, extract_requested_servings(history))
+    with span("recipe.run"):
+        run_response = await recipe_agent.arun(prompt)
+    record_run(recipe_agent, run_response)
+    remember_translation(title, language, history, preferences_context, run_response.content)
+    return run_response.content
@@ -0,0 +1,94 @@
+# prefetch.py
+
+import contextvars
+import os
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError
+from Agent.catalog import resolve_title
+from Agent.context import extract_requested_servings
+from Agent.pipeline import build_preferences_context, prepare_recipe_prompt
+from Agent.recipe import get_agent
+from Agent.router import choose_route
+from tracing import span
+from Agent.usage import record_run, session_over_budget
+
+PREFETCH_ENABLED = os.getenv("RECIPE_PREFETCH", "0") == "1"
+# How many of the displayed suggestions are resolved ahead of a click
+PREFETCH_TOP_N = int(os.getenv("RECIPE_PREFETCH_TOP_N", "2"))
+# Cap on speculative recipe agent runs per session, each one is a paid completion
+PREFETCH_MAX_RUNS = int(os.getenv("RECIPE_PREFETCH_MAX_RUNS", "6"))
+
+# Shared by all sessions so speculative work can never take more than a few threads
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("RECIPE_PREFETCH_WORKERS", "4")),
+                              thread_name_prefix="recipe-prefetch")
+
+
+class RecipePrefetcher:
+    """Resolves and translates suggested recipes in the background for one session
+
+    Results are keyed by the recipe agent prompt, so a prefetched recipe is only used
+    when the language, servings and preferences are the same as at click time.
+    """
+
+    def __init__(self, top_n=PREFETCH_TOP_N, max_runs=PREFETCH_MAX_RUNS):
+        self.top_n = top_n
+        self.max_runs = max_runs
+        self.runs_started = 0
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def start(self, titles, language, preferences, preferences_collected, history):
+        """Prefetch the top suggestions, cancelling queued work for suggestions no longer shown"""
+        if session_over_budget():
+            # Speculative runs are the first thing to go once a session is over budget
+            return
+        prompts = []
+        servings = extract_requested_servings(history)
+        preferences_context = build_preferences_context(preferences, preferences_collected)
+        for title in titles[:self.top_n]:
+            # Recipes the router answers without the recipe agent need no speculative run
+            if choose_route(resolve_title(title), language, servings, preferences_context) != "llm":
+                continue
+            prompt = prepare_recipe_prompt(title, language, preferences, preferences_collected, history)
+            if prompt is not None:
+                prompts.append(prompt)
+        self.cancel(keep=prompts)
+
+        with self.lock:
+            for prompt in prompts:
+                if prompt in self.futures or self.runs_started >= self.max_runs:
+                    continue
+                self.runs_started += 1
+                # Run in a copy of the caller's context, so the spans keep its request id
+                self.futures[prompt] = executor.submit(contextvars.copy_context().run, self.run, prompt)
+
+    @staticmethod
+    def run(prompt):
+        # A fresh agent, the session's own agent may be running in the script thread
+        agent = get_agent()
+        with span("recipe.prefetch_run"):
+            run_response = agent.run(prompt)
+        record_run(agent, run_response)
+        return run_response.content
+
+    def cancel(self, keep=()):
+        """Drop every prefetch except `keep`; runs already in flight finish but are discarded"""
+        with self.lock:
+            for prompt in list(self.futures):
+                if prompt not in keep and self.futures.pop(prompt).cancel():
+                    # It never started, so it does not count against the budget
+                    self.runs_started -= 1
+
+    def result(self, prompt, timeout=None):
+        """The prefetched recipe for this prompt, waiting for it if it is still running"""
+        with self.lock:
+            future = self.futures.get(prompt)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except (CancelledError, TimeoutError):
+            return None
+        except Exception as e:
+            print(f"Recipe prefetch failed: {e}")
+            return None
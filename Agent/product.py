@@ -1,8 +1,11 @@
+import asyncio
 import re
 from rapidfuzz import fuzz, process
 # from fuzzywuzzy import fuzz, process
 from deep_translator import GoogleTranslator
-from Database.database import search_products
+from Agent.text import language_code, needs_translation
+from tracing import traced
+from Database.database import async_search_products, search_products
 
 def clean_ingredient(ingredient):
     cleaned = re.sub(r'【.*?】', '', ingredient) 
@@ -16,6 +19,7 @@ def clean_ingredient(ingredient):
     words = [w for w in cleaned.lower().split() if w not in blacklist]
     return ' '.join(words).strip()
 
+@traced("product.fuzzy_match")
 def find_similar_products(cleaned_ingredients, products_db, threshold=85):
     results = set()
     product_names = [product[0].lower() for product in products_db]
@@ -29,31 +33,81 @@ def find_similar_products(cleaned_ingredients, products_db, threshold=85):
                     results.add(tuple(product))
     return list(results)
 
-def get_available_ingredients(recipe_ingredients, language):
+@traced("product.fuzzy_match")
+def match_scores(ingredients, products_db):
+    """ingredients x products token_set_ratio matrix, computed in one batched pass"""
+    product_names = [product[0].lower() for product in products_db]
+    return process.cdist([i.lower() for i in ingredients], product_names, scorer=fuzz.token_set_ratio, workers=-1)
+
+def match_products(ingredients, products_db, threshold=85):
+    """Index of the best product row for each ingredient, None below threshold"""
+    if not ingredients or not products_db:
+        return [None] * len(ingredients)
+    scores = match_scores(ingredients, products_db)
+    best = scores.argmax(axis=1)
+    return [int(index) if scores[row, index] >= threshold else None for row, index in enumerate(best)]
+
+def split_ingredients(recipe_ingredients):
     if isinstance(recipe_ingredients, list):
-        ingredient_list = [i.strip() for i in recipe_ingredients if i]
+        return [i.strip() for i in recipe_ingredients if i]
     elif isinstance(recipe_ingredients, str):
-        ingredient_list = [i.strip() for i in recipe_ingredients.split(",") if i]
-    else:
-        ingredient_list = []
+        return [i.strip() for i in recipe_ingredients.split(",") if i]
+    return []
+
+@traced("translate")
+def translate_text(text, target):
+    return GoogleTranslator(source='auto', target=target).translate(text)
+
+def translate_if_needed(text, target):
+    """The text in the target language, without a translator call when it already is"""
+    return translate_text(text, target) if needs_translation(text, target) else text
+
+async def atranslate_if_needed(text, target):
+    if not needs_translation(text, target):
+        return text
+    return await asyncio.to_thread(translate_text, text, target)
+
+def format_matches(matches, product_names=None):
+    """Turn matched product rows into the dicts shown in the UI, optionally with translated names"""
+    return [
+        {
+            "Product_name": product_names[index] if product_names else p[0],
+            "Tax": p[1],
+            "Price": f"{p[2]}",
+            "Weight": f"{p[5]} {p[6]}",
+            # The name in ai.products, stock is reserved under it whatever language is shown
+            "Catalog_name": p[0],
+        }
+        for index, p in enumerate(matches)
+    ]
+
+def product_display_names(matches, language):
+    """English names of matched product rows, translated once per name, None for Japanese"""
+    if language_code(language) == "ja":
+        return None
+    translated = {}
+    for match in matches:
+        if match[0] not in translated:
+            translated[match[0]] = translate_if_needed(match[0], 'en')
+    return [translated[match[0]] for match in matches]
+
+@traced("product.available_ingredients")
+def get_available_ingredients(recipe_ingredients, language, is_vegan=None):
+    ingredient_list = split_ingredients(recipe_ingredients)
     # print('---ingredient_list----', ingredient_list)
 
     cleaned_ingredients = [clean_ingredient(i) for i in ingredient_list]
     # print('---cleaned_ingredients---', cleaned_ingredients)
 
-    if language.lower() != "Japanese":
-        try:
-            ingredient_list = [
-                GoogleTranslator(source='auto', target='ja').translate(i)
-                for i in cleaned_ingredients
-            ]
-            # print('------translated-ingredient_list----', ingredient_list)
-        except Exception as e:
-            print("Translation failed:", e)
-    else:
-        ingredient_list = cleaned_ingredients
-
-    products_db = search_products()
+    # Products are matched by their Japanese names, ingredients already in Japanese are not translated
+    try:
+        ingredient_list = [translate_if_needed(i, 'ja') for i in cleaned_ingredients]
+        # print('------translated-ingredient_list----', ingredient_list)
+    except Exception as e:
+        print("Translation failed:", e)
+
+    # Only sellable products (in stock, not expired) are fetched and matched
+    products_db = search_products(is_vegan=is_vegan)
     # print('----product_db', products_db)
     products_db = [list(p) for p in products_db]
 
@@ -61,25 +115,25 @@ def get_available_ingredients(recipe_ingredients, language):
     # print('--------matches--------', matches)
 
     # Translate product details if the language is not Japanese
-    if language.lower() != "japanese":
-        translated_matches = []
-        for match in matches:
-            translated_match = {
-                "Product_name": GoogleTranslator(source='auto', target='en').translate(match[0]),
-                "Tax": match[1],
-                "Price": f"{match[2]}",
-                "Weight": f"{match[5]} {match[6]}"
-            }
-            translated_matches.append(translated_match)
-        # print('---------translated_matches-------', translated_matches)
-        return translated_matches
-    else:
-        return [
-            {
-                "Product_name": p[0],
-                "Tax": p[1],
-                "Price": f"{p[2]}",
-                "Weight": f"{p[5]} {p[6]}"
-            }
-            for p in matches
-        ]
+    return format_matches(matches, product_display_names(matches, language))
+
+@traced("product.available_ingredients")
+async def aget_available_ingredients(recipe_ingredients, language, is_vegan=None):
+    """Async variant: translations run concurrently and overlap with the product query"""
+    ingredient_list = split_ingredients(recipe_ingredients)
+    cleaned_ingredients = [clean_ingredient(i) for i in ingredient_list]
+
+    products_task = asyncio.create_task(async_search_products(is_vegan=is_vegan))
+    try:
+        ingredient_list = await asyncio.gather(*(atranslate_if_needed(i, 'ja') for i in cleaned_ingredients))
+    except Exception as e:
+        print("Translation failed:", e)
+
+    products_db = [list(p) for p in await products_task]
+    matches = find_similar_products(ingredient_list, products_db)
+
+    if language_code(language) == "ja":
+        return format_matches(matches)
+    names = list(dict.fromkeys(match[0] for match in matches))
+    translated = dict(zip(names, await asyncio.gather(*(atranslate_if_needed(name, 'en') for name in names))))
+    return format_matches(matches, [translated[match[0]] for match in matches])
@@ -1,8 +1,7 @@
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, ConfigDict
 from agno.agent import Agent
-from agno.models.openai import OpenAIChat
-from agno.storage.postgres import PostgresStorage
+from Agent.models import get_chat_model
 from textwrap import dedent
 import os
 from dotenv import load_dotenv
@@ -11,6 +10,8 @@ import re
 import time
 from typing import Iterator
 from agno.agent import RunResponse
+from Agent.catalog import get_recipe, resolve_title
+from Agent.text import contains_japanese
 
 load_dotenv()
 
@@ -60,7 +61,7 @@ def clean_recipe_name(recipe_text):
     recipe_text = re.sub(r'\s+-\s+.*$', '', recipe_text)
 
     # Remove any text in square brackets that's not part of Japanese formatting
-    if not any(ord(char) > 127 for char in recipe_text):  # If not Japanese
+    if not contains_japanese(recipe_text):
         recipe_text = re.sub(r'\[.*?\]', '', recipe_text)
 
     # Remove trailing punctuation and whitespace
@@ -68,23 +69,13 @@ def clean_recipe_name(recipe_text):
 
     return recipe_text.strip()
 
-def load_recipe_data(json_path="recipe_data/all_recipes.json"):
-    try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
-    except Exception as e:
-        print(f"Error loading recipe data: {e}")
-        return []
-
-
 def search_for_recipe_exact(title: str):
-
-    recipe_data = load_recipe_data()  
-    for recipe in recipe_data:
-        # print('-----search--------recipe', recipe) 
-        # print('-----get-------title', recipe.get('title', ''))
-        if recipe.get('title', '').strip() == title.strip():
+    # Titles are looked up in the shared catalog, the resolver also handles list markers
+    # and "(English name)" suffixes, so titles that contain parentheses still match
+    recipe_id = resolve_title(title)
+    if recipe_id is not None:
+        recipe = get_recipe(recipe_id)
+        if recipe:
 
             serving_size = None
             servings_info = recipe.get("servings", {})
@@ -160,18 +151,12 @@ def search_for_recipe_exact(title: str):
 #     return agent
 
 
+# Conversation state is persisted by Agent.session_store with batched writes, so the
+# agent itself keeps no storage and a chat turn never waits on the database
 def get_agent():
-    db_url = f"postgresql+psycopg2://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@" \
-             f"{os.getenv('DB_HOST')}:{os.getenv('PORT')}/{os.getenv('DB_NAME')}"
-    storage = PostgresStorage(
-        table_name="agent_sessions",
-        db_url=db_url,
-        auto_upgrade_schema=True
-    )
-
     agent = Agent(
         name="Recipe Agent",
-        model=OpenAIChat(id="gpt-4o-mini"),
+        model=get_chat_model("gpt-4o-mini"),
         system_message = dedent(f"""
             Your task is to provide the recipe details in the language specified by the user.
             IMPORTANT:
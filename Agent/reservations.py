@@ -0,0 +1,177 @@
+# reservations.py
+#
+# Stock holds for carts. Adding to a cart reserves the quantity in ai.products with an
+# expiry; checkout commits the holds, clearing the cart or letting them expire puts the
+# stock back. Reservations from all sessions of a worker are grouped for a few
+# milliseconds and sent as one conditional batch decrement, so a hot product costs one
+# row update per batch instead of one locked update per cart.
+
+import atexit
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from Database.database import commit_holds, create_stock_holds_table, release_holds, reserve_stock
+
+RESERVATIONS_ENABLED = os.getenv("RESERVATIONS", "1") == "1"
+HOLD_TTL = int(os.getenv("RESERVATION_TTL", "900"))
+# How long a reservation waits for others to share its batch
+BATCH_WINDOW = float(os.getenv("RESERVATION_BATCH_WINDOW", "0.02"))
+MAX_BATCH = 500
+RESERVE_TIMEOUT = 10.0
+RELEASE_INTERVAL = float(os.getenv("RESERVATION_RELEASE_INTERVAL", "30"))
+
+
+class ReservationError(Exception):
+    """The stock could not be checked (database unreachable), as opposed to being sold out"""
+
+
+class StockReserver:
+    """Group-commit queue for reservations plus a background releaser of expired holds"""
+
+    def __init__(self, ttl=HOLD_TTL, batch_window=BATCH_WINDOW, max_batch=MAX_BATCH,
+                 release_interval=RELEASE_INTERVAL, reserve_rows=reserve_stock, release_rows=release_holds,
+                 create_table=create_stock_holds_table):
+        self.ttl = ttl
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.release_interval = release_interval
+        self.reserve_rows = reserve_rows
+        self.release_rows = release_rows
+        self.create_table = create_table
+        self.table_ready = False
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.threads = None
+
+    def start(self):
+        with self.lock:
+            if self.threads is not None:
+                return
+            self.threads = [
+                threading.Thread(target=self.run, name="stock-reserver", daemon=True),
+                threading.Thread(target=self.run_releaser, name="stock-releaser", daemon=True),
+            ]
+        for thread in self.threads:
+            thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, cart_id, product_name, quantity):
+        """Queue a reservation, the future resolves to the hold id or None if out of stock"""
+        future = Future()
+        with self.lock:
+            self.pending.append(((uuid.uuid4().hex, cart_id, product_name, quantity), future))
+            full = len(self.pending) >= self.max_batch
+        self.start()
+        self.wake.set()
+        if full:
+            self.flush()
+        return future
+
+    def reserve(self, cart_id, product_name, quantity, timeout=RESERVE_TIMEOUT):
+        return self.submit(cart_id, product_name, quantity).result(timeout)
+
+    def ensure_table(self):
+        # The holds table is created on first use, a fresh database needs no setup step
+        if not self.table_ready:
+            self.create_table()
+            self.table_ready = True
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            self.ensure_table()
+            granted = self.reserve_rows([request for request, _ in batch], self.ttl)
+        except Exception as e:
+            print(f"Stock reservation failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (hold_id, *_), future in batch:
+            future.set_result(hold_id if hold_id in granted else None)
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            # Let concurrent carts join the batch
+            time.sleep(self.batch_window)
+            self.wake.clear()
+            self.flush()
+
+    def run_releaser(self):
+        while True:
+            time.sleep(self.release_interval)
+            try:
+                self.ensure_table()
+                released = self.release_rows(expired=True)
+                if released:
+                    print(f"Released {released} units from expired stock holds")
+            except Exception as e:
+                print(f"Expired hold release failed: {e}")
+
+
+stock_reserver = StockReserver()
+
+
+def reserve(cart_id, product_name, quantity):
+    """Hold `quantity` of a product for the cart, True if the stock was available
+
+    Raises ReservationError when the stock could not be checked at all.
+    """
+    if not RESERVATIONS_ENABLED:
+        return True
+    try:
+        return stock_reserver.reserve(cart_id, product_name, quantity) is not None
+    except Exception as e:
+        print(f"Reservation failed for {product_name}: {e}")
+        raise ReservationError(f"Stock for {product_name} could not be checked") from e
+
+
+def checkout(cart_id, cart_items):
+    """Commit the cart's holds, returns the items whose holds expired and could not be re-reserved
+
+    Raises ReservationError when the database could not be reached.
+    """
+    if not RESERVATIONS_ENABLED:
+        return []
+    try:
+        committed = commit_holds(cart_id)
+    except Exception as e:
+        print(f"Checkout of {cart_id} failed: {e}")
+        raise ReservationError("The order could not be placed") from e
+    unavailable = []
+    re_reserved = False
+    for item in cart_items:
+        name = item.get("Catalog_name", item["Product_name"])
+        held = min(committed.get(name, 0), item["Quantity"])
+        committed[name] = committed.get(name, 0) - held
+        shortfall = item["Quantity"] - held
+        # Expired holds are re-reserved and committed if the stock is still there
+        if shortfall > 0:
+            if not reserve(cart_id, name, shortfall):
+                unavailable.append({"Product_name": item["Product_name"], "Quantity": shortfall})
+            else:
+                re_reserved = True
+    if re_reserved:
+        try:
+            commit_holds(cart_id)
+        except Exception as e:
+            print(f"Checkout of {cart_id} failed: {e}")
+            raise ReservationError("The order could not be placed") from e
+    return unavailable
+
+
+def release(cart_id):
+    """Put back everything held for the cart"""
+    if not RESERVATIONS_ENABLED:
+        return 0
+    try:
+        return release_holds(cart_id=cart_id)
+    except Exception as e:
+        print(f"Releasing holds of {cart_id} failed: {e}")
+        return 0
@@ -0,0 +1,90 @@
+# router.py
+#
+# Decides per recipe request whether the recipe agent is needed at all. The catalog is
+# Japanese, so a Japanese request is answered from the catalog record, with its
+# quantities scaled locally when other servings were asked for. Recipes the agent has
+# already translated are served from a shared cache. Only the rest goes to the LLM.
+
+import math
+import os
+import threading
+from collections import OrderedDict
+from Agent.catalog import get_recipe
+from Agent.facets import servings_value
+from Agent.text import language_code
+from tracing import register_metrics
+
+# Language of the recipe corpus
+CATALOG_LANGUAGE = "Japanese"
+TRANSLATION_CACHE_SIZE = int(os.getenv("RECIPE_TRANSLATION_CACHE_SIZE", "512"))
+ROUTES = ("catalog", "cache", "llm")
+
+route_counts = {route: 0 for route in ROUTES}
+
+
+class TranslationCache:
+    """Recipe agent outputs by cache_key, least recently used dropped first"""
+
+    def __init__(self, size=TRANSLATION_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        if value is None or self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+translation_cache = TranslationCache()
+
+
+def cache_key(recipe_id, language, servings=None, preferences_context=""):
+    # The recipe prompt carries the allergies and diet, so they are part of the answer
+    return recipe_id, language, servings, preferences_context
+
+
+def servings_scale(recipe_id, servings):
+    """Factor from the published servings to the requested ones, None if it cannot be computed"""
+    if not servings:
+        return 1
+    base_servings = servings_value(get_recipe(recipe_id))
+    if math.isnan(base_servings) or base_servings <= 0:
+        return None
+    return servings / base_servings
+
+
+def choose_route(recipe_id, language, servings=None, preferences_context=""):
+    """'catalog', 'cache' or 'llm' for a recipe request"""
+    if recipe_id is None:
+        return "llm"
+    if translation_cache.get(cache_key(recipe_id, language, servings, preferences_context)) is not None:
+        return "cache"
+    if language_code(language) == language_code(CATALOG_LANGUAGE) and servings_scale(recipe_id, servings) is not None:
+        return "catalog"
+    return "llm"
+
+
+def record_route(route):
+    route_counts[route] += 1
+
+
+@register_metrics
+def render_route_metrics():
+    lines = [
+        "# HELP recipe_requests_routed_total Recipe requests by how they were answered.",
+        "# TYPE recipe_requests_routed_total counter",
+    ]
+    lines += [f'recipe_requests_routed_total{{route="{route}"}} {route_counts[route]}' for route in ROUTES]
+    return lines
@@ -0,0 +1,292 @@
+# session_memory.py
+#
+# Keeps the in-process state of all sessions within a fixed memory budget. After every
+# request the session's history is capped, its agents' run memory trimmed and its state
+# measured. Large values that are only needed when the user comes back to them (resolved
+# recipes, product results, lists) live in a per-session cold store owned here rather
+# than in the session state; the cold values of idle sessions, or of the least recently
+# used ones once the budget is exceeded, are written to local disk and read back on use.
+
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from pydantic import BaseModel
+from Agent.usage import usage_ledger
+from Database.database import existing_sessions
+from tracing import register_metrics
+
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+# Messages of the chat history kept in memory, older ones are appended to disk
+SESSION_HISTORY_LIMIT = int(os.getenv("SESSION_HISTORY_LIMIT", "100"))
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "600"))
+# Sessions not seen for this long have ended (Streamlit never says so), they are
+# forgotten; their archived history is deleted once the session store no longer has them
+SESSION_EXPIRE_SECONDS = float(os.getenv("SESSION_EXPIRE_SECONDS", "3600"))
+EXPIRE_CHECK_INTERVAL = 60
+OFFLOAD_DIR = os.getenv("SESSION_OFFLOAD_DIR", "session_offload")
+# Agents build their context from the session history, their own run memory is not needed
+AGENT_MEMORY_RUNS = 1
+
+
+def estimate_size(value, seen=None):
+    """Approximate bytes held by a value and everything it references
+
+    Containers, pydantic models and agents' run memory are followed; other objects
+    count for their own size only, since they are usually shared between sessions.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key, seen) + estimate_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in value)
+    elif isinstance(value, BaseModel):
+        size += estimate_size(value.__dict__, seen)
+    elif isinstance(getattr(value, "memory", None), BaseModel):
+        size += estimate_size(value.memory, seen)
+    return size
+
+
+def trim_agent_memory(agent, keep_runs=AGENT_MEMORY_RUNS):
+    memory = getattr(agent, "memory", None)
+    if memory is None or not hasattr(memory, "runs"):
+        return
+    if len(memory.runs) > keep_runs:
+        memory.runs = memory.runs[-keep_runs:] if keep_runs else []
+    memory.messages = []
+
+
+class SessionMemoryManager:
+    def __init__(self, budget=SESSION_MEMORY_BUDGET, history_limit=SESSION_HISTORY_LIMIT,
+                 idle_seconds=SESSION_IDLE_SECONDS, expire_seconds=SESSION_EXPIRE_SECONDS, directory=OFFLOAD_DIR,
+                 stored_sessions=existing_sessions):
+        self.budget = budget
+        self.history_limit = history_limit
+        self.idle_seconds = idle_seconds
+        self.expire_seconds = expire_seconds
+        self.directory = directory
+        # Session ids -> those still in the session store, whose archived history is kept
+        self.stored_sessions = stored_sessions
+        self.last_expiry = time.monotonic()
+        # session id -> {"last_seen", "sizes" of the state, "cold" values, "cold_sizes", "offloaded",
+        # "offloading" while its cold values are written, "version" bumped on every change to them}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def path(self, session_id, suffix):
+        return os.path.join(self.directory, f"{session_id}.{suffix}")
+
+    def entry(self, session_id):
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            entry = self.sessions[session_id] = {
+                "last_seen": time.monotonic(), "sizes": {}, "cold": {}, "cold_sizes": {}, "offloaded": False,
+                "offloading": False, "version": 0,
+            }
+        return entry
+
+    def touch(self, session_id):
+        """Mark the session as active, for requests that neither track nor use its cold values"""
+        with self.lock:
+            self.entry(session_id)["last_seen"] = time.monotonic()
+
+    def get(self, session_id, key, default=None):
+        """A cold value of the session, read back from disk if it was offloaded"""
+        with self.lock:
+            entry = self.entry(session_id)
+            entry["last_seen"] = time.monotonic()
+            if entry["offloaded"]:
+                self.load_cold(session_id, entry)
+            return entry["cold"].get(key, default)
+
+    def set(self, session_id, key, value):
+        with self.lock:
+            entry = self.entry(session_id)
+            entry["last_seen"] = time.monotonic()
+            if entry["offloaded"]:
+                self.load_cold(session_id, entry)
+            entry["version"] += 1
+            if value is None:
+                entry["cold"].pop(key, None)
+                entry["cold_sizes"].pop(key, None)
+            else:
+                entry["cold"][key] = value
+                entry["cold_sizes"][key] = estimate_size(value)
+
+    def load_cold(self, session_id, entry):
+        path = self.path(session_id, "pkl")
+        try:
+            with open(path, "rb") as f:
+                cold = pickle.load(f)
+            os.remove(path)
+        except OSError as e:
+            print(f"Offloaded state of {session_id} not found: {e}")
+            cold = {}
+        entry["cold"] = cold
+        entry["cold_sizes"] = {key: estimate_size(value) for key, value in cold.items()}
+        entry["offloaded"] = False
+
+    def track(self, session_id, state):
+        """Cap and measure the session after a request, then keep all sessions within the budget"""
+        history = state.get("supervisor_history")
+        if history is not None and len(history) > self.history_limit:
+            self.archive_history(session_id, history[:-self.history_limit])
+            del history[:-self.history_limit]
+        for key in ("supervisor_agent", "recipe_agent"):
+            if key in state:
+                trim_agent_memory(state[key])
+
+        sizes = {key: estimate_size(state[key]) for key in list(state.keys())}
+        with self.lock:
+            entry = self.entry(session_id)
+            entry["sizes"] = sizes
+            entry["last_seen"] = time.monotonic()
+        self.expire_sessions()
+        self.enforce_budget(current=session_id)
+
+    def archive_history(self, session_id, messages):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(session_id, "history.jsonl"), "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(message, ensure_ascii=False, default=str) + "\n" for message in messages)
+
+    def offload(self, session_id):
+        """Write the cold values of a session to disk and drop them from memory, returns the bytes freed"""
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None or entry["offloaded"] or entry["offloading"] or not entry["cold"]:
+                return 0
+            entry["offloading"] = True
+            version, cold = entry["version"], dict(entry["cold"])
+        # Pickled outside the lock, other sessions' requests do not wait for the disk
+        path = self.path(session_id, "pkl")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = self.path(session_id, "pkl.tmp")
+            with open(temp_path, "wb") as f:
+                pickle.dump(cold, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except Exception:
+            with self.lock:
+                entry["offloading"] = False
+            raise
+        with self.lock:
+            entry["offloading"] = False
+            if self.sessions.get(session_id) is entry and entry["version"] == version:
+                freed = sum(entry["cold_sizes"].values())
+                entry.update(cold={}, cold_sizes={}, offloaded=True)
+                return freed
+            # Changed or forgotten while it was written, the file is stale
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return 0
+
+    def session_bytes(self, entry):
+        return sum(entry["sizes"].values()) + sum(entry["cold_sizes"].values())
+
+    def enforce_budget(self, current=None):
+        now = time.monotonic()
+        with self.lock:
+            total = sum(self.session_bytes(entry) for entry in self.sessions.values())
+            by_age = sorted((entry["last_seen"], session_id) for session_id, entry in self.sessions.items()
+                            if session_id != current and entry["cold"])
+        for last_seen, session_id in by_age:
+            if total <= self.budget and now - last_seen < self.idle_seconds:
+                break
+            try:
+                total -= self.offload(session_id)
+            except Exception as e:
+                print(f"Offloading session {session_id} failed: {e}")
+
+    def idle_sessions(self):
+        """Sessions not seen for idle_seconds, candidates for dropping whole"""
+        now = time.monotonic()
+        with self.lock:
+            return [session_id for session_id, entry in self.sessions.items()
+                    if now - entry["last_seen"] >= self.idle_seconds]
+
+    def forget(self, session_id, archive=False):
+        """Drop a session and its offloaded values; with archive, its archived history as well
+
+        Only sessions this process tracks have files deleted, other workers may share the directory.
+        """
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+        usage_ledger.forget(session_id)
+        if entry is None:
+            return
+        suffixes = (["pkl"] if entry["offloaded"] else []) + (["history.jsonl"] if archive else [])
+        for suffix in suffixes:
+            try:
+                os.remove(self.path(session_id, suffix))
+            except OSError:
+                pass
+
+    def expire_sessions(self, force=False):
+        """Forget sessions not seen for expire_seconds, with their archived history once the store has no row"""
+        now = time.monotonic()
+        if not force and now - self.last_expiry < EXPIRE_CHECK_INTERVAL:
+            return
+        self.last_expiry = now
+        with self.lock:
+            expired = [session_id for session_id, entry in self.sessions.items()
+                       if now - entry["last_seen"] >= self.expire_seconds]
+        if not expired:
+            return
+        # The archive is the only copy of older messages, it stays while the session can be restored
+        try:
+            stored = self.stored_sessions(expired)
+        except Exception as e:
+            print(f"Session store lookup failed, keeping archived history: {e}")
+            stored = set(expired)
+        for session_id in expired:
+            self.forget(session_id, archive=session_id not in stored)
+
+    def report(self, top=20):
+        """Memory per session, largest first, with the keys that hold most of it"""
+        now = time.monotonic()
+        with self.lock:
+            rows = [
+                {
+                    "session_id": session_id,
+                    "bytes": self.session_bytes(entry),
+                    "keys": dict(sorted({**entry["sizes"], **entry["cold_sizes"]}.items(),
+                                        key=lambda item: -item[1])[:5]),
+                    "idle_seconds": round(now - entry["last_seen"], 1),
+                    "offloaded": entry["offloaded"],
+                }
+                for session_id, entry in self.sessions.items()
+            ]
+        rows.sort(key=lambda row: -row["bytes"])
+        return {
+            "sessions": len(rows),
+            "offloaded": sum(1 for row in rows if row["offloaded"]),
+            "total_bytes": sum(row["bytes"] for row in rows),
+            "budget_bytes": self.budget,
+            "largest": rows[:top],
+        }
+
+
+memory_manager = SessionMemoryManager()
+
+
+@register_metrics
+def render_memory_metrics():
+    report = memory_manager.report(top=0)
+    return [
+        "# HELP recipe_session_memory_bytes Estimated memory held by session state.",
+        "# TYPE recipe_session_memory_bytes gauge",
+        f"recipe_session_memory_bytes {report['total_bytes']}",
+        "# HELP recipe_sessions Sessions tracked in this process.",
+        "# TYPE recipe_sessions gauge",
+        f'recipe_sessions{{state="active"}} {report["sessions"] - report["offloaded"]}',
+        f'recipe_sessions{{state="offloaded"}} {report["offloaded"]}',
+    ]
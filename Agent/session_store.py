@@ -0,0 +1,121 @@
+# session_store.py
+
+import atexit
+import json
+import threading
+import zlib
+from Agent.usage import usage_ledger
+from Database.database import load_session, save_sessions
+
+# Session state keys that survive a worker restart
+PERSISTED_KEYS = [
+    "supervisor_history", "dish_suggestions", "final_dish_choice", "ready_for_recipe",
+    "preferences", "preferences_collected", "cart_items", "mode", "usage",
+]
+
+FLUSH_INTERVAL = 5.0
+MAX_BATCH = 100
+
+
+def serialize_session(state):
+    """Compact JSON (no padding, no ASCII escaping of Japanese) compressed with zlib"""
+    data = {key: state[key] for key in PERSISTED_KEYS if key in state}
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+    return zlib.compress(payload.encode("utf-8"))
+
+
+def deserialize_session(data):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+class SessionWriter:
+    """Write-behind store: saves are buffered per session and flushed in batches
+
+    Several saves of the same session before a flush coalesce into one row, and a
+    flush writes every pending session in a single upsert, so chat turns never wait
+    on the database.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_batch=MAX_BATCH, save_rows=save_sessions):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.save_rows = save_rows
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="session-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def save(self, session_id, data):
+        with self.lock:
+            self.pending[session_id] = data
+            full = len(self.pending) >= self.max_batch
+        self.start()
+        if full:
+            self.wake.set()
+
+    def load(self, session_id):
+        with self.lock:
+            data = self.pending.get(session_id)
+        if data is None:
+            try:
+                data = load_session(session_id)
+            except Exception as e:
+                print(f"Session load failed: {e}")
+        return deserialize_session(data) if data else None
+
+    def flush(self):
+        with self.lock:
+            rows = list(self.pending.items())
+            self.pending = {}
+        if not rows:
+            return
+        try:
+            self.save_rows(rows)
+        except Exception as e:
+            print(f"Session flush failed: {e}")
+            # Put the rows back unless a newer save arrived in the meantime
+            with self.lock:
+                for session_id, data in rows:
+                    self.pending.setdefault(session_id, data)
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+
+session_writer = SessionWriter()
+
+
+def save_session_state(session_id, state):
+    """Queue the session for the next batched write, skipping it if nothing changed"""
+    usage = usage_ledger.session_usage(session_id)
+    if usage:
+        state["usage"] = usage
+    data = serialize_session(state)
+    digest = zlib.crc32(data)
+    if state.get("_saved_digest") == digest:
+        return
+    state["_saved_digest"] = digest
+    session_writer.save(session_id, data)
+
+
+def restore_session_state(session_id, state):
+    """Copy a persisted session into `state`, returns True if one was found"""
+    data = session_writer.load(session_id)
+    if not data:
+        return False
+    for key, value in data.items():
+        state[key] = value
+    # Budgets keep counting from where the session left off
+    usage_ledger.restore(session_id, data.get("usage"))
+    return True
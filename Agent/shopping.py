@@ -0,0 +1,160 @@
+# shopping.py
+#
+# Shopping list for several recipes at once. Ingredient lines of the selected catalog
+# recipes are reduced to canonical ingredients, their quantities parsed and summed per
+# ingredient and unit, and the merged list is matched against the products in a single
+# query and a single fuzzy matching pass.
+
+import math
+import re
+from fractions import Fraction
+from Agent.allergens import MEASURE_PATTERN, canonical_ingredient, normalize_text
+from Agent.catalog import get_recipe
+from Agent.facets import servings_value
+from Agent.product import format_matches, match_products, product_display_names
+from Agent.text import katakana_to_hiragana
+from tracing import traced
+from Database.database import search_products
+
+# Spoon and cup measures are summed as millilitres
+VOLUME_PREFIXES = {"大さじ": 15, "小さじ": 5}
+# Units the amount is written in front of, mapped to the unit they are summed in
+UNIT_FACTORS = {
+    "kg": ("g", 1000), "g": ("g", 1), "ml": ("ml", 1), "cc": ("ml", 1), "l": ("ml", 1000),
+    "カップ": ("ml", 200), "合": ("合", 1),
+}
+COUNT_UNITS = ["個", "本", "枚", "袋", "パック", "かけ", "片", "缶", "束", "切れ", "切", "尾", "株", "房", "玉", "丁", "杯", "cm"]
+QUANTITY_PATTERN = re.compile(
+    r"(?P<prefix>大さじ|小さじ|カップ)?\s*(?P<amount>\d+(?:\.\d+)?(?:\s*と\s*\d+/\d+)?(?:/\d+)?)"
+    # Ranges like '3～4本' are bought at the lower end
+    r"(?:\s*[～〜~-]\s*\d+(?:\.\d+)?)?\s*"
+    r"(?P<unit>kg|g|ml|cc|l(?![a-z])|カップ|合|" + "|".join(COUNT_UNITS) + r")?"
+)
+AMOUNT_PATTERN = re.compile(r"[\d０-９]+(?:[.．][\d０-９]+)?(?:\s*と\s*[\d０-９]+[/／][\d０-９]+)?(?:[/／][\d０-９]+)?")
+
+
+def parse_amount(text):
+    """'1と1/2' -> 1.5, '1/4' -> 0.25"""
+    total = Fraction(0)
+    for part in re.split(r"\s*と\s*", text):
+        total += Fraction(part)
+    return float(total)
+
+
+def parse_quantity(quantity):
+    """(amount, unit) of a quantity string, amount None for '適量', '少々' and the like"""
+    text = normalize_text(quantity).replace("：", "").replace(":", "")
+    match = QUANTITY_PATTERN.search(text)
+    if not match:
+        return None, text or None
+    amount = parse_amount(match["amount"])
+    prefix, unit = match["prefix"], match["unit"]
+    if prefix in VOLUME_PREFIXES:
+        return amount * VOLUME_PREFIXES[prefix], "ml"
+    if prefix == "カップ":
+        return amount * 200, "ml"
+    if unit in UNIT_FACTORS:
+        unit, factor = UNIT_FACTORS[unit]
+        return amount * factor, unit
+    return amount, unit or ""
+
+
+def scale_quantity(quantity, factor):
+    """Every amount in a quantity multiplied by factor, '大さじ1と1/2' x 2 -> '大さじ3'; '適量' stays as it is"""
+    return AMOUNT_PATTERN.sub(lambda match: f"{round(parse_amount(normalize_text(match[0])) * factor, 1):g}", quantity)
+
+
+def scale_ingredient(ingredient, factor):
+    """An ingredient line of a catalog recipe with its quantity scaled"""
+    name = ingredient.get("name", "") if isinstance(ingredient, dict) else str(ingredient)
+    quantity = (ingredient.get("quantity") if isinstance(ingredient, dict) else None) or ""
+    if not quantity:
+        # Most scrapes keep the amount in the name, 'アボカド1/2個', it starts at the first measure
+        match = MEASURE_PATTERN.search(name)
+        if match is None or factor == 1:
+            return name
+        return name[:match.start()] + scale_quantity(name[match.start():], factor)
+    scaled = scale_quantity(quantity, factor) if factor != 1 else quantity
+    # Scraped names usually end with the quantity, 'ごま油大さじ1'
+    if name.endswith(quantity):
+        return name[:-len(quantity)] + scaled
+    return f"{name} {scaled}"
+
+
+def ingredient_lines(recipe):
+    """(canonical name, quantity text) of every ingredient of a catalog recipe"""
+    for ingredient in recipe.get("ingredients", []):
+        raw_name = ingredient.get("name", "") if isinstance(ingredient, dict) else str(ingredient)
+        name = canonical_ingredient(raw_name)
+        if not name:
+            continue
+        quantity = ingredient.get("quantity") if isinstance(ingredient, dict) else None
+        # Some scrapes leave the quantity inside the name, e.g. 'ごま油大さじ1'
+        if not quantity:
+            quantity = normalize_text(raw_name)[len(name):] if normalize_text(raw_name).startswith(name) else ""
+        yield name, quantity
+
+
+def merge_ingredients(recipe_ids, servings=None):
+    """Ingredients of several recipes summed per canonical name and unit
+
+    With `servings`, each recipe is scaled from its published servings first. Returns
+    {name: {"amounts": {unit: total}, "notes": [...], "recipe_ids": [...]}} in first-seen order.
+    """
+    merged = {}
+    # 'タマネギ' and 'たまねぎ' are one line, shown with the spelling seen first
+    names = {}
+    for recipe_id in recipe_ids:
+        recipe = get_recipe(recipe_id)
+        if recipe is None:
+            continue
+        base_servings = servings_value(recipe)
+        scale = servings / base_servings if servings and not math.isnan(base_servings) else 1
+        for name, quantity in ingredient_lines(recipe):
+            name = names.setdefault(katakana_to_hiragana(name), name)
+            item = merged.setdefault(name, {"amounts": {}, "notes": [], "recipe_ids": []})
+            if recipe_id not in item["recipe_ids"]:
+                item["recipe_ids"].append(recipe_id)
+            amount, unit = parse_quantity(quantity)
+            if amount is None:
+                # '適量', '少々': nothing to add up, kept once as a note
+                if unit and unit not in item["notes"]:
+                    item["notes"].append(unit)
+                continue
+            item["amounts"][unit] = item["amounts"].get(unit, 0) + amount * scale
+    return merged
+
+
+def format_amounts(item):
+    parts = [f"{round(total, 1):g}{unit}" for unit, total in item["amounts"].items()]
+    return " + ".join(parts + item["notes"])
+
+
+@traced("shopping.list")
+def build_shopping_list(recipe_ids, language, is_vegan=None, servings=None, products_db=None):
+    """Merged ingredients of the recipes with the best matching product of each, one product query for all
+
+    Returns a list of {"ingredient", "amount", "recipe_ids", "product"} where product is None
+    when nothing in stock matches.
+    """
+    merged = merge_ingredients(recipe_ids, servings)
+    if products_db is None:
+        products_db = search_products(is_vegan=is_vegan)
+    products_db = [list(p) for p in products_db]
+
+    # Catalog ingredients are Japanese like the product names, so no translation is needed to match
+    names = list(merged)
+    best = match_products(names, products_db)
+
+    matched_rows = [products_db[index] for index in best if index is not None]
+    products = iter(format_matches(matched_rows, product_display_names(matched_rows, language)))
+
+    shopping_list = []
+    for name, index in zip(names, best):
+        shopping_list.append({
+            "ingredient": name,
+            "amount": format_amounts(merged[name]),
+            "recipe_ids": merged[name]["recipe_ids"],
+            "product": next(products) if index is not None else None,
+        })
+    return shopping_list
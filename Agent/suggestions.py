@@ -0,0 +1,111 @@
+# suggestions.py
+
+import json
+import re
+from collections import Counter
+from Agent.catalog import get_recipe, resolve_title
+from Agent.recipe import clean_recipe_name
+from tracing import register_metrics
+
+# How supervisor suggestions were resolved: `valid` matched the catalog as returned,
+# `repaired` were fixed locally by the title resolver, `dropped` could not be resolved
+# and `text_fallback` counts responses that were not structured and had to be parsed
+suggestion_stats = Counter()
+SUGGESTION_OUTCOMES = ("valid", "repaired", "dropped", "text_fallback")
+MESSAGE_START = re.compile(r'"message"\s*:\s*"')
+
+
+@register_metrics
+def render_suggestion_metrics():
+    lines = [
+        "# HELP recipe_suggestions_total Supervisor suggestions by how they were resolved against the catalog.",
+        "# TYPE recipe_suggestions_total counter",
+    ]
+    lines += [f'recipe_suggestions_total{{outcome="{outcome}"}} {suggestion_stats[outcome]}'
+              for outcome in SUGGESTION_OUTCOMES]
+    return lines
+
+
+def streamed_message(text):
+    """The `message` string decoded so far from a partial SupervisorResponse JSON, '' before it starts"""
+    match = MESSAGE_START.search(text)
+    if match is None:
+        return ""
+    end = match.end()
+    # Up to the closing quote, or to the last escape that has fully arrived
+    while end < len(text) and text[end] != '"':
+        if text[end] == "\\":
+            step = 6 if text[end + 1:end + 2] == "u" else 2
+            if end + step > len(text):
+                break
+            end += step
+        else:
+            end += 1
+    message = json.loads('"' + text[match.end():end] + '"')
+    # Half of a surrogate pair waits for the other half
+    if message and "\ud800" <= message[-1] <= "\udbff":
+        message = message[:-1]
+    return message
+
+
+def parse_suggestion_text(full_response):
+    """Extract suggestion lines after the "RECIPE SUGGESTIONS:" marker of a free text response"""
+    dish_suggestions = []
+    if "RECIPE SUGGESTIONS:" not in full_response:
+        return dish_suggestions
+
+    suggestion_section = full_response.split("RECIPE SUGGESTIONS:", 1)[1].strip()
+    for line in suggestion_section.splitlines():
+        line = line.strip()
+        if line:
+            # Remove common punctuation that might appear
+            if line.endswith((".", ",", ";", "?", "!", ":", "。", "、", "！", "？", "：", "；")):
+                line = line[:-1].strip()
+
+            line = clean_recipe_name(line)
+
+            if line and not line.lower().startswith(("if ", "when ", "please ", "let me")):
+                dish_suggestions.append(line)
+    return dish_suggestions
+
+
+def validate_suggestion(recipe_id, title):
+    """Return the catalog recipe id for one suggestion, repairing it locally when needed"""
+    recipe = get_recipe(recipe_id) if recipe_id is not None else None
+    if recipe is not None and (not title or recipe['title'].strip() == title.strip()):
+        suggestion_stats["valid"] += 1
+        return recipe_id
+
+    # The title is what the user will read, so it wins over a mismatched id
+    resolved_id = resolve_title(title)
+    if resolved_id is None and recipe is not None:
+        resolved_id = recipe_id
+    if resolved_id is None:
+        suggestion_stats["dropped"] += 1
+        return None
+    suggestion_stats["repaired"] += 1
+    return resolved_id
+
+
+def validate_suggestions(content, allowed_ids=None):
+    """Turn a supervisor response into (message, recipe ids) validated against the catalog"""
+    if hasattr(content, "suggestions"):
+        message = content.message
+        pairs = [(suggestion.recipe_id, suggestion.title) for suggestion in content.suggestions]
+    else:
+        # The model did not return the structured response, parse its text instead
+        suggestion_stats["text_fallback"] += 1
+        text = str(content or "")
+        message = text.split("RECIPE SUGGESTIONS:", 1)[0].strip()
+        pairs = [(None, line) for line in parse_suggestion_text(text)]
+
+    recipe_ids = []
+    for recipe_id, title in pairs:
+        resolved_id = validate_suggestion(recipe_id, title)
+        if resolved_id is None or resolved_id in recipe_ids:
+            continue
+        if allowed_ids is not None and resolved_id not in allowed_ids:
+            suggestion_stats["dropped"] += 1
+            continue
+        recipe_ids.append(resolved_id)
+    return message, recipe_ids
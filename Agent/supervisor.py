@@ -6,10 +6,12 @@ from typing import Dict, List
 import json
 from agno.knowledge.json import JSONKnowledgeBase
 from agno.vectordb.pgvector import PgVector
-from agno.models.openai import OpenAIChat
+from Agent.models import get_chat_model
 from deep_translator import GoogleTranslator
 import os
 from dotenv import load_dotenv
+from Agent.catalog import recipes as catalog_recipes
+from tracing import traced
 
 load_dotenv()
 
@@ -25,23 +27,21 @@ knowledge_base = JSONKnowledgeBase(
 )
 # Load the knowledge base
 knowledge_base.load(recreate=False)
+# Time the PgVector lookups the agents run through search_knowledge
+knowledge_base.vector_db.search = traced("pgvector.search")(knowledge_base.vector_db.search)
+knowledge_base.vector_db.async_search = traced("pgvector.search")(knowledge_base.vector_db.async_search)
+
+
+class RecipeSuggestion(BaseModel):
+    recipe_id: int
+    title: str
 
 
 class SupervisorResponse(BaseModel):
     message: str
-    suggestions: List[str]
+    suggestions: List[RecipeSuggestion]
 
 
-# Load the actual recipe data to ensure we have exact recipe titles
-def load_recipe_data(json_path="recipe_data/all_recipes.json"):
-    try:
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
-    except Exception as e:
-        print(f"Error loading recipe data: {e}")
-        return []
-
 # Extract all recipe titles with their English translations (if available)
 def extract_recipe_titles(recipe_data):
     titles_with_translations = []
@@ -56,34 +56,44 @@ def extract_recipe_titles(recipe_data):
 
     return titles_with_translations
 
-# Load the recipe data
-recipe_data = load_recipe_data()
+# The recipe data shared with the rest of the app (scrape failures already dropped)
+recipe_data = catalog_recipes
 
 # Extract the recipe titles
 recipe_titles = extract_recipe_titles(recipe_data)
 
-# Create a simple lookup set of just the Japanese titles for verification
-japanese_recipe_titles = {recipe.get('title', '') for recipe in recipe_data if recipe.get('title', '')}
+def format_catalog_lines(recipe_ids):
+    """One "id: title" line per recipe, the ids are what the supervisor returns"""
+    return "\n".join(f"{recipe_id}: {recipe_titles[recipe_id]}" for recipe_id in recipe_ids)
 
-def get_supervisor_agent():
-    agent = Agent(
-        name="Supervisor",
-        model=OpenAIChat(id="gpt-4o-mini"),
-        knowledge=knowledge_base,
-        search_knowledge=True,
-        read_chat_history=True,
-        system_message=f"""
+
+def set_supervisor_candidates(agent, recipe_ids=None):
+    """Restrict the recipes offered to the supervisor, None offers the whole catalog"""
+    if agent.session_state is None:
+        agent.session_state = {}
+    agent.session_state["candidate_recipe_ids"] = None if recipe_ids is None else sorted(recipe_ids)
+
+
+def build_supervisor_system_message(agent=None):
+    candidate_ids = None
+    if agent is not None and agent.session_state:
+        candidate_ids = agent.session_state.get("candidate_recipe_ids")
+    if candidate_ids is None:
+        candidate_ids = range(len(recipe_data))
+
+    # Recipes excluded by allergies, diet or cooking time never reach the prompt
+    catalog_lines = format_catalog_lines(candidate_ids)
+
+    return f"""
         You are a helpful recipe supervisor specializing in Japanese recipes. Your job is to help users find EXACT recipes from our database by matching keywords and ingredients.
 
-        IMPORTANT: 
-        - Our database contains ONLY the following Japanese recipe titles. You MUST ONLY suggest recipes from this exact list:
-        {', '.join(japanese_recipe_titles)}
-        - Formatted recipe titles with English translations (when available):
-        {recipe_titles}
+        IMPORTANT:
+        - Our database contains ONLY the following recipes, one per line as "recipe_id: Japanese title". You MUST ONLY suggest recipes from this exact list:
+        {catalog_lines}
         - ALWAY SUGGEST 5 RECIPES
 
         STRICT RULES:
-        1. You must ONLY suggest recipes with titles that EXACTLY match those in our database list above
+        1. You must ONLY suggest recipes whose recipe_id and title appear in our database list above
         2. NEVER create new recipe names or modify existing ones
         3. NEVER combine or reconstruct recipe names
         4. If no exact matches are found for the user's query, say so clearly and suggest recipes that might be similar based on available options
@@ -95,43 +105,40 @@ def get_supervisor_agent():
         4. ONLY suggest recipes that appear EXACTLY in the provided list
 
         RESPONSE FORMAT:
-        1. A brief conversational response
-        2. Clearly state whether you found exact matches or not
-        3. In the "RECIPE SUGGESTIONS:" section, list only recipes that exactly match titles in our database
-        4. Format: [Japanese title] ([English translation]) - if English translation is available
-        5. If no exact matches are found, clearly state this and suggest closest alternatives from our actual recipe list
+        - `message`: a brief conversational response in the user's language. Clearly state whether you found exact matches or not. Do not list the recipes here.
+        - `suggestions`: the suggested recipes, each with its `recipe_id` and its Japanese `title` copied exactly from the list
+        - If no exact matches are found, say so in `message` and suggest the closest alternatives from our actual recipe list
 
-        EXAMPLES:
+        EXAMPLE:
 
         User: "I want recipes with sakura (cherry blossom)"
         Your process:
         - Translate "sakura" to "桜" in Japanese
         - Search for recipes with "桜" in the title
-        - If none found exactly, do NOT create fake recipe names
-
-        DO NOT respond like this (INCORRECT):
-        "Here are some sakura recipes:
-        RECIPE SUGGESTIONS:
-        - ひんやりさくらアイスクリーム (Chilled Sakura Ice Cream)
-        - さくらのクレープ (Sakura Crepe)
-        - 桜の咲く特製のサラダ (Special Sakura Salad)"
-
-        Instead, respond like this (CORRECT):
-        "I searched for cherry blossom (桜) recipes in our database. While we don't have recipes with exactly 'sakura' or '桜' in the title, here are some traditional Japanese desserts from our collection:
-
-        RECIPE SUGGESTIONS:
-        - とろ〜りもちもち！みたらしだんご (Chewy Mitarashi Dango)
-        - 水信玄餅風和菓子 (Mizu Shingen Mochi Style Japanese Sweet)
-
-        Would you like me to recommend other traditional Japanese recipes instead?"
+        - If none found exactly, do NOT create fake recipe names. Instead say that there is no recipe with '桜' in the title and suggest traditional Japanese desserts from the list, such as みたらしだんご.
 
         FINAL REMINDERS:
-        - The recipes MUST have EXACT titles as they appear in our database
+        - The recipes MUST have EXACT titles and ids as they appear in our database
         - Do NOT invent or modify recipe names
         - If no exact match exists, be honest and suggest alternatives from our actual recipe list
         - Always verify that suggested recipes exist in our database before recommending them
-        """,
+        """
+
+
+def get_supervisor_agent():
+    agent = Agent(
+        name="Supervisor",
+        model=get_chat_model("gpt-4o-mini"),
+        knowledge=knowledge_base,
+        search_knowledge=True,
+        read_chat_history=True,
+        system_message=build_supervisor_system_message,
+        session_state={"candidate_recipe_ids": None},
+        response_model=SupervisorResponse,
+        structured_outputs=True,
+        # Otherwise agno turns stream=True into a blocking run; non-streaming runs are still parsed natively
+        parse_response=False,
         markdown=True,
         show_tool_calls=True
     )
-    return agent
\ No newline at end of file
+    return agent
@@ -0,0 +1,91 @@
+# text.py
+#
+# Script classification and normalization shared by everything that decides whether a
+# string needs translating. Scripts are counted with precompiled character classes, so
+# checking an ingredient or product name costs microseconds instead of a translator
+# round trip.
+
+import re
+import unicodedata
+
+HIRAGANA = r"\u3041-\u309f"
+# Full-width katakana with ー, its phonetic extensions and the half-width forms
+KATAKANA = r"\u30a0-\u30ff\u31f0-\u31ff\uff66-\uff9d"
+# CJK ideographs (extension A, unified, compatibility) and the iteration marks 々 and 〆
+KANJI = r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3005\u3006"
+# ASCII letters, Latin-1 and Latin Extended letters and full-width A-Z
+LATIN = r"A-Za-z\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u024f\uff21-\uff3a\uff41-\uff5a"
+
+KANA_PATTERN = re.compile(f"[{HIRAGANA}{KATAKANA}]")
+KANJI_PATTERN = re.compile(f"[{KANJI}]")
+JAPANESE_PATTERN = re.compile(f"[{HIRAGANA}{KATAKANA}{KANJI}]")
+LATIN_PATTERN = re.compile(f"[{LATIN}]")
+# Unit abbreviations after an amount, '200g', '1 tbsp', are not English words
+UNIT_PATTERN = re.compile(r"(?<=[0-9０-９])\s*(?:kg|mg|g|ml|cc|l|cm|mm|oz|lbs?|tsp|tbsp|kcal|cal)(?![A-Za-z])",
+                          re.IGNORECASE)
+
+# Text counts as Japanese when kana and kanji make up at least this share of its letters;
+# one kanji carries about as much as a short English word, so mixed names like
+# 'ツナ缶 (tuna)' stay Japanese
+JAPANESE_SHARE = 1 / 3
+
+LANGUAGE_CODES = {"japanese": "ja", "english": "en", "ja": "ja", "en": "en"}
+
+# Katakana ァ..ヶ to hiragana ぁ..ゖ, the blocks are 0x60 apart
+KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30a1, 0x30f7)}
+
+
+def script_counts(text):
+    """Characters of each script in a text: {'kana', 'kanji', 'latin'}, units after amounts not counted"""
+    text = normalize_width(text)
+    return {
+        "kana": len(KANA_PATTERN.findall(text)),
+        "kanji": len(KANJI_PATTERN.findall(text)),
+        "latin": len(LATIN_PATTERN.findall(UNIT_PATTERN.sub("", text))),
+    }
+
+
+def contains_japanese(text):
+    return JAPANESE_PATTERN.search(text or "") is not None
+
+
+def is_japanese(text):
+    """True if kana and kanji make up at least JAPANESE_SHARE of the letters"""
+    counts = script_counts(text)
+    japanese = counts["kana"] + counts["kanji"]
+    letters = japanese + counts["latin"]
+    return letters > 0 and japanese / letters >= JAPANESE_SHARE
+
+
+def language_code(language):
+    """'Japanese' -> 'ja', 'English' -> 'en', any other name or code lower-cased"""
+    language = (language or "").strip().lower()
+    return LANGUAGE_CODES.get(language, language)
+
+
+def needs_translation(text, target):
+    """False when a text is already in the target language (a name or a code), or has no words at all"""
+    code = language_code(target)
+    if code == "ja":
+        return script_counts(text)["latin"] > 0 and not is_japanese(text)
+    if code == "en":
+        return contains_japanese(text)
+    return bool((text or "").strip())
+
+
+def normalize_width(text):
+    """Full-width ASCII to ASCII and half-width katakana to full-width, 'ＡＢＣ１２' -> 'ABC12'"""
+    return unicodedata.normalize("NFKC", text or "")
+
+
+def normalize_text(text):
+    return normalize_width(text).lower().strip()
+
+
+def katakana_to_hiragana(text):
+    return (text or "").translate(KATAKANA_TO_HIRAGANA)
+
+
+def normalize_kana(text):
+    """normalize_text with katakana folded to hiragana, so 'タマネギ' and 'たまねぎ' compare equal"""
+    return katakana_to_hiragana(normalize_text(text))
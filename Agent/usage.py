@@ -0,0 +1,143 @@
+# usage.py
+#
+# Token and cost accounting for every agent run, aggregated per session, per agent and
+# per day. Sessions over their budget are served by local fallbacks in Agent.pipeline.
+
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from tracing import TraceExporter, current_session_id, register_metrics
+
+# USD per million tokens
+MODEL_PRICES = {
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+}
+
+# Per-session budgets, 0 means unlimited
+SESSION_TOKEN_BUDGET = int(os.getenv("USAGE_SESSION_TOKEN_BUDGET", "0"))
+SESSION_COST_BUDGET = float(os.getenv("USAGE_SESSION_COST_BUDGET", "0"))
+USAGE_FILE = os.getenv("USAGE_FILE")
+# UTC days whose totals are kept in memory, older ones are only in USAGE_FILE; 0 keeps all
+USAGE_DAYS_KEPT = int(os.getenv("USAGE_DAYS_KEPT", "7"))
+
+USAGE_FIELDS = ("calls", "input_tokens", "cached_tokens", "output_tokens", "cost_usd")
+
+
+def usage_from_metrics(metrics):
+    """Token counts of one run from agno's RunResponse.metrics (lists with one value per model call)"""
+    metrics = metrics or {}
+    cached_tokens = sum((details or {}).get("cached_tokens") or 0
+                        for details in metrics.get("prompt_tokens_details", []))
+    return {
+        "calls": len(metrics.get("input_tokens", [])),
+        "input_tokens": sum(metrics.get("input_tokens", [])),
+        "cached_tokens": cached_tokens,
+        "output_tokens": sum(metrics.get("output_tokens", [])),
+    }
+
+
+def cost_of(model_id, usage):
+    prices = MODEL_PRICES.get(model_id)
+    if prices is None:
+        return 0.0
+    uncached = usage["input_tokens"] - usage["cached_tokens"]
+    return (uncached * prices["input"] + usage["cached_tokens"] * prices["cached_input"]
+            + usage["output_tokens"] * prices["output"]) / 1_000_000
+
+
+class UsageLedger:
+    """Running token and cost totals per session, agent and UTC day"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = defaultdict(Counter)
+        self.agents = defaultdict(Counter)
+        self.days = defaultdict(Counter)
+        self.exporter = TraceExporter(USAGE_FILE) if USAGE_FILE else None
+
+    def record(self, session_id, agent_name, model_id, usage):
+        usage = dict(usage, cost_usd=cost_of(model_id, usage))
+        day = time.strftime("%Y-%m-%d", time.gmtime())
+        with self.lock:
+            if session_id is not None:
+                self.sessions[session_id].update(usage)
+            self.agents[agent_name].update(usage)
+            self.days[day].update(usage)
+            # ISO dates sort by age
+            for old_day in sorted(self.days)[:-USAGE_DAYS_KEPT]:
+                del self.days[old_day]
+        if self.exporter is not None:
+            self.exporter.export({"time": time.time(), "session_id": session_id, "agent": agent_name,
+                                  "model": model_id, **usage})
+        return usage
+
+    def session_usage(self, session_id):
+        with self.lock:
+            return {field: self.sessions[session_id][field] for field in USAGE_FIELDS} \
+                if session_id in self.sessions else {}
+
+    def restore(self, session_id, usage):
+        """Seed a session's totals from its persisted state, e.g. after a worker restart"""
+        with self.lock:
+            if session_id not in self.sessions and usage:
+                self.sessions[session_id].update(usage)
+
+    def forget(self, session_id):
+        """Drop an ended or evicted session's totals, its persisted state still carries them"""
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def over_budget(self, session_id):
+        if session_id is None:
+            return False
+        with self.lock:
+            totals = self.sessions.get(session_id)
+            if totals is None:
+                return False
+            tokens = totals["input_tokens"] + totals["output_tokens"]
+            return bool((SESSION_TOKEN_BUDGET and tokens >= SESSION_TOKEN_BUDGET)
+                        or (SESSION_COST_BUDGET and totals["cost_usd"] >= SESSION_COST_BUDGET))
+
+    def summary(self):
+        with self.lock:
+            return {
+                "agents": {name: dict(totals) for name, totals in self.agents.items()},
+                "days": {day: dict(totals) for day, totals in self.days.items()},
+                "sessions": len(self.sessions),
+            }
+
+
+usage_ledger = UsageLedger()
+
+
+def record_run(agent, run_response, session_id=None):
+    """Account the tokens of one agent run to the current session"""
+    if run_response is None:
+        return None
+    session_id = session_id or current_session_id.get()
+    model_id = agent.model.id if agent.model is not None else None
+    return usage_ledger.record(session_id, agent.name, model_id, usage_from_metrics(run_response.metrics))
+
+
+def session_over_budget(session_id=None):
+    return usage_ledger.over_budget(session_id or current_session_id.get())
+
+
+@register_metrics
+def render_usage_metrics():
+    summary = usage_ledger.summary()
+    lines = [
+        "# HELP recipe_llm_tokens_total Tokens used by agent runs.",
+        "# TYPE recipe_llm_tokens_total counter",
+    ]
+    costs = [
+        "# HELP recipe_llm_cost_usd_total Estimated cost of agent runs in USD.",
+        "# TYPE recipe_llm_cost_usd_total counter",
+    ]
+    for name, totals in sorted(summary["agents"].items()):
+        for kind in ("input_tokens", "cached_tokens", "output_tokens"):
+            lines.append(f'recipe_llm_tokens_total{{agent="{name}",kind="{kind[:-7]}"}} {totals.get(kind, 0)}')
+        costs.append(f'recipe_llm_cost_usd_total{{agent="{name}"}} {totals.get("cost_usd", 0):.6f}')
+    return lines + costs
@@ -1,3 +1,4 @@
+import httpx
 import requests
 from agno.agent import Agent
 from pydantic import BaseModel
@@ -8,7 +9,9 @@ from agno.vectordb.pgvector import PgVector
 from agno.models.openai import OpenAIChat
 from deep_translator import GoogleTranslator
 import os
+import time
 from dotenv import load_dotenv
+from tracing import traced
 
 load_dotenv()
 
@@ -61,17 +64,54 @@ def get_cities_in_country(country_name: str):
     else:
         return [] 
     
-def get_weather(city: str, country='JP'):
+def parse_weather(data):
+    return {
+        'temperature': data['main']['temp'],
+        'description': data['weather'][0]['description'],
+        'humidity': data['main']['humidity'],
+    }
+
+# Weather changes slowly, reruns and requests for the same city reuse the last answer
+WEATHER_TTL = float(os.getenv("WEATHER_TTL", "600"))
+weather_cache = {}
+
+def cached_weather(city, country):
+    entry = weather_cache.get((city, country))
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def cache_weather(city, country, weather):
+    if weather is not None:
+        weather_cache[(city, country)] = (time.monotonic() + WEATHER_TTL, weather)
+    return weather
+
+@traced("weather.fetch")
+def fetch_weather(city: str, country='JP'):
     url = f"{BASE_URL}?q={city},{country}&appid={API_KEY}&units=metric"
     response = requests.get(url)
     print('-----------response', response.text, response.status_code)
     if response.status_code == 200:
-        data = response.json()
-        weather = {
-            'temperature': data['main']['temp'],
-            'description': data['weather'][0]['description'],
-            'humidity': data['main']['humidity'],
-        }
-        return weather
+        return parse_weather(response.json())
     else:
         return None
+
+def get_weather(city: str, country='JP'):
+    return cached_weather(city, country) or cache_weather(city, country, fetch_weather(city, country))
+
+# One client per process so connections to the weather API are pooled and reused
+async_client = None
+
+@traced("weather.fetch")
+async def afetch_weather(city: str, country='JP'):
+    global async_client
+    if async_client is None:
+        async_client = httpx.AsyncClient(timeout=10)
+    response = await async_client.get(BASE_URL, params={"q": f"{city},{country}", "appid": API_KEY, "units": "metric"})
+    if response.status_code == 200:
+        return parse_weather(response.json())
+    else:
+        return None
+
+async def aget_weather(city: str, country='JP'):
+    return cached_weather(city, country) or cache_weather(city, country, await afetch_weather(city, country))
@@ -1,6 +1,9 @@
 import os
+import psycopg
 import psycopg2
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
+from tracing import traced
 
 load_dotenv()
 
@@ -10,6 +13,26 @@ db_password = os.getenv("DB_PASSWORD")
 db_name = os.getenv("DB_NAME")
 port = os.getenv("PORT")
 
+PRODUCT_COLUMNS = """product_name, tax, price, stock_quantity, category,
+                   weight, unit, brand, expiry_date, is_vegan"""
+
+# Supporting indexes for the product queries below. The partial index only covers
+# rows with stock, so the sellable scan never touches sold out products; the
+# column order matches DISTINCT ON + ORDER BY so Postgres can skip the sort.
+PRODUCT_INDEXES = [
+    """
+    CREATE INDEX IF NOT EXISTS products_sellable_idx
+    ON ai.products (product_name, expiry_date DESC NULLS LAST, stock_quantity DESC, brand)
+    WHERE stock_quantity > 0;
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS products_vegan_sellable_idx
+    ON ai.products (product_name, expiry_date DESC NULLS LAST, stock_quantity DESC, brand)
+    WHERE stock_quantity > 0 AND is_vegan;
+    """,
+]
+
+@traced("db.connect")
 def connect_to_postgres():
     try:
         conn = psycopg2.connect(
@@ -23,18 +46,354 @@ def connect_to_postgres():
     except Exception as e:
         raise Exception(f"Database connection error: {e}")
 
-def search_products():
+def build_product_query(in_stock=True, not_expired=True, is_vegan=None, after=None, limit=None, product_name=None):
+    """Build the product query and its parameters for the given filters"""
+    conditions = []
+    params = []
+    if in_stock:
+        conditions.append("stock_quantity > 0")
+    if not_expired:
+        conditions.append("(expiry_date IS NULL OR expiry_date >= CURRENT_DATE)")
+    if is_vegan is not None:
+        conditions.append("is_vegan = %s")
+        params.append(is_vegan)
+    if after is not None:
+        # Keyset paging: continue after the last product name of the previous page
+        conditions.append("product_name > %s")
+        params.append(after)
+    if product_name is not None:
+        conditions.append("product_name = %s")
+        params.append(product_name)
+
+    query = f"SELECT DISTINCT ON (product_name) {PRODUCT_COLUMNS} FROM ai.products"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    # The canonical row per product is the one that expires last, then the one with
+    # the most stock, then by brand, so the same row wins on every call.
+    query += " ORDER BY product_name, expiry_date DESC NULLS LAST, stock_quantity DESC, brand"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+@traced("db.search_products")
+def search_products(in_stock=True, not_expired=True, is_vegan=None, after=None, limit=None):
     try:
         conn = connect_to_postgres()
         cursor = conn.cursor()
-        query = """
-            SELECT DISTINCT ON (product_name) product_name, tax, price, stock_quantity, category,
-                   weight, unit, brand, expiry_date, is_vegan
-            FROM ai.products;
-        """
-        cursor.execute(query)
+        query, params = build_product_query(in_stock, not_expired, is_vegan, after, limit)
+        cursor.execute(query, params)
         rows = cursor.fetchall()
         conn.close()
         return rows
     except Exception as e:
         raise Exception(f"Product fetch error: {e}")
+
+@traced("db.connect")
+async def async_connect_to_postgres():
+    try:
+        return await psycopg.AsyncConnection.connect(
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=port
+        )
+    except Exception as e:
+        raise Exception(f"Database connection error: {e}")
+
+@traced("db.search_products")
+async def async_search_products(in_stock=True, not_expired=True, is_vegan=None, after=None, limit=None,
+                                product_name=None):
+    """Async variant of search_products on the psycopg 3 async driver, optionally for one product name"""
+    try:
+        conn = await async_connect_to_postgres()
+        async with conn:
+            cursor = conn.cursor()
+            query, params = build_product_query(in_stock, not_expired, is_vegan, after, limit, product_name)
+            await cursor.execute(query, params)
+            return await cursor.fetchall()
+    except Exception as e:
+        raise Exception(f"Product fetch error: {e}")
+
+def iter_product_pages(page_size=500, in_stock=True, not_expired=True, is_vegan=None):
+    """Yield the filtered products page by page using keyset paging on product_name"""
+    conn = connect_to_postgres()
+    try:
+        cursor = conn.cursor()
+        after = None
+        while True:
+            query, params = build_product_query(in_stock, not_expired, is_vegan, after, page_size)
+            try:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+            except Exception as e:
+                raise Exception(f"Product fetch error: {e}")
+            if not rows:
+                break
+            yield rows
+            if len(rows) < page_size:
+                break
+            after = rows[-1][0]
+    finally:
+        conn.close()
+
+def create_product_indexes():
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        for statement in PRODUCT_INDEXES:
+            cursor.execute(statement)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        raise Exception(f"Product index error: {e}")
+
+SESSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS ai.chat_sessions (
+        session_id TEXT PRIMARY KEY,
+        data BYTEA NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+def create_session_table():
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        cursor.execute(SESSION_TABLE)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        raise Exception(f"Session table error: {e}")
+
+@traced("db.save_sessions")
+def save_sessions(rows):
+    """Upsert many (session_id, data) rows in a single round trip"""
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        execute_values(
+            cursor,
+            """
+            INSERT INTO ai.chat_sessions (session_id, data) VALUES %s
+            ON CONFLICT (session_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now();
+            """,
+            [(session_id, psycopg2.Binary(data)) for session_id, data in rows],
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        raise Exception(f"Session save error: {e}")
+
+@traced("db.load_session")
+def load_session(session_id):
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        cursor.execute("SELECT data FROM ai.chat_sessions WHERE session_id = %s;", (session_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return bytes(row[0]) if row else None
+    except Exception as e:
+        raise Exception(f"Session load error: {e}")
+
+@traced("db.existing_sessions")
+def existing_sessions(session_ids):
+    """The subset of session ids that still have a row in ai.chat_sessions"""
+    if not session_ids:
+        return set()
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        cursor.execute("SELECT session_id FROM ai.chat_sessions WHERE session_id = ANY(%s);", (list(session_ids),))
+        rows = cursor.fetchall()
+        conn.close()
+        return {row[0] for row in rows}
+    except Exception as e:
+        raise Exception(f"Session lookup error: {e}")
+
+# Stock held for carts. Reserving decrements ai.products right away, so the sellable
+# product queries stop offering what is held; a hold records the exact row it came
+# from so releasing it puts the stock back on the same row.
+STOCK_HOLDS_TABLE = """
+    CREATE TABLE IF NOT EXISTS ai.stock_holds (
+        hold_id TEXT PRIMARY KEY,
+        cart_id TEXT NOT NULL,
+        product_name TEXT NOT NULL,
+        brand TEXT,
+        expiry_date DATE,
+        quantity INTEGER NOT NULL CHECK (quantity > 0),
+        expires_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS stock_holds_cart_idx ON ai.stock_holds (cart_id);
+    CREATE INDEX IF NOT EXISTS stock_holds_expires_idx ON ai.stock_holds (expires_at);
+"""
+
+# One statement decrements many products. Each product's row is picked in the CTE by
+# its (product_name, brand, expiry_date) key, the same key holds are released by: the
+# first row in canonical order (the one the product queries show) whose stock covers
+# the quantity, so a short canonical row does not fail a product that has duplicate
+# rows with enough stock. The stock check sits in the UPDATE's own
+# WHERE clause: when a concurrent reservation updated the row first, Postgres re-checks
+# it against the new row version, which still carries the same key, so the decrement
+# goes through if the stock still covers it and never drives it below zero. A ctid
+# would not survive that re-check, it changes with every row version. The updated rows
+# stay locked until the reservation transaction commits, right after its holds are
+# inserted.
+DECREMENT_STOCK = """
+    WITH requested (product_name, quantity) AS (VALUES %s),
+    chosen AS (
+        SELECT DISTINCT ON (p.product_name) p.product_name, p.brand, p.expiry_date
+        FROM ai.products p JOIN requested r ON r.product_name = p.product_name
+        WHERE p.stock_quantity > 0 AND (p.expiry_date IS NULL OR p.expiry_date >= CURRENT_DATE)
+        ORDER BY p.product_name, p.stock_quantity >= r.quantity DESC,
+                 p.expiry_date DESC NULLS LAST, p.stock_quantity DESC, p.brand
+    )
+    UPDATE ai.products p
+    SET stock_quantity = p.stock_quantity - r.quantity
+    FROM chosen c JOIN requested r ON r.product_name = c.product_name
+    WHERE p.product_name = c.product_name
+      AND p.brand IS NOT DISTINCT FROM c.brand
+      AND p.expiry_date IS NOT DISTINCT FROM c.expiry_date
+      AND p.stock_quantity >= r.quantity
+    RETURNING p.product_name, p.brand, p.expiry_date;
+"""
+
+# Deleting holds and putting their stock back is one statement, rows are skipped when
+# another worker is already releasing them
+RELEASE_HOLDS = """
+    WITH released AS (
+        DELETE FROM ai.stock_holds
+        WHERE hold_id IN (
+            SELECT hold_id FROM ai.stock_holds WHERE {condition}
+            ORDER BY expires_at LIMIT %(limit)s FOR UPDATE SKIP LOCKED
+        )
+        RETURNING product_name, brand, expiry_date, quantity
+    ),
+    totals AS (
+        SELECT product_name, brand, expiry_date, sum(quantity) AS quantity
+        FROM released GROUP BY product_name, brand, expiry_date
+    ),
+    restocked AS (
+        UPDATE ai.products p
+        SET stock_quantity = p.stock_quantity + t.quantity
+        FROM totals t
+        WHERE p.product_name = t.product_name
+          AND p.brand IS NOT DISTINCT FROM t.brand
+          AND p.expiry_date IS NOT DISTINCT FROM t.expiry_date
+    )
+    SELECT coalesce(sum(quantity), 0) FROM released;
+"""
+
+def create_stock_holds_table():
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        cursor.execute(STOCK_HOLDS_TABLE)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        raise Exception(f"Stock holds table error: {e}")
+
+def decrement_stock(cursor, quantities):
+    """Conditionally decrement {product_name: quantity}, returns {product_name: (brand, expiry_date)} that succeeded"""
+    rows = execute_values(cursor, DECREMENT_STOCK, list(quantities.items()), page_size=max(len(quantities), 1),
+                          fetch=True)
+    return {name: (brand, expiry_date) for name, brand, expiry_date in rows}
+
+@traced("db.reserve_stock")
+def reserve_stock(requests, ttl_seconds):
+    """Hold stock for many (hold_id, cart_id, product_name, quantity) requests in one transaction
+
+    Quantities are summed per product and decremented in a single statement. Products
+    that cannot cover the whole batch are retried request by request in arrival order,
+    so the batch only fails what stock really cannot cover. Each hold records the row its
+    own decrement came from. Returns the granted hold ids.
+    """
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        totals = {}
+        for _, _, product_name, quantity in requests:
+            totals[product_name] = totals.get(product_name, 0) + quantity
+        sources = decrement_stock(cursor, totals)
+        granted = [(request, sources[request[2]]) for request in requests if request[2] in sources]
+        for request in requests:
+            if request[2] in sources:
+                continue
+            # Retried requests of a product may each come from a different row
+            source = decrement_stock(cursor, {request[2]: request[3]}).get(request[2])
+            if source is not None:
+                granted.append((request, source))
+        if granted:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO ai.stock_holds (hold_id, cart_id, product_name, brand, expiry_date, quantity, expires_at)
+                VALUES %s;
+                """,
+                [(hold_id, cart_id, product_name, *source, quantity)
+                 for (hold_id, cart_id, product_name, quantity), source in granted],
+                template=f"(%s, %s, %s, %s, %s, %s, now() + interval '{int(ttl_seconds)} seconds')",
+            )
+        conn.commit()
+        conn.close()
+        return {request[0] for request, _ in granted}
+    except Exception as e:
+        raise Exception(f"Stock reservation error: {e}")
+
+@traced("db.commit_holds")
+def commit_holds(cart_id):
+    """Turn the live holds of a cart into sales, returns {product_name: quantity} committed
+
+    The stock was already decremented when it was held, so committing only drops the
+    holds. Expired holds are not committed, the releaser puts their stock back.
+    """
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            DELETE FROM ai.stock_holds WHERE cart_id = %s AND expires_at >= now()
+            RETURNING product_name, quantity;
+            """,
+            (cart_id,),
+        )
+        committed = {}
+        for product_name, quantity in cursor.fetchall():
+            committed[product_name] = committed.get(product_name, 0) + quantity
+        conn.commit()
+        conn.close()
+        return committed
+    except Exception as e:
+        raise Exception(f"Stock commit error: {e}")
+
+@traced("db.release_holds")
+def release_holds(cart_id=None, expired=False, limit=1000):
+    """Delete the holds of a cart, or expired holds, and restock them; returns the units released"""
+    if cart_id is not None:
+        condition, params = "cart_id = %(cart_id)s", {"cart_id": cart_id, "limit": limit}
+    elif expired:
+        condition, params = "expires_at < now()", {"limit": limit}
+    else:
+        raise ValueError("release_holds needs a cart_id or expired=True")
+    try:
+        conn = connect_to_postgres()
+        cursor = conn.cursor()
+        cursor.execute(RELEASE_HOLDS.format(condition=condition), params)
+        released = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+        return int(released)
+    except Exception as e:
+        raise Exception(f"Stock release error: {e}")
+
+
+# Run as a module from the project root, python -m Database.database, so the top-level
+# tracing module is importable
+if __name__ == "__main__":
+    create_product_indexes()
+    create_session_table()
+    create_stock_holds_table()
+    print("Product indexes, session table and stock holds table created")
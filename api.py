@@ -0,0 +1,458 @@
+# api.py
+#
+# Headless HTTP API for the suggestion, recipe, product and cart pipelines.
+# Run with `python api.py --port=8080`. With --processes=N every worker listens on its own
+# port (8080 .. 8080+N-1) and keeps its sessions in memory, so a proxy in front must send
+# all requests of a session to the same port.
+
+import asyncio
+import json
+import math
+import os
+import uuid
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+import tornado.web
+from tornado.options import define, options
+
+from Agent.basket import cheapest_basket, fill_cart
+from Agent.cart import add_item_to_cart, display_cart_summary
+from Agent.catalog import get_recipe, resolve_title
+from Agent.media import MEDIA_DIR, media_cache, recipe_image
+from Agent.nutrition import MAX_PLAN_RECIPES
+from Agent.pipeline import aget_recipe_details, asuggest_recipes, plan_meals
+from Agent.product import aget_available_ingredients, format_matches
+from Agent.recipe import get_agent
+from Agent.reservations import ReservationError, checkout, release
+from Agent.session_memory import memory_manager
+from Agent.session_store import restore_session_state, save_session_state
+from Agent.shopping import build_shopping_list
+from Agent.supervisor import get_supervisor_agent
+from tracing import record_span, render_prometheus, start_request
+from Agent.weather import aget_weather
+from Database.database import async_search_products
+
+define("port", default=8080, help="port to listen on", type=int)
+define("processes", default=1, help="worker processes on consecutive ports, 0 means one per CPU core", type=int)
+
+DEFAULT_PREFERENCES = {
+    "taste": None,
+    "cooking_time": None,
+    "ingredients": [],
+    "allergies": [],
+    "diet": None
+}
+
+sessions = {}
+# session id -> task restoring it
+restoring = {}
+
+
+def build_session_state(session_id):
+    """A session's state restored from the session store, with fresh agents; blocks on the database"""
+    state = {
+        "supervisor_history": [],
+        "dish_suggestions": [],
+        "cart_items": [],
+        "preferences": dict(DEFAULT_PREFERENCES),
+        "preferences_collected": False,
+    }
+    restore_session_state(session_id, state)
+    state["supervisor_agent"] = get_supervisor_agent()
+    state["recipe_agent"] = get_agent()
+    memory_manager.track(session_id, state)
+    return state
+
+
+async def restore_session(session_id):
+    state = await asyncio.to_thread(build_session_state, session_id)
+    # Agents are not safe to share between concurrent runs, one request per session at a time
+    state["lock"] = asyncio.Lock()
+    sessions[session_id] = state
+    return state
+
+
+async def get_session(session_id):
+    """The per-session state and agents, restored from the session store off the event loop on first use"""
+    evict_idle_sessions()
+    session = sessions.get(session_id)
+    if session is None:
+        # Concurrent first requests of a session share one restore
+        task = restoring.get(session_id)
+        if task is None:
+            task = restoring[session_id] = asyncio.ensure_future(restore_session(session_id))
+            task.add_done_callback(lambda _: restoring.pop(session_id, None))
+        session = await task
+    # Read-only requests keep the session active too
+    memory_manager.touch(session_id)
+    return session
+
+
+def store_session(session_id, session):
+    save_session_state(session_id, session)
+    memory_manager.track(session_id, session)
+
+
+def evict_idle_sessions():
+    """Drop idle sessions from memory, they are persisted and restored on their next request"""
+    for session_id in memory_manager.idle_sessions():
+        session = sessions.get(session_id)
+        if session is not None and session["lock"].locked():
+            continue
+        sessions.pop(session_id, None)
+        memory_manager.forget(session_id)
+
+
+def is_number(value):
+    # JSON true/false arrive as bool, which is an int subclass
+    return not isinstance(value, bool) and isinstance(value, (int, float)) and math.isfinite(value)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        self.body = {}
+        if self.request.body:
+            try:
+                self.body = json.loads(self.request.body)
+            except json.JSONDecodeError:
+                raise tornado.web.HTTPError(400, reason="Body must be JSON")
+            if not isinstance(self.body, dict):
+                raise tornado.web.HTTPError(400, reason="Body must be a JSON object")
+        # Proxies route sessions to their worker by this header, it stands in for a missing body field
+        header_session_id = self.request.headers.get("X-Session-Id")
+        if header_session_id:
+            self.body.setdefault("session_id", header_session_id)
+        session_id = self.path_args[0] if self.path_args else self.body.get("session_id")
+        start_request(session_id)
+
+    def on_finish(self):
+        record_span(f"api.{self.__class__.__name__}", self.request.request_time(), self.get_status() >= 500,
+                    status=self.get_status())
+
+    def int_field(self, name, default=None, minimum=1):
+        """An integer body field of at least `minimum`, `default` when it is missing; 400 otherwise"""
+        value = self.body.get(name)
+        if value is None:
+            return default
+        if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+            raise tornado.web.HTTPError(400, reason=f"{name} must be an integer")
+        try:
+            number = int(value)
+        except (TypeError, ValueError, OverflowError):
+            raise tornado.web.HTTPError(400, reason=f"{name} must be an integer")
+        if number < minimum:
+            raise tornado.web.HTTPError(400, reason=f"{name} must be at least {minimum}")
+        return number
+
+    def number_field(self, name):
+        """A numeric body field, None when it is missing; 400 otherwise"""
+        value = self.body.get(name)
+        if value is None:
+            return None
+        if not is_number(value):
+            raise tornado.web.HTTPError(400, reason=f"{name} must be a number")
+        return value
+
+    def preferences_field(self):
+        """The body's preferences over the defaults, None when the body has none"""
+        preferences = self.body.get("preferences")
+        if preferences is None:
+            return None
+        if not isinstance(preferences, dict):
+            raise tornado.web.HTTPError(400, reason="preferences must be an object")
+        return {**DEFAULT_PREFERENCES, **preferences}
+
+    def titles_field(self):
+        titles = self.body.get("titles")
+        if not titles:
+            raise tornado.web.HTTPError(400, reason="titles is required")
+        if not isinstance(titles, list) or not all(isinstance(title, str) for title in titles):
+            raise tornado.web.HTTPError(400, reason="titles must be a list of strings")
+        return titles
+
+    def write_json(self, data):
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json.dumps(data, ensure_ascii=False, default=str))
+
+    async def write_event(self, event, **data):
+        """Write one NDJSON line and flush it to the client right away"""
+        self.write(json.dumps({"event": event, **data}, ensure_ascii=False, default=str) + "\n")
+        await self.flush()
+
+    def start_stream(self):
+        self.set_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.set_header("Cache-Control", "no-cache")
+
+    def write_error(self, status_code, **kwargs):
+        self.write_json({"error": self._reason})
+
+
+class HealthHandler(BaseHandler):
+    def get(self):
+        self.write_json({"status": "ok"})
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        # Stages are counted per worker process, with --processes every worker port is scraped
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render_prometheus())
+
+
+class SessionMemoryHandler(BaseHandler):
+    def get(self):
+        # Like /metrics, the report covers the worker process behind this port
+        try:
+            top = int(self.get_argument("top", "20"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="top must be an integer")
+        self.write_json(memory_manager.report(top=top))
+
+
+class SuggestHandler(BaseHandler):
+    async def post(self):
+        user_input = self.body.get("message")
+        if not user_input:
+            raise tornado.web.HTTPError(400, reason="message is required")
+        language = self.body.get("language", "English")
+        session_id = self.body.get("session_id") or uuid.uuid4().hex
+        preferences = self.preferences_field()
+        session = await get_session(session_id)
+        if preferences is not None:
+            session["preferences"] = preferences
+            session["preferences_collected"] = True
+
+        self.start_stream()
+        await self.write_event("session", session_id=session_id)
+
+        weather_data = None
+        if self.body.get("city") and self.body.get("country"):
+            weather_data = await aget_weather(self.body["city"], self.body["country"])
+            if weather_data:
+                await self.write_event("weather", **weather_data)
+
+        async with session["lock"]:
+            history = session["supervisor_history"]
+            history.append({"role": "user", "content": user_input, "language": language})
+            full_response, dish_suggestions = await asuggest_recipes(
+                session["supervisor_agent"], history, user_input, language,
+                session["preferences"], session["preferences_collected"], weather_data
+            )
+            history.append({"role": "assistant", "content": full_response})
+            if dish_suggestions:
+                session["dish_suggestions"] = dish_suggestions
+            store_session(session_id, session)
+
+        await self.write_event("message", content=full_response.split("\n\nRECIPE SUGGESTIONS:", 1)[0])
+        for title in dish_suggestions:
+            await self.write_event("suggestion", title=title)
+        await self.write_event("done")
+
+
+class RecipeHandler(BaseHandler):
+    async def post(self):
+        title = self.body.get("title")
+        if not title:
+            raise tornado.web.HTTPError(400, reason="title is required")
+        language = self.body.get("language", "English")
+        session_id = self.body.get("session_id") or uuid.uuid4().hex
+        session = await get_session(session_id)
+
+        async with session["lock"]:
+            recipe = await aget_recipe_details(
+                session["recipe_agent"], title, language,
+                session["preferences"], session["preferences_collected"], session["supervisor_history"]
+            )
+        if recipe is None:
+            raise tornado.web.HTTPError(404, reason=f"No recipe found for {title}")
+        recipe_id = resolve_title(title)
+        image_path, image_url = recipe_image(get_recipe(recipe_id) if recipe_id is not None else None)
+        if image_path:
+            image_url = f"/media/{os.path.basename(image_path)}"
+        elif image_url:
+            media_cache.prefetch([image_url])
+        self.write_json({"session_id": session_id, "recipe": recipe.model_dump(), "image_url": image_url})
+
+
+class MealPlanHandler(BaseHandler):
+    async def post(self):
+        session_id = self.body.get("session_id") or uuid.uuid4().hex
+        session = await get_session(session_id)
+        preferences, preferences_collected = self.preferences_field(), True
+        if preferences is None:
+            preferences, preferences_collected = session["preferences"], session["preferences_collected"]
+        calories = self.body.get("calories")
+        if calories is not None and not (isinstance(calories, list) and len(calories) == 2
+                                         and all(is_number(value) for value in calories)):
+            raise tornado.web.HTTPError(400, reason="calories must be [low, high]")
+        count = self.int_field("count", 3)
+        if count > MAX_PLAN_RECIPES:
+            raise tornado.web.HTTPError(400, reason=f"count must be between 1 and {MAX_PLAN_RECIPES}")
+        servings = self.int_field("servings", 1)
+        # The combination search is NumPy work, keep it off the event loop
+        plan = await asyncio.to_thread(
+            plan_meals, preferences, preferences_collected, count, calories,
+            self.number_field("min_protein"), self.number_field("max_salt"), servings,
+        )
+        if plan is None:
+            raise tornado.web.HTTPError(404, reason="Not enough recipes with nutrient data")
+        self.write_json({"session_id": session_id, "plan": plan})
+
+
+class ProductsHandler(BaseHandler):
+    async def post(self):
+        ingredients = self.body.get("ingredients")
+        if not ingredients:
+            raise tornado.web.HTTPError(400, reason="ingredients is required")
+        language = self.body.get("language", "English")
+        is_vegan = True if self.body.get("vegan") else None
+
+        self.start_stream()
+        products = await aget_available_ingredients(ingredients, language, is_vegan)
+        for product in products:
+            await self.write_event("product", **product)
+        await self.write_event("done", count=len(products))
+
+
+class ShoppingListHandler(BaseHandler):
+    async def post(self):
+        titles = self.titles_field()
+        recipe_ids = [resolve_title(title) for title in titles]
+        unknown = [title for title, recipe_id in zip(titles, recipe_ids) if recipe_id is None]
+        if unknown:
+            raise tornado.web.HTTPError(404, reason=f"No recipe found for {', '.join(unknown)}")
+        language = self.body.get("language", "English")
+        is_vegan = True if self.body.get("vegan") else None
+        servings = self.int_field("servings")
+
+        products_db = await async_search_products(is_vegan=is_vegan)
+        # Matching and translating the product names block, keep them off the event loop
+        items = await asyncio.to_thread(build_shopping_list, recipe_ids, language, is_vegan,
+                                        servings, products_db)
+        self.write_json({"items": items})
+
+
+class BasketHandler(BaseHandler):
+    async def post(self):
+        titles = self.titles_field()
+        recipe_ids = [resolve_title(title) for title in titles]
+        unknown = [title for title, recipe_id in zip(titles, recipe_ids) if recipe_id is None]
+        if unknown:
+            raise tornado.web.HTTPError(404, reason=f"No recipe found for {', '.join(unknown)}")
+        language = self.body.get("language", "English")
+        is_vegan = True if self.body.get("vegan") else None
+        servings = self.int_field("servings")
+
+        products_db = await async_search_products(is_vegan=is_vegan)
+        basket = await asyncio.to_thread(cheapest_basket, recipe_ids, language, is_vegan,
+                                         servings, products_db)
+        # With a session id the basket goes straight into that session's cart
+        session_id = self.body.get("session_id")
+        if session_id and self.body.get("add_to_cart"):
+            session = await get_session(session_id)
+            async with session["lock"]:
+                try:
+                    basket["unavailable"] = await asyncio.to_thread(fill_cart, basket, session["cart_items"],
+                                                                    session_id)
+                except ReservationError as e:
+                    raise tornado.web.HTTPError(503, reason=str(e))
+                finally:
+                    store_session(session_id, session)
+        self.write_json({"session_id": session_id, **basket})
+
+
+class CartHandler(BaseHandler):
+    def write_cart(self, session_id, session):
+        self.write_json({
+            "session_id": session_id,
+            "items": session["cart_items"],
+            "summary": display_cart_summary(session["cart_items"]),
+        })
+
+    async def get(self, session_id):
+        self.write_cart(session_id, await get_session(session_id))
+
+    async def post(self, session_id):
+        product_name = self.body.get("product_name")
+        if not product_name or not isinstance(product_name, str):
+            raise tornado.web.HTTPError(400, reason="product_name is required")
+        quantity = self.int_field("quantity", 1)
+        # Price, tax and weight come from the catalog, never from the client
+        rows = await async_search_products(product_name=product_name, limit=1)
+        if not rows:
+            raise tornado.web.HTTPError(404, reason=f"No product {product_name} in stock")
+        product = format_matches(rows)[0]
+        session = await get_session(session_id)
+        # Cart changes hold the session lock, so they do not interleave and the session is not evicted meanwhile
+        async with session["lock"]:
+            # The reservation waits for its batch, off the event loop
+            try:
+                added = await asyncio.to_thread(add_item_to_cart, product, quantity,
+                                                session["cart_items"], session_id)
+            except ReservationError as e:
+                raise tornado.web.HTTPError(503, reason=str(e))
+            if not added:
+                raise tornado.web.HTTPError(409, reason=f"Not enough {product.get('Product_name')} in stock")
+            store_session(session_id, session)
+            self.write_cart(session_id, session)
+
+    async def delete(self, session_id):
+        session = await get_session(session_id)
+        async with session["lock"]:
+            session["cart_items"] = []
+            await asyncio.to_thread(release, session_id)
+            store_session(session_id, session)
+            self.write_cart(session_id, session)
+
+
+class CheckoutHandler(BaseHandler):
+    async def post(self, session_id):
+        session = await get_session(session_id)
+        async with session["lock"]:
+            if not session["cart_items"]:
+                raise tornado.web.HTTPError(400, reason="cart is empty")
+            try:
+                unavailable = await asyncio.to_thread(checkout, session_id, session["cart_items"])
+            except ReservationError as e:
+                raise tornado.web.HTTPError(503, reason=str(e))
+            summary = display_cart_summary(session["cart_items"])
+            session["cart_items"] = []
+            store_session(session_id, session)
+        self.write_json({"session_id": session_id, "summary": summary, "unavailable": unavailable})
+
+
+def make_app():
+    return tornado.web.Application([
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/sessions/memory", SessionMemoryHandler),
+        (r"/suggest", SuggestHandler),
+        (r"/recipe", RecipeHandler),
+        (r"/meal-plan", MealPlanHandler),
+        (r"/products", ProductsHandler),
+        (r"/shopping-list", ShoppingListHandler),
+        (r"/basket", BasketHandler),
+        (r"/cart/([\w-]+)", CartHandler),
+        (r"/cart/([\w-]+)/checkout", CheckoutHandler),
+        # Thumbnails are named by content hash, a changed image is served under a new URL
+        (r"/media/(.*)", tornado.web.StaticFileHandler, {"path": MEDIA_DIR}),
+    ])
+
+
+async def serve(sockets):
+    server = tornado.httpserver.HTTPServer(make_app())
+    server.add_sockets(sockets)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    options.parse_command_line()
+    port = options.port
+    if options.processes != 1:
+        # A session's state lives in the memory of one worker and reaches the session store
+        # only with the next write-behind flush, so workers must not share a socket where
+        # any of them could accept the session's next request
+        port += tornado.process.fork_processes(options.processes)
+    asyncio.run(serve(tornado.netutil.bind_sockets(port)))
@@ -1,6 +1,11 @@
+import os
+import uuid
 import streamlit as st
 from Agent.recipe import get_agent
+from Agent.session_memory import memory_manager
+from Agent.session_store import restore_session_state, save_session_state
 from Agent.supervisor import get_supervisor_agent
+from tracing import serve_metrics, span, start_request
 from streamlit_app.streamlit_welcom import display_welcome_message
 from streamlit_app.streamlit_product import get_product_suggestions
 from streamlit_app.streamlit_recipe import get_recipe_suggestions
@@ -16,6 +21,19 @@ language = st.sidebar.selectbox("Choose your preferred language:", language_opti
 
 display_welcome_message(language)
 
+# Session Persistence: the session id is kept in the URL, so reloading the page after a
+# worker restart restores the conversation from the database
+if "session_id" not in st.session_state:
+    session_id = st.query_params.get("session_id") or uuid.uuid4().hex
+    st.query_params["session_id"] = session_id
+    st.session_state.session_id = session_id
+    restore_session_state(session_id, st.session_state)
+
+# Every rerun is one traced request of this session, TRACE_METRICS_PORT exposes /metrics
+start_request(st.session_state.session_id)
+if os.getenv("TRACE_METRICS_PORT"):
+    serve_metrics(int(os.getenv("TRACE_METRICS_PORT")))
+
 # Session State Initialization
 if "recipe_agent" not in st.session_state:
     st.session_state.recipe_agent = get_agent()
@@ -31,8 +49,6 @@ if "ready_for_recipe" not in st.session_state:
     st.session_state.ready_for_recipe = False
 if "cart_items" not in st.session_state:
     st.session_state.cart_items = []
-if "available_ingredients" not in st.session_state:
-    st.session_state.available_ingredients = []
 if "last_added" not in st.session_state:
     st.session_state.last_added = None
 if "dish_suggestions" not in st.session_state:
@@ -56,9 +72,15 @@ if "mode" not in st.session_state:
 
 
 
-if st.session_state.mode == 'recipe':
-    get_recipe_suggestions(language)
+with span("streamlit.script", mode=st.session_state.mode):
+    if st.session_state.mode == 'recipe':
+        get_recipe_suggestions(language)
+
+    if st.session_state.mode == 'product':
+        get_product_suggestions(language)
+    
 
-if st.session_state.mode == 'product':
-    get_product_suggestions(language)
-    
\ No newline at end of file
+# Queue the session for the next batched write, the database is never hit inline
+save_session_state(st.session_state.session_id, st.session_state)
+# Cap the history and keep idle sessions' cold data on disk, within the memory budget
+memory_manager.track(st.session_state.session_id, st.session_state)
@@ -0,0 +1,96 @@
+# fakes.py
+#
+# Offline stand-ins for Postgres, the translator, the weather API and OpenAI, so the
+# core functions can be timed without network or database access.
+
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import Agent.product as product_module
+import Agent.weather as weather_module
+
+
+class FakeTranslator:
+    """Returns the text unchanged after an optional simulated round trip"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, text, target):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return text
+
+
+class FakeProductStore:
+    """Applies the same filters as Database.database.search_products to in-memory rows"""
+
+    def __init__(self, rows, latency=0.0):
+        self.rows = rows
+        self.latency = latency
+
+    def __call__(self, in_stock=True, not_expired=True, is_vegan=None, after=None, limit=None):
+        if self.latency:
+            time.sleep(self.latency)
+        rows = self.rows
+        if in_stock:
+            rows = [row for row in rows if row[3] > 0]
+        if is_vegan is not None:
+            rows = [row for row in rows if row[9] == is_vegan]
+        return rows
+
+
+class FakeWeatherResponse:
+    status_code = 200
+    text = "{}"
+
+    def json(self):
+        return {"main": {"temp": 21.5, "humidity": 60}, "weather": [{"description": "clear sky"}]}
+
+
+def fake_weather_get(url, *args, **kwargs):
+    return FakeWeatherResponse()
+
+
+class FakeAgent:
+    """Stands in for an agno Agent backed by OpenAI, `respond(messages)` builds the content"""
+
+    def __init__(self, respond, latency=0.0):
+        self.respond = respond
+        self.latency = latency
+        self.session_state = {}
+
+    def run(self, message=None, messages=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleNamespace(content=self.respond(messages or message))
+
+
+def fake_supervisor_response(recipe_list, rng):
+    """A structured supervisor response, some suggestions carry a decorated title or a wrong id"""
+    suggestions = []
+    for recipe_id in rng.sample(range(len(recipe_list)), min(5, len(recipe_list))):
+        title = recipe_list[recipe_id]['title']
+        roll = rng.random()
+        if roll < 0.2:
+            title = f"{title}。"
+        elif roll < 0.3:
+            recipe_id = rng.randrange(len(recipe_list))
+        suggestions.append(SimpleNamespace(recipe_id=recipe_id, title=title))
+    return SimpleNamespace(message="Here are some recipes you might like.", suggestions=suggestions)
+
+
+@contextmanager
+def stand_ins(products, translator_latency=0.0, database_latency=0.0):
+    """Swap the network and database calls of Agent.product and Agent.weather for fakes"""
+    saved = (product_module.translate_text, product_module.search_products, weather_module.requests.get)
+    product_module.translate_text = FakeTranslator(translator_latency)
+    product_module.search_products = FakeProductStore(products, database_latency)
+    weather_module.requests.get = fake_weather_get
+    try:
+        yield
+    finally:
+        product_module.translate_text, product_module.search_products, weather_module.requests.get = saved
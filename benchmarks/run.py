@@ -0,0 +1,121 @@
+# run.py
+#
+# Offline benchmarks for the core functions on synthetic corpora.
+# Run with `python -m benchmarks.run --recipes=10000 --products=1000`, nothing is sent to
+# Postgres, the translator, the weather API or OpenAI.
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from Agent.catalog import load_catalog, recipes
+from benchmarks.fakes import FakeAgent, fake_supervisor_response, stand_ins
+from benchmarks.synthetic import generate_products, generate_recipes, generate_supervisor_text
+
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def measure(name, call, inputs, iterations):
+    """Time `call` over the inputs, returns latency percentiles in ms and peak traced memory"""
+    samples = []
+    # The functions print debug output, keep it out of the timings and the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        call(inputs[0])
+        for index in range(iterations):
+            argument = inputs[index % len(inputs)]
+            start = time.perf_counter()
+            call(argument)
+            samples.append((time.perf_counter() - start) * 1000)
+
+        tracemalloc.start()
+        call(inputs[0])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "function": name,
+        "iterations": iterations,
+        "p50_ms": round(percentile(samples, 0.50), 3),
+        "p95_ms": round(percentile(samples, 0.95), 3),
+        "p99_ms": round(percentile(samples, 0.99), 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def build_benchmarks(products, rng):
+    """(name, call, inputs) for every benchmarked function, imports are deferred until the catalog is loaded"""
+    from Agent.cart import add_item_to_cart
+    from Agent.product import clean_ingredient, find_similar_products, get_available_ingredients
+    from Agent.recipe import search_for_recipe_exact
+    from Agent.suggestions import validate_suggestions
+    from Agent.weather import fetch_weather
+
+    sample = rng.sample(recipes, min(200, len(recipes)))
+    titles = [recipe['title'] for recipe in sample]
+    ingredient_lists = [[item['name'] for item in recipe['ingredients']] for recipe in sample]
+    product_rows = [list(product) for product in products]
+    cart_products = [
+        {"Product_name": row[0], "Tax": row[1], "Price": row[2], "Weight": f"{row[5]} {row[6]}"}
+        for row in rng.sample(products, min(200, len(products)))
+    ]
+    cart_items = []
+    supervisor = FakeAgent(lambda messages: fake_supervisor_response(recipes, rng))
+
+    return [
+        ("search_for_recipe_exact", search_for_recipe_exact, titles),
+        ("search_for_recipe_exact_fuzzy", search_for_recipe_exact, [f"1. {title}。" for title in titles]),
+        ("clean_ingredient", clean_ingredient, [name for names in ingredient_lists for name in names]),
+        ("find_similar_products", lambda names: find_similar_products([clean_ingredient(n) for n in names], product_rows),
+         ingredient_lists),
+        ("get_available_ingredients_ja", lambda names: get_available_ingredients(names, "japanese"), ingredient_lists),
+        ("get_available_ingredients_en", lambda names: get_available_ingredients(names, "English"), ingredient_lists),
+        ("add_item_to_cart", lambda product: add_item_to_cart(product, 1, cart_items), cart_products),
+        ("fetch_weather", lambda city: fetch_weather(city), ["Tokyo", "Osaka", "Sapporo"]),
+        ("supervisor_text_titles", validate_suggestions,
+         [generate_supervisor_text(titles, random.Random(seed)) for seed in range(50)]),
+        ("supervisor_structured", lambda messages: validate_suggestions(supervisor.run(messages=messages).content),
+         [None]),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks on synthetic data")
+    parser.add_argument("--recipes", type=int, default=10000, help="synthetic recipes in the catalog")
+    parser.add_argument("--products", type=int, default=1000, help="synthetic products returned by the database")
+    parser.add_argument("--iterations", type=int, default=200, help="timed calls per function")
+    parser.add_argument("--functions", nargs="*", help="only run benchmarks whose name starts with one of these")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    load_catalog(generate_recipes(args.recipes, args.seed))
+    products = generate_products(args.products, args.seed)
+    print(f"Generated {len(recipes)} recipes and {len(products)} products in {time.perf_counter() - start:.1f}s")
+
+    results = []
+    with stand_ins(products):
+        for name, call, inputs in build_benchmarks(products, random.Random(args.seed)):
+            if args.functions and not name.startswith(tuple(args.functions)):
+                continue
+            results.append(measure(name, call, inputs, args.iterations))
+            result = results[-1]
+            print(f"{name:32} p50 {result['p50_ms']:>10.3f} ms  p95 {result['p95_ms']:>10.3f} ms  "
+                  f"p99 {result['p99_ms']:>10.3f} ms  peak {result['peak_kib']:>10.1f} KiB")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"recipes": len(recipes), "products": len(products), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
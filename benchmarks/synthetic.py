@@ -0,0 +1,85 @@
+# synthetic.py
+#
+# Generators for synthetic recipe and product corpora shaped like recipe_data/all_recipes.json
+# and the ai.products rows returned by Database.database.search_products.
+
+import random
+
+ADJECTIVES = ["ふわふわ", "カリッと", "さっぱり", "濃厚", "簡単", "ピリ辛", "ほっこり", "やみつき", "とろ〜り", "ひんやり"]
+INGREDIENTS = ["鶏もも肉", "豚バラ肉", "牛こま肉", "鮭", "えび", "卵", "豆腐", "たまねぎ", "にんじん", "じゃがいも",
+               "キャベツ", "トマト", "なす", "ブロッコリー", "しめじ", "ほうれん草", "牛乳", "チーズ", "バター", "薄力粉",
+               "米", "うどん", "パスタ", "アボカド", "きゅうり", "大根", "かぼちゃ", "ごま", "しょうゆ", "みそ"]
+DISHES = ["炒め", "煮込み", "サラダ", "スープ", "グラタン", "丼", "カレー", "パスタ", "ケーキ", "マリネ", "焼き", "揚げ"]
+QUANTITIES = ["1/2個", "1個", "2個", "100g", "200g", "300g", "大さじ1", "小さじ1/2", "少々", "適量", "1本", "1パック"]
+UNITS = [("g", 100), ("g", 200), ("g", 500), ("個", 1), ("本", 1), ("パック", 1), ("ml", 500), ("ml", 1000)]
+BRANDS = ["くらしにベルク", "明治", "カゴメ", "キッコーマン", "日清", None]
+
+
+def generate_recipe(rng, index):
+    main = rng.sample(INGREDIENTS, 2)
+    title = f"{rng.choice(ADJECTIVES)}！{main[0]}と{main[1]}の{rng.choice(DISHES)} No.{index}"
+    ingredients = [
+        {"name": f"{name}{quantity}", "quantity": quantity}
+        for name, quantity in zip(rng.sample(INGREDIENTS, rng.randint(4, 12)), rng.choices(QUANTITIES, k=12))
+    ]
+    recipe = {
+        "url": f"https://example.com/recipe/{index}",
+        "final_url": f"https://example.com/recipe/{index}",
+        "source": "synthetic",
+        "title": title,
+        "image_url": f"https://example.com/images/{index}.jpg",
+        "cooking_time": {"value": rng.choice([5, 10, 15, 20, 30, 45, 60, 90, 120]), "unit": "分"},
+        "servings": {"value": rng.randint(1, 6), "unit": "人前"},
+        "ingredients": ingredients,
+        "steps": [f"{step}. {rng.choice(ingredients)['name']}を{rng.choice(DISHES)}にする。" for step in range(1, rng.randint(3, 8))],
+    }
+    # Only a minority of the real corpus carries these blocks
+    if rng.random() < 0.1:
+        recipe["rating"] = {"average": round(rng.uniform(3.0, 5.0), 1), "count": rng.randint(1, 200)}
+        recipe["cost_estimate"] = {"value": rng.choice([100, 200, 300, 500, 800, 1200]), "unit": "円"}
+        recipe["nutrients"] = {
+            "カロリー": {"value": round(rng.uniform(50, 900), 1), "unit": "kcal"},
+            "たんぱく質": {"value": round(rng.uniform(0, 60), 1), "unit": "g"},
+            "塩分": {"value": round(rng.uniform(0, 6), 1), "unit": "g"},
+        }
+    return recipe
+
+
+def generate_recipes(count, seed=0):
+    rng = random.Random(seed)
+    return [generate_recipe(rng, index) for index in range(count)]
+
+
+def generate_products(count, seed=0):
+    """Rows in the column order of search_products():
+    (product_name, tax, price, stock_quantity, category, weight, unit, brand, expiry_date, is_vegan)"""
+    rng = random.Random(seed)
+    products = []
+    for index in range(count):
+        name = rng.choice(INGREDIENTS)
+        brand = rng.choice(BRANDS)
+        unit, weight = rng.choice(UNITS)
+        price = rng.randint(80, 1500)
+        products.append((
+            f"{brand + ' ' if brand else ''}{name} {index}",
+            f"{round(price * 1.08)}円",
+            f"{price}円",
+            rng.randint(0, 50),
+            "食品",
+            weight,
+            unit,
+            brand,
+            None,
+            name not in {"鶏もも肉", "豚バラ肉", "牛こま肉", "鮭", "えび", "卵", "牛乳", "チーズ", "バター"},
+        ))
+    return products
+
+
+def generate_supervisor_text(titles, rng=None):
+    """A free text supervisor answer in the old "RECIPE SUGGESTIONS:" format"""
+    rng = rng or random.Random(0)
+    lines = []
+    for title in rng.sample(titles, min(5, len(titles))):
+        # Mix exact titles with the decorations the model tends to add
+        lines.append(rng.choice([title, f"- {title}", f"{title} (Recipe)", f"1. {title}。"]))
+    return "Here are some recipe suggestions based on your preferences.\n\nRECIPE SUGGESTIONS:\n" + "\n".join(lines)
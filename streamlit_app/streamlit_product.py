@@ -1,23 +1,36 @@
 import streamlit as st
 import json
+import time
 
 from Agent.cart import add_item_to_cart, display_cart_summary
 from Agent.product import get_available_ingredients
+from Agent.reservations import ReservationError, checkout
+from Agent.session_memory import memory_manager
+from Agent.session_store import save_session_state
+from tracing import record_span
 
 
 
-def product_cart(product_input, language):
-    products = get_available_ingredients(product_input, language)
+def product_cart(product_input, language, is_vegan=None):
+    """Run the product search once, the results are kept in the session and shown by product_results"""
+    products = get_available_ingredients(product_input, language, is_vegan=is_vegan)
     # print('---------products', products)
-    st.session_state.available_ingredients = products
+    memory_manager.set(st.session_state.session_id, "available_ingredients", products)
     st.session_state.search_done = True  
 
+
+# Quantity changes, Add to Cart and Checkout rerun only this fragment, not the search,
+# the chat or the sidebar
+@st.fragment
+def product_results():
+    render_start = time.perf_counter()
+    product_list = memory_manager.get(st.session_state.session_id, "available_ingredients", [])
+
     # Show matching products if search was done
-    if st.session_state.search_done and not st.session_state.available_ingredients:
+    if st.session_state.search_done and not product_list:
         st.warning("⚠️ No matching product found.")
     elif st.session_state.search_done:
         st.subheader("Matching Products:")
-        product_list = st.session_state.available_ingredients
 
         for i, product in enumerate(product_list):
             st.subheader(f"{product['Product_name']}")
@@ -32,18 +45,43 @@ def product_cart(product_input, language):
 
             if st.button(f"Add to Cart", key=f"add_{i}"):
                 # st.write('🛒 Button clicked for:', product["Product_name"])
-                add_item_to_cart(product, quantity)
-                st.session_state.last_added = product["Product_name"]
+                try:
+                    if add_item_to_cart(product, quantity, cart_id=st.session_state.session_id):
+                        st.session_state.last_added = product["Product_name"]
+                    else:
+                        st.warning(f"⚠️ Not enough {product['Product_name']} in stock.")
+                except ReservationError:
+                    st.error("⚠️ Stock could not be checked right now, please try again.")
                 # st.experimental_rerun()  # Force refresh to show cart update immediately
 
+    record_span("render.products", time.perf_counter() - render_start)
+    cart_panel()
+    # A fragment rerun does not reach the save at the end of app.py
+    save_session_state(st.session_state.session_id, st.session_state)
+
+
+def cart_panel():
     if st.session_state.last_added:
         st.success(f"✅ {st.session_state.last_added} added to cart!")
         st.session_state.last_added = None
+    if st.session_state.get("cart_warning"):
+        st.warning(st.session_state.pop("cart_warning"))
 
     if st.session_state.cart_items:
         st.title("🧺 Your Cart:")
         for item_line in display_cart_summary():
             st.write(item_line)
+        # Items are held for a limited time, checkout turns the holds into sales
+        if st.button("Checkout"):
+            try:
+                unavailable = checkout(st.session_state.session_id, st.session_state.cart_items)
+            except ReservationError:
+                st.error("⚠️ The order could not be placed right now, please try again.")
+                return
+            for item in unavailable:
+                st.warning(f"⚠️ {item['Quantity']} x {item['Product_name']} no longer in stock.")
+            st.session_state.cart_items = []
+            st.success("✅ Order placed!")
 
 
 def get_product_suggestions(language):  
@@ -51,6 +89,7 @@ def get_product_suggestions(language):
     product_input = st.text_input("Enter products or ingredients:")
     if st.button("Find Products"):
         product_cart(product_input.split(","), language)
+    product_results()
         # Simulate product search
     #     products = get_available_ingredients(product_input.split(","), language)
     #     # print('---------products', products)
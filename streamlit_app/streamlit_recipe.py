@@ -5,11 +5,24 @@ from typing import Iterator
 from agno.agent import RunResponse
 import json
 import re
+import time
+from Agent.basket import cheapest_basket, fill_cart
 from Agent.cart import add_item_to_cart, display_cart_summary
 from Agent.product import get_available_ingredients
-from Agent.recipe import clean_recipe_name, search_for_recipe_exact, stream_response_chunks
+from Agent.reservations import ReservationError
+from Agent.catalog import get_recipe, resolve_title
+from Agent.context import extract_requested_servings
+from Agent.facets import bucket_counts
+from Agent.media import best_image_url, media_cache, recipe_image
+from Agent.pipeline import SupervisorStream, finish_suggestion_run, get_recipe_details, prepare_suggestion_run
+from Agent.prefetch import PREFETCH_ENABLED, RecipePrefetcher
+from Agent.recipe import stream_response_chunks
+from Agent.session_memory import memory_manager
+from Agent.session_store import save_session_state
+from Agent.shopping import build_shopping_list
+from tracing import record_span
 from Agent.weather import get_cities_in_country, get_weather
-from streamlit_app.streamlit_product import product_cart
+from streamlit_app.streamlit_product import product_cart, product_results
 
 def get_recipe_suggestions(language):
     # Preference Collection UI in Sidebar
@@ -37,6 +50,10 @@ def get_recipe_suggestions(language):
                     st.sidebar.write(f"☁️ Weather: {weather_data['description']}")
 
 
+    prefetch_enabled = st.sidebar.toggle("⚡ Prefetch suggested recipes", value=PREFETCH_ENABLED)
+    if "prefetcher" not in st.session_state:
+        st.session_state.prefetcher = RecipePrefetcher()
+
     st.sidebar.header("🍽️ Your Preferences")
 
     # Only show preference inputs if not yet collected
@@ -45,7 +62,11 @@ def get_recipe_suggestions(language):
         st.session_state.preferences["taste"] = st.sidebar.selectbox("Taste Preference:", taste_options, index=5)
 
         time_options = ["Quick (< 30 min)", "Medium (30-60 min)", "Long (> 60 min)", "No Preference"]
-        st.session_state.preferences["cooking_time"] = st.sidebar.selectbox("Cooking Time:", time_options, index=3)
+        time_counts = bucket_counts("cooking_time")
+        st.session_state.preferences["cooking_time"] = st.sidebar.selectbox(
+            "Cooking Time:", time_options, index=3,
+            format_func=lambda option: f"{option} ({time_counts[option]})" if option in time_counts else option
+        )
 
         ingredients_input = st.sidebar.text_area("Ingredients you want to use (comma separated):")
         if ingredients_input:
@@ -81,6 +102,9 @@ def get_recipe_suggestions(language):
 
     # Chat Input
     if user_input := st.chat_input("Ask for a recipe suggestion..."):
+        # The user moved on, speculative work for the previous suggestions is dropped
+        st.session_state.prefetcher.cancel()
+
         # Store user's message
         st.session_state.supervisor_history.append({"role": "user", "content": user_input, "language": language})
 
@@ -88,192 +112,31 @@ def get_recipe_suggestions(language):
         with st.chat_message("user"):
             st.markdown(user_input)
 
-        user_message_count = sum(1 for msg in st.session_state.supervisor_history if msg["role"] == "user")
-
         # Check if the request is specifically for recipe suggestions based on preferences
         # is_suggestion_request = any(keyword in user_input.lower() for keyword in
         #                             ["suggest", "recommendation", "what can i make", "recipe", "dish"])
 
         # Check if the request is specifically for Japanese recipes
         st.session_state.is_japanese_request = "japanese" in user_input.lower() or "japan" in user_input.lower() or "日本" in user_input
-        if st.session_state.preferences_collected:
-            text = ""
-            if st.session_state.preferences['taste']:
-                text += f" - Taste must be {st.session_state.preferences['taste']}"
-            if st.session_state.preferences['cooking_time']:
-                text += f" - Cooking Time must be {st.session_state.preferences['cooking_time']}"
-            if st.session_state.preferences['ingredients']:
-                text += f" - Ingredients to include: {', '.join(st.session_state.preferences['ingredients']) if st.session_state.preferences['ingredients'] else 'No specific ingredients'}"
-            if st.session_state.preferences['allergies']:
-                text += f"""MOST IMPORTANT: Suggest Recipe which don't have mentioned Allergies
-                Allergies/Avoid: {', '.join(st.session_state.preferences['allergies']) if st.session_state.preferences['allergies'] else 'None specified'}
-                """
-            if st.session_state.preferences['diet']:
-                text += f" - Diet must be {st.session_state.preferences['diet']}."
-            # Include user preferences in the prompt
-            preferences_text = f"""
-            IMPORTANT USER PREFERENCES:
-            {text}
-
-            Based on these preferences and the user's request: "{user_input}", suggest 5 suitable recipes.
-            Please ensure All the user preferences must be satisfied
-
-            IMPORTANT FORMATTING RULES:
-            1. Format your response as conversational text, followed by "RECIPE SUGGESTIONS:" 
-            2. List each recipe on a new line
-            3. For Japanese recipes, use format: "寿司 (Sushi)" - Japanese name first, then English in parentheses
-            4. ONLY include the recipe names - NO URLs, NO image links, NO descriptions, NO additional text
-            5. DO NOT use JSON format
-
-            Example correct format:
-            Here are some recipe suggestions based on your preferences.
-
-            RECIPE SUGGESTIONS:
-            寿司 (Sushi)
-            天ぷら (Tempura)
-            ラーメン (Ramen)
-            うどん (Udon)
-            そば (Soba)
-            """
-            prompt = f"{preferences_text} IMPORTANT: Generate response in {language}"
-        else:
-            # Process request without specific preference information
-            no_preference_indicators = [
-                "no preferences", "not having specific preferences", "any recipe is fine",
-                "no specific", "don't have preferences", "no particular preferences",
-                "just suggest", "whatever you suggest", "anything is fine"
-            ]
-            has_explicit_no_preference = any(indicator in user_input.lower() for indicator in no_preference_indicators)
-
-            prompt = f"{user_input}"
-            if st.session_state.is_japanese_request:
-                prompt += " IMPORTANT: For Japanese recipes, ALWAYS include both the Japanese name in Japanese characters AND English translation in the format: 寿司 (Sushi). Never suggest Japanese recipes without Japanese characters."
-
-            if has_explicit_no_preference:
-                prompt += " USER HAS EXPLICITLY STATED NO PREFERENCES, PROVIDE RECIPE SUGGESTIONS IMMEDIATELY."
-            elif user_message_count > 1:
-                prompt += " THIS IS A FOLLOW-UP MESSAGE WITH USER PREFERENCES, PROVIDE RECIPE SUGGESTIONS NOW."
-
-            prompt += f"""
-            IMPORTANT FORMATTING RULES: 
-            - Generate response in {language}
-            - alway give msg like this when no preference: give msg like i search for prefrnce but no prefrence so i will suggest some recipes
-            - Format your response as conversational text, followed by "RECIPE SUGGESTIONS:" 
-            - List each recipe on a new line
-            - For Japanese recipes, use format: "寿司 (Sushi)" - Japanese name first, then English in parentheses
-            - ONLY include the recipe names - NO URLs, NO image links, NO descriptions, NO additional text
-            - DO NOT use JSON format
-            """
-        if weather_data:
-            prompt += f"""MUST ADD WEATHER DETAILS AND SUGGEST RECIPE
-                {weather_data['temperature']}:
-                    - If the temperature is over 30°C and the weather is hot or sunny, suggest cold or refreshing dishes, drinks.
-                    - If the temperature is below 15°C and the weather is cold, suggest warm and comforting dishes, drinks.
-                    - If the temperature is between 15°C and 30°C, suggest balanced dishes,drinks that are neither too hot nor too cold.
-                {weather_data['description']}:
-                    - If  weather data includes the word **rain**: suggest meal based on rain"""
-            
-        msg = [{"role": "user", "content": prompt}]
-
-        # Include conversation history for context if this isn't the first message
-        if user_message_count > 1 and len(st.session_state.supervisor_history) >= 2:
-            context_messages = []
-            # Add the last 2 exchanges for context
-            for i in range(min(4, len(st.session_state.supervisor_history))):
-                if len(st.session_state.supervisor_history) - i - 1 >= 0:
-                    prev_msg = st.session_state.supervisor_history[len(st.session_state.supervisor_history) - i - 1]
-                    context_messages.insert(0, {"role": prev_msg["role"], "content": prev_msg["content"]})
-
-            # Add current message
-            context_messages.append({"role": "user", "content": prompt})
-            msg = context_messages
+
+        msg, allowed_ids = prepare_suggestion_run(
+            st.session_state.supervisor_agent, st.session_state.supervisor_history, user_input, language,
+            st.session_state.preferences, st.session_state.preferences_collected, weather_data
+        )
         print(msg)
-        # response_iterator = st.session_state.supervisor_agent.run(message=prompt, stream=True)
-        response_iterator = st.session_state.supervisor_agent.run(messages=msg, stream=True)
-        # print('------------msg', msg)
-        # response_iterator = st.session_state.weather_agent.run(messages=msg, stream=True)
+        # The supervisor returns a SupervisorResponse, its message is shown as it streams; the
+        # suggestions are validated against the catalog and repaired locally afterwards
         with st.chat_message("assistant"):
-            full_response = st.write_stream(stream_response_chunks(response_iterator))
+            response_area = st.empty()
+            stream = SupervisorStream(st.session_state.supervisor_agent, msg, user_input, language, allowed_ids)
+            with response_area:
+                st.write_stream(stream)
+            full_response, dish_suggestions = finish_suggestion_run(stream.content, allowed_ids)
+            response_area.markdown(full_response)
 
         # Store assistant response
         st.session_state.supervisor_history.append({"role": "assistant", "content": full_response})
 
-        # Extract suggestions for button display
-        dish_suggestions = []
-
-        # First try to parse as JSON (in case the model returns JSON)
-        try:
-            json_response = json.loads(full_response)
-            if isinstance(json_response, dict) and "suggestions" in json_response and isinstance(
-                    json_response["suggestions"], list):
-                dish_suggestions = json_response["suggestions"]
-
-                # Create a formatted response with RECIPE SUGGESTIONS: marker for display
-                formatted_response = json_response.get("message",
-                                                    "Here are some recipe suggestions:") + "\n\nRECIPE SUGGESTIONS:\n"
-                formatted_response += "\n".join(dish_suggestions)
-
-                # Update the stored response to use our formatted version with the marker
-                st.session_state.supervisor_history[-1]["content"] = formatted_response
-                full_response = formatted_response
-        except (json.JSONDecodeError, ValueError):
-            # Not valid JSON, continue with existing text extraction
-            pass
-
-        # If no suggestions were found via JSON, try the text marker approach
-        if not dish_suggestions and "RECIPE SUGGESTIONS:" in full_response:
-            # Split the content at the marker and take everything after it
-            suggestion_section = full_response.split("RECIPE SUGGESTIONS:", 1)[1].strip()
-            # Process each line in the suggestion section
-            for line in suggestion_section.splitlines():
-                line = line.strip()
-                if line:
-                    # Remove common punctuation that might appear
-                    if line.endswith((".", ",", ";", "?", "!", ":", "。", "、", "！", "？", "：", "；")):
-                        line = line[:-1].strip()
-
-                    # Clean the recipe name
-                    line = clean_recipe_name(line)
-
-                    # Add to suggestions if non-empty
-                    if line and not line.lower().startswith(("if ", "when ", "please ", "let me")):
-                        dish_suggestions.append(line)
-
-            # For Japanese requests, verify that suggestions have Japanese characters
-            if st.session_state.is_japanese_request and dish_suggestions:
-                print('--------dish_suggestions', dish_suggestions)
-                has_japanese_chars = False
-                for suggestion in dish_suggestions:
-                    # Check if any suggestion contains Japanese characters
-                    if any(ord(char) > 127 for char in suggestion):
-                        has_japanese_chars = True
-                        break
-
-                # If no Japanese characters found, force regeneration with Japanese
-                if not has_japanese_chars:
-                    force_japanese_prompt = (
-                        f"Based on the user request for Japanese recipes, please provide ONLY recipe suggestions "
-                        f"with BOTH Japanese characters AND English translations. Format each suggestion as: "
-                        f"[Japanese name in Japanese characters] ([English translation]). "
-                        f"Examples: 寿司 (Sushi), 天ぷら (Tempura), ラーメン (Ramen). "
-                        f"IMPORTANT: Do NOT include URLs, links, or descriptions - ONLY the recipe names. "
-                        f"Start with 'RECIPE SUGGESTIONS:' and list 5 suitable recipes."
-                    )
-
-                    force_msg = [{"role": "user", "content": force_japanese_prompt}]
-                    force_response = st.session_state.supervisor_agent.run(
-                        messages=force_msg,
-                        stream=False
-                    )
-
-                    # Replace the previous response
-                    st.session_state.supervisor_history[-1]["content"] = force_response.content
-
-                    # Extract new suggestions
-                    if "RECIPE SUGGESTIONS:" in force_response.content:
-                        suggestion_section = force_response.content.split("RECIPE SUGGESTIONS:", 1)[1].strip()
-                        dish_suggestions = [line.strip() for line in suggestion_section.splitlines() if line.strip()]
-        # print('----dishhhhhhhhhhhhhh----', dish_suggestions)
         if dish_suggestions:
             st.session_state.dish_suggestions = dish_suggestions
             st.session_state.final_dish_choice = None
@@ -289,57 +152,49 @@ def get_recipe_suggestions(language):
                 st.session_state.ready_for_recipe = True
                 st.rerun()
 
+        # Thumbnails of the suggestions are cached before one of them is opened,
+        # a restored title that is no longer in the catalog has none
+        suggestion_ids = [resolve_title(title) for title in st.session_state.dish_suggestions]
+        media_cache.prefetch([best_image_url(get_recipe(recipe_id))
+                              for recipe_id in suggestion_ids if recipe_id is not None])
+
+        # Speculatively resolve the top suggestions while the user reads them
+        if prefetch_enabled and not st.session_state.ready_for_recipe:
+            st.session_state.prefetcher.start(
+                st.session_state.dish_suggestions, language, st.session_state.preferences,
+                st.session_state.preferences_collected, st.session_state.supervisor_history
+            )
+
+        # One consolidated list for several suggestions, matched against the products in one pass
+        shopping_list_panel(language)
+
     # Generate recipe
     recipe_generated = False
     if st.session_state.ready_for_recipe and st.session_state.final_dish_choice:
-        # Build context from conversation history and preferences
-        conversation_history = ""
-        for msg in st.session_state.supervisor_history:
-            conversation_history += f"{msg['content']}\n"
-
-        preferences_context = ""
-        if st.session_state.preferences_collected:
-            preferences = st.session_state.preferences
-            preferences_list = []
-
-            if preferences['taste'] and preferences['taste'] != "No Preference":
-                preferences_list.append(f"- Taste: {preferences['taste']}")
-            
-            if preferences['cooking_time'] and preferences['cooking_time'] != "No Preference":
-                preferences_list.append(f"- Cooking Time: {preferences['cooking_time']}")
-            
-            if preferences['ingredients']:
-                if preferences['ingredients']:
-                    preferences_list.append(f"- Ingredients to include: {', '.join(preferences['ingredients'])}")
-            
-            if preferences['allergies']:
-                if preferences['allergies']:
-                    preferences_list.append(f"- Allergies/Avoid: {', '.join(preferences['allergies'])}")
-            
-            if preferences['diet'] and preferences['diet'] != "No Preference":
-                preferences_list.append(f"- Diet: {preferences['diet']}")
-
-            # Join all valid preferences together
-            if preferences_list:
-                preferences_context = "User Preferences:\n" + "\n".join(preferences_list)
-
-        # Construct prompt for recipe agent using context
+        # Cleaned dish name for the not found message
         cleaned_dish_name = re.sub(r'\s*\(.*?\)', '', st.session_state.final_dish_choice)
         cleaned_dish_name = re.sub(r'^\s*-*\s*', '', cleaned_dish_name)
-        
-        recipe_from_json = search_for_recipe_exact(cleaned_dish_name)
-        if recipe_from_json:
-            prompt = (
-                f"Please translate the following recipe into {language}:\n\n"
-                f"{preferences_context}\n\n"
-                f"Recipe: {recipe_from_json}\n\n"
-                f"Adjust the ingredients, times and quantities proportionally to match for given {conversation_history} servings. "
-                f"Ensure that all quantities are modified proportionally and the INGREDIANTS appear on separate lines. "
-                f"Do not omit any important details in the translation."
+
+        # The recipe is resolved once per dish, language, preferences and servings, reruns reuse it
+        recipe_key = (
+            st.session_state.final_dish_choice, language, json.dumps(st.session_state.preferences, sort_keys=True),
+            st.session_state.preferences_collected, extract_requested_servings(st.session_state.supervisor_history),
+        )
+        recipe = None
+        if st.session_state.get("recipe_key") == recipe_key:
+            recipe = memory_manager.get(st.session_state.session_id, "recipe")
+        if recipe is None:
+            recipe = get_recipe_details(
+                st.session_state.recipe_agent, st.session_state.final_dish_choice, language,
+                st.session_state.preferences, st.session_state.preferences_collected, st.session_state.supervisor_history,
+                prefetcher=st.session_state.prefetcher if prefetch_enabled else None
             )
-            run_response: Iterator[RunResponse] = st.session_state.recipe_agent.run(prompt, stream=True)
-            recipe = run_response.content
-        
+            if recipe:
+                st.session_state.recipe_key = recipe_key
+                # Product results of the previous recipe no longer apply
+                st.session_state.search_done = False
+        if recipe:
+            render_start = time.perf_counter()
             st.title("🍽️ Deliciously Recipe 🍽️")
 
             # Display recipe image or video if available
@@ -354,11 +209,16 @@ def get_recipe_suggestions(language):
             #     if mp4_video and mp4_video.get('url'):
             #         st.video(mp4_video.get('url'))
 
-            if recipe.image_url and recipe.image_url.startswith(('http://', 'https://')):
-                # Only display if it's a valid URL
-                st.image(recipe.image_url, caption=recipe.recipe_title)
-            elif recipe.image_url:
-                # If there's an image URL but it's not valid, just display a message
+            # The image comes from the catalog record, the agent's copy is often the site logo
+            recipe_id = resolve_title(st.session_state.final_dish_choice)
+            image_path, image_url = recipe_image(get_recipe(recipe_id) if recipe_id is not None else None)
+            if image_path:
+                st.image(image_path, caption=recipe.recipe_title)
+            elif image_url:
+                # Not cached yet, the browser fetches it this time and the thumbnail is stored for next time
+                st.image(image_url, caption=recipe.recipe_title)
+                media_cache.prefetch([image_url])
+            else:
                 st.write("Image not available")
 
             info = {
@@ -390,8 +250,9 @@ def get_recipe_suggestions(language):
             st.subheader("Storage Instructions")
             st.write(recipe.storage_instructions)
 
-            st.session_state.recipe = recipe
+            memory_manager.set(st.session_state.session_id, "recipe", recipe)
             recipe_generated = True
+            record_span("render.recipe", time.perf_counter() - render_start)
         else:
             st.error(f"No reccipe found for{cleaned_dish_name}")
 
@@ -402,4 +263,86 @@ def get_recipe_suggestions(language):
 
         if st.button("Find Available Ingredients"):
             with st.spinner("Finding matching products... ⏳"):
-                product_cart(st.session_state.recipe.ingredients, language)
\ No newline at end of file
+                is_vegan = True if st.session_state.preferences.get('diet') == "Vegan" else None
+                product_cart(recipe.ingredients, language, is_vegan=is_vegan)
+        product_results()
+
+        # Cheapest product and package count per ingredient, for the servings the user asked for
+        basket_panel(language)
+
+
+# The shopping list and the basket rerun on their own, adding an item does not rebuild
+# the chat or resolve the recipe again
+@st.fragment
+def shopping_list_panel(language):
+    with st.expander("🧾 Shopping list for several recipes"):
+        selected = st.multiselect("Recipes:", st.session_state.dish_suggestions,
+                                  default=st.session_state.dish_suggestions)
+        list_servings = st.number_input("Servings per recipe:", min_value=1, max_value=12, value=2, step=1)
+        if st.button("Build Shopping List") and selected:
+            with st.spinner("Matching ingredients to products... ⏳"):
+                is_vegan = True if st.session_state.preferences.get('diet') == "Vegan" else None
+                recipe_ids = [resolve_title(title) for title in selected]
+                shopping_list = build_shopping_list(
+                    [recipe_id for recipe_id in recipe_ids if recipe_id is not None], language,
+                    is_vegan=is_vegan, servings=list_servings
+                )
+                memory_manager.set(st.session_state.session_id, "shopping_list", shopping_list)
+        for i, item in enumerate(memory_manager.get(st.session_state.session_id, "shopping_list", [])):
+            product = item["product"]
+            if product is None:
+                st.write(f"- {item['ingredient']}: {item['amount']} (not in stock)")
+                continue
+            st.write(f"- {item['ingredient']}: {item['amount']} → {product['Product_name']} "
+                     f"({product['Weight']}, {product['Tax']} 円)")
+            if st.button("Add to Cart", key=f"list_add_{i}"):
+                try:
+                    added = add_item_to_cart(product, 1, cart_id=st.session_state.session_id)
+                except ReservationError:
+                    st.error("⚠️ Stock could not be checked right now, please try again.")
+                    continue
+                if added:
+                    st.session_state.last_added = product["Product_name"]
+                    # A fragment rerun does not reach the save at the end of app.py
+                    save_session_state(st.session_state.session_id, st.session_state)
+                    # The cart is drawn by the product results fragment, redraw the page so it shows the item
+                    st.rerun(scope="app")
+                else:
+                    st.warning(f"⚠️ Not enough {product['Product_name']} in stock.")
+
+
+@st.fragment
+def basket_panel(language):
+    if st.button("Find Cheapest Basket"):
+        with st.spinner("Pricing the ingredients... ⏳"):
+            is_vegan = True if st.session_state.preferences.get('diet') == "Vegan" else None
+            recipe_id = resolve_title(st.session_state.final_dish_choice)
+            basket = cheapest_basket(
+                [recipe_id] if recipe_id is not None else [], language, is_vegan=is_vegan,
+                servings=extract_requested_servings(st.session_state.supervisor_history)
+            )
+            memory_manager.set(st.session_state.session_id, "basket", basket)
+            st.session_state.basket_title = st.session_state.final_dish_choice
+
+    basket = memory_manager.get(st.session_state.session_id, "basket")
+    if basket and st.session_state.get("basket_title") == st.session_state.final_dish_choice:
+        for item in basket["items"]:
+            st.write(f"- {item['ingredient']} ({item['amount']}): {item['packages']} x "
+                     f"{item['product']['Product_name']} ({item['product']['Weight']}) = {item['cost']} 円")
+        st.write(f"**Basket total with Tax: {basket['total']} 円**")
+        if basket["missing"]:
+            st.caption("Not in stock: " + ", ".join(basket["missing"]))
+        if st.button("Add Basket to Cart"):
+            try:
+                unavailable = fill_cart(basket, cart_id=st.session_state.session_id)
+            except ReservationError:
+                # Items added before the failure stay in the cart
+                save_session_state(st.session_state.session_id, st.session_state)
+                st.error("⚠️ Stock could not be checked right now, please try again.")
+                return
+            save_session_state(st.session_state.session_id, st.session_state)
+            memory_manager.set(st.session_state.session_id, "basket", None)
+            st.session_state.last_added = "Basket"
+            if unavailable:
+                st.session_state.cart_warning = "⚠️ Sold out meanwhile: " + ", ".join(unavailable)
+            st.rerun(scope="app")
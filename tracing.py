@@ -0,0 +1,221 @@
+# tracing.py
+#
+# Span timing for the stages of a request (translation, product query, fuzzy matching,
+# vector search, model latency, rendering). Spans are tagged with the request and session
+# id, kept as per-stage percentiles for a Prometheus-style /metrics endpoint and, when
+# TRACE_FILE is set, exported as JSON lines.
+
+import asyncio
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRACING_ENABLED = os.getenv("TRACING", "1") == "1"
+TRACE_FILE = os.getenv("TRACE_FILE")
+# Recent durations kept per stage for the percentiles
+TRACE_SAMPLES = int(os.getenv("TRACE_SAMPLES", "2048"))
+QUANTILES = (0.5, 0.95, 0.99)
+EXPORT_BATCH = 100
+
+current_request_id = ContextVar("current_request_id", default=None)
+current_session_id = ContextVar("current_session_id", default=None)
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=TRACE_SAMPLES)
+
+
+stage_stats = {}
+stats_lock = threading.Lock()
+
+
+class TraceExporter:
+    """Buffers finished spans and appends them to a JSONL file in batches"""
+
+    def __init__(self, path, batch=EXPORT_BATCH):
+        self.path = path
+        self.batch = batch
+        self.pending = []
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def export(self, record):
+        with self.lock:
+            self.pending.append(record)
+            full = len(self.pending) >= self.batch
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records)
+        except OSError as e:
+            print(f"Trace export failed: {e}")
+
+
+exporter = TraceExporter(TRACE_FILE) if TRACE_FILE else None
+
+
+def start_request(session_id=None, request_id=None):
+    """Tag the spans that follow in this thread or task with a new request id"""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    current_request_id.set(request_id)
+    if session_id is not None:
+        current_session_id.set(session_id)
+    return request_id
+
+
+def record_span(name, duration, error=False, **attributes):
+    if not TRACING_ENABLED:
+        return
+    with stats_lock:
+        stats = stage_stats.get(name)
+        if stats is None:
+            stats = stage_stats[name] = StageStats()
+        stats.count += 1
+        stats.total += duration
+        stats.errors += int(error)
+        stats.samples.append(duration)
+    if exporter is not None:
+        exporter.export({
+            "stage": name,
+            "duration_ms": round(duration * 1000, 3),
+            "error": error,
+            "request_id": current_request_id.get(),
+            "session_id": current_session_id.get(),
+            "time": time.time(),
+            **attributes,
+        })
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the enclosed block as one stage of the current request"""
+    start = time.perf_counter()
+    error = False
+    try:
+        yield attributes
+    except Exception:
+        error = True
+        raise
+    finally:
+        record_span(name, time.perf_counter() - start, error, **attributes)
+
+
+def traced(name):
+    """Decorator timing every call of a function, sync or async, as the stage `name`"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def stage_summary():
+    """Count, error count, total seconds and recent percentiles per stage"""
+    with stats_lock:
+        snapshot = {name: (stats.count, stats.errors, stats.total, sorted(stats.samples))
+                    for name, stats in stage_stats.items()}
+    return {
+        name: {
+            "count": count,
+            "errors": errors,
+            "sum": total,
+            "quantiles": {q: percentile(samples, q) for q in QUANTILES} if samples else {},
+        }
+        for name, (count, errors, total, samples) in sorted(snapshot.items())
+    }
+
+
+# Other modules add their own metric families to /metrics, each a function returning lines
+metric_renderers = []
+
+
+def register_metrics(render):
+    metric_renderers.append(render)
+    return render
+
+
+def render_prometheus():
+    """The stage summary and registered metrics in the Prometheus text exposition format"""
+    lines = [
+        "# HELP recipe_stage_seconds Latency of request stages.",
+        "# TYPE recipe_stage_seconds summary",
+    ]
+    errors = [
+        "# HELP recipe_stage_errors_total Stage runs that raised.",
+        "# TYPE recipe_stage_errors_total counter",
+    ]
+    for name, summary in stage_summary().items():
+        for q, value in summary["quantiles"].items():
+            lines.append(f'recipe_stage_seconds{{stage="{name}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'recipe_stage_seconds_sum{{stage="{name}"}} {summary["sum"]:.6f}')
+        lines.append(f'recipe_stage_seconds_count{{stage="{name}"}} {summary["count"]}')
+        errors.append(f'recipe_stage_errors_total{{stage="{name}"}} {summary["errors"]}')
+    for render in metric_renderers:
+        errors.extend(render())
+    return "\n".join(lines + errors) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+metrics_server = None
+metrics_lock = threading.Lock()
+
+
+def serve_metrics(port):
+    """Serve /metrics on `port` from a daemon thread, for processes without their own HTTP server"""
+    global metrics_server
+    with metrics_lock:
+        if metrics_server is not None:
+            return
+        try:
+            metrics_server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        except OSError as e:
+            print(f"Metrics endpoint not started: {e}")
+            return
+    threading.Thread(target=metrics_server.serve_forever, name="metrics", daemon=True).start()